@@ -0,0 +1,24 @@
+"""Add templates updated
+
+Revision ID: 3a9e5c41b2d7
+Revises: 7d3b1f0e9a52
+Create Date: 2026-10-18 15:02:44.903216
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3a9e5c41b2d7"
+down_revision = "7d3b1f0e9a52"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("templates", sa.Column("updated", sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade():
+    op.drop_column("templates", "updated")
@@ -0,0 +1,115 @@
+"""Extend search indexes
+
+Revision ID: 4f8d2b6a1c37
+Revises: 9c2e7f14d8a3
+Create Date: 2026-10-18 19:41:52.630194
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "4f8d2b6a1c37"
+down_revision = "9c2e7f14d8a3"
+branch_labels = None
+depends_on = None
+
+# NOTE: must be kept in sync with SEARCH_COLUMNS of models, indexed expression should match BaseModel.get_search_expression
+SEARCH_COLUMNS = {
+    "users": ("id", "email", "is_superuser", "settings"),
+    "wallets": ("id", "name", "xpub", "currency", "user_id", "lightning_enabled", "label", "hint", "contract"),
+    "notifications": ("id", "user_id", "name", "provider", "data"),
+    "templates": ("id", "user_id", "name", "text"),
+    "stores": (
+        "id",
+        "name",
+        "default_currency",
+        "email",
+        "email_host",
+        "email_port",
+        "email_use_ssl",
+        "email_user",
+        "checkout_settings",
+        "theme_settings",
+        "plugin_settings",
+        "templates",
+        "user_id",
+    ),
+    "discounts": ("id", "user_id", "name", "percent", "description", "promocode", "currencies"),
+    "products": (
+        "id",
+        "name",
+        "price",
+        "quantity",
+        "download_url",
+        "category",
+        "description",
+        "image",
+        "store_id",
+        "status",
+        "templates",
+        "user_id",
+    ),
+    "invoices": (
+        "id",
+        "price",
+        "currency",
+        "paid_currency",
+        "status",
+        "expiration",
+        "buyer_email",
+        "discount",
+        "promocode",
+        "shipping_address",
+        "notes",
+        "notification_url",
+        "redirect_url",
+        "store_id",
+        "order_id",
+        "user_id",
+    ),
+    "tokens": ("id", "user_id", "app_id", "redirect_url"),
+}
+
+OLD_SEARCH_COLUMNS = {
+    "users": ("id", "email"),
+    "wallets": ("id", "name", "xpub", "currency", "label", "hint", "contract"),
+    "notifications": ("id", "name", "provider"),
+    "templates": ("id", "name"),
+    "stores": ("id", "name", "email", "default_currency"),
+    "discounts": ("id", "name", "description", "promocode", "currencies"),
+    "products": ("id", "name", "description", "category", "status"),
+    "invoices": (
+        "id",
+        "order_id",
+        "buyer_email",
+        "status",
+        "currency",
+        "paid_currency",
+        "promocode",
+        "notes",
+        "shipping_address",
+    ),
+    "tokens": ("id", "app_id", "redirect_url"),
+}
+
+
+def get_search_expression(table, columns):
+    return " || E'\\n' || ".join(f"coalesce({table}.{column}::text, '')" for column in columns)
+
+
+def get_old_search_expression(table, columns):
+    return " || ' ' || ".join(f"coalesce({table}.{column}, '')" for column in columns)
+
+
+def create_indexes(search_columns, get_expression):
+    for table, columns in search_columns.items():
+        op.execute(f"DROP INDEX IF EXISTS {table}_search_idx")
+        op.execute(f"CREATE INDEX {table}_search_idx ON {table} USING gin (({get_expression(table, columns)}) gin_trgm_ops)")
+
+
+def upgrade():
+    create_indexes(SEARCH_COLUMNS, get_search_expression)
+
+
+def downgrade():
+    create_indexes(OLD_SEARCH_COLUMNS, get_old_search_expression)
@@ -0,0 +1,42 @@
+"""Add IPN deliveries
+
+Revision ID: 7d3b1f0e9a52
+Revises: c98fde1ca6f1
+Create Date: 2026-10-18 14:21:07.184523
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7d3b1f0e9a52"
+down_revision = "c98fde1ca6f1"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "ipndeliveries",
+        sa.Column("id", sa.Text(), nullable=False),
+        sa.Column("invoice_id", sa.Text(), nullable=True),
+        sa.Column("url", sa.Text(), nullable=False),
+        sa.Column("data", sa.JSON(), nullable=True),
+        sa.Column("status", sa.Text(), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("response_status", sa.Integer(), nullable=True),
+        sa.Column("error", sa.Text(), nullable=True),
+        sa.Column("created", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("updated", sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(["invoice_id"], ["invoices.id"], ondelete="SET NULL"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_ipndeliveries_id"), "ipndeliveries", ["id"], unique=False)
+    op.create_index(op.f("ix_ipndeliveries_invoice_id"), "ipndeliveries", ["invoice_id"], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_ipndeliveries_invoice_id"), table_name="ipndeliveries")
+    op.drop_index(op.f("ix_ipndeliveries_id"), table_name="ipndeliveries")
+    op.drop_table("ipndeliveries")
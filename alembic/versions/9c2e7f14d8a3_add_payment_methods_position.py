@@ -0,0 +1,29 @@
+"""Add payment methods position
+
+Revision ID: 9c2e7f14d8a3
+Revises: e1c4a7d9f620
+Create Date: 2026-10-18 19:02:11.204816
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9c2e7f14d8a3"
+down_revision = "e1c4a7d9f620"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("paymentmethods", sa.Column("position", sa.Integer(), nullable=True))
+    op.execute(
+        """UPDATE paymentmethods SET position = ordered.position FROM (
+            SELECT id, row_number() OVER (PARTITION BY invoice_id ORDER BY created) - 1 AS position FROM paymentmethods
+        ) AS ordered WHERE paymentmethods.id = ordered.id"""
+    )
+
+
+def downgrade():
+    op.drop_column("paymentmethods", "position")
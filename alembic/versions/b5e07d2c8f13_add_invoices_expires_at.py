@@ -0,0 +1,33 @@
+"""Add invoices expires_at
+
+Revision ID: b5e07d2c8f13
+Revises: 3a9e5c41b2d7
+Create Date: 2026-10-18 15:48:12.377105
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b5e07d2c8f13"
+down_revision = "3a9e5c41b2d7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("invoices", sa.Column("expires_at", sa.DateTime(timezone=True), nullable=True))
+    op.execute("UPDATE invoices SET expires_at = created + expiration * interval '1 minute'")
+    op.create_index(
+        "invoices_pending_expires_at_idx",
+        "invoices",
+        ["expires_at"],
+        unique=False,
+        postgresql_where=sa.text("status = 'pending'"),
+    )
+
+
+def downgrade():
+    op.drop_index("invoices_pending_expires_at_idx", table_name="invoices")
+    op.drop_column("invoices", "expires_at")
@@ -0,0 +1,54 @@
+"""Add search indexes
+
+Revision ID: c98fde1ca6f1
+Revises: a050d461a6c1
+Create Date: 2026-10-18 12:04:31.520417
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c98fde1ca6f1"
+down_revision = "a050d461a6c1"
+branch_labels = None
+depends_on = None
+
+# NOTE: must be kept in sync with SEARCH_COLUMNS of models, indexed expression should match BaseModel.get_search_expression
+SEARCH_COLUMNS = {
+    "users": ("id", "email"),
+    "wallets": ("id", "name", "xpub", "currency", "label", "hint", "contract"),
+    "notifications": ("id", "name", "provider"),
+    "templates": ("id", "name"),
+    "stores": ("id", "name", "email", "default_currency"),
+    "discounts": ("id", "name", "description", "promocode", "currencies"),
+    "products": ("id", "name", "description", "category", "status"),
+    "invoices": (
+        "id",
+        "order_id",
+        "buyer_email",
+        "status",
+        "currency",
+        "paid_currency",
+        "promocode",
+        "notes",
+        "shipping_address",
+    ),
+    "tokens": ("id", "app_id", "redirect_url"),
+}
+
+
+def get_search_expression(table, columns):
+    return " || ' ' || ".join(f"coalesce({table}.{column}, '')" for column in columns)
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for table, columns in SEARCH_COLUMNS.items():
+        op.execute(
+            f"CREATE INDEX {table}_search_idx ON {table} USING gin (({get_search_expression(table, columns)}) gin_trgm_ops)"
+        )
+
+
+def downgrade():
+    for table in SEARCH_COLUMNS:
+        op.execute(f"DROP INDEX IF EXISTS {table}_search_idx")
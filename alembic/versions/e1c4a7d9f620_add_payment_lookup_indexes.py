@@ -0,0 +1,36 @@
+"""Add payment lookup indexes
+
+Revision ID: e1c4a7d9f620
+Revises: b5e07d2c8f13
+Create Date: 2026-10-18 17:21:40.518362
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e1c4a7d9f620"
+down_revision = "b5e07d2c8f13"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("paymentmethods_currency_lookup_field_idx", "paymentmethods", ["currency", "lookup_field"], unique=False)
+    op.create_index("paymentmethods_invoice_id_idx", "paymentmethods", ["invoice_id"], unique=False)
+    op.create_index(
+        "invoices_pending_status_idx",
+        "invoices",
+        ["status"],
+        unique=False,
+        postgresql_where=sa.text("status IN ('pending', 'paid')"),
+    )
+    op.create_index("walletsxstores_store_id_wallet_id_idx", "walletsxstores", ["store_id", "wallet_id"], unique=False)
+
+
+def downgrade():
+    op.drop_index("walletsxstores_store_id_wallet_id_idx", table_name="walletsxstores")
+    op.drop_index("invoices_pending_status_idx", table_name="invoices")
+    op.drop_index("paymentmethods_invoice_id_idx", table_name="paymentmethods")
+    op.drop_index("paymentmethods_currency_lookup_field_idx", table_name="paymentmethods")
@@ -7,9 +7,12 @@ WEBSITE = "https://bitcartcc.com"  # BitcartCC official site
 GIT_REPO_URL = "https://github.com/bitcartcc/bitcart"  # BitcartCC github repository
 DOCKER_REPO_URL = "https://github.com/bitcartcc/bitcart-docker"  # BitcartCC Docker Packaging repository
 MAX_CONFIRMATION_WATCH = 6  # maximum number of confirmations to save
+EXPIRATION_BATCH_SIZE = 1000  # maximum number of invoices expired in one query
 FEE_ETA_TARGETS = [25, 10, 5, 2, 1]  # supported target blocks confirmation ETA fee
 EVENTS_CHANNEL = "events"  # default redis channel for event system (inter-process communication)
-LOGSERVER_PORT = 9020  # port for logserver in the worker
+EVENTS_QUEUE = "events:queue"  # events for the background worker, kept while no worker is the leader
+EVENTS_QUEUE_SIZE = 10000  # maximum number of queued events, oldest are dropped
+LOGSERVER_PORT = 9020  # default port for logserver in the worker
 ALPHABET = string.ascii_letters  # used by ID generator
 SUPPORTED_CRYPTOS = {coin.lower(): obj.friendly_name for (coin, obj) in _COINS.items()}  # all cryptos supported by the SDK
 HTTPS_REVERSE_PROXIES = [
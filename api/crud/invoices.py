@@ -1,3 +1,4 @@
+import asyncio
 from collections import defaultdict
 from decimal import Decimal
 from operator import attrgetter
@@ -53,13 +54,13 @@ async def create_invoice(invoice: schemes.CreateInvoice, user: schemes.User):
     return obj
 
 
-async def _create_payment_method(invoice, wallet, product, store, discounts, promocode, lightning=False):
+async def _create_payment_method(invoice, wallet, product, store, discounts, promocode, created, position, lightning=False):
     coin = settings.settings.get_coin(wallet.currency, {"xpub": wallet.xpub, "contract": wallet.contract})
     discount_id = None
-    symbol = await coin.server.readcontract(wallet.contract, "symbol") if wallet.contract else wallet.currency
+    symbol = await utils.wallets.get_wallet_symbol(coin, wallet)
     divisibility = currency_table.get_currency_data(wallet.currency)["divisibility"]
     if wallet.contract:  # pragma: no cover
-        divisibility = min(MAX_CONTRACT_DIVISIBILITY, await coin.server.readcontract(wallet.contract, "decimals"))
+        divisibility = min(MAX_CONTRACT_DIVISIBILITY, await utils.wallets.get_token_metadata(coin, wallet, "decimals"))
     rate = currency_table.normalize(
         invoice.currency, await utils.wallets.get_rate(wallet, invoice.currency, store.default_currency)
     )
@@ -118,31 +119,58 @@ async def _create_payment_method(invoice, wallet, product, store, discounts, pro
         confirmations=0,
         label=wallet.label,
         hint=wallet.hint,
-        created=utils.time.now(),
+        created=created,
+        position=position,
         contract=wallet.contract,
         symbol=symbol,
         divisibility=divisibility,
     )
 
 
-async def create_payment_method(invoice, wallet, product, store, discounts, promocode):
-    method = await _create_payment_method(invoice, wallet, product, store, discounts, promocode)
+async def create_payment_method(invoice, wallet, product, store, discounts, promocode, created=None, position=0):
+    created = created or utils.time.now()
+    method = await _create_payment_method(invoice, wallet, product, store, discounts, promocode, created, position)
     coin_settings = settings.settings.crypto_settings.get(wallet.currency.lower())
     if coin_settings and coin_settings["lightning"] and wallet.lightning_enabled:  # pragma: no cover
-        await _create_payment_method(invoice, wallet, product, store, discounts, promocode, lightning=True)
+        await _create_payment_method(invoice, wallet, product, store, discounts, promocode, created, position, lightning=True)
     return method
 
 
-async def update_invoice_payments(invoice, wallets, discounts, store, product, promocode):
-    logger.info(f"Started adding invoice payments for invoice {invoice.id}")
-    for wallet_id in wallets:
-        wallet = await models.Wallet.get(wallet_id)
+async def create_payment_method_safe(semaphore, invoice, wallet, product, store, discounts, promocode, created, position):
+    async with semaphore:
         try:
-            await create_payment_method(invoice, wallet, product, store, discounts, promocode)
+            await create_payment_method(invoice, wallet, product, store, discounts, promocode, created, position)
         except Exception as e:
             logger.error(
                 f"Invoice {invoice.id}: failed creating payment method {wallet.currency.upper()}:\n{get_exception_message(e)}"
             )
+
+
+async def update_invoice_payments(invoice, wallets, discounts, store, product, promocode):
+    logger.info(f"Started adding invoice payments for invoice {invoice.id}")
+    wallet_objects = {
+        wallet.id: wallet for wallet in await models.Wallet.query.where(models.Wallet.id.in_(wallets)).gino.all()
+    }
+    semaphore = asyncio.Semaphore(settings.settings.payment_methods_concurrency)
+    created = utils.time.now()
+    # payment methods are created concurrently, their position keeps the order of store wallets
+    await asyncio.gather(
+        *(
+            create_payment_method_safe(
+                semaphore,
+                invoice,
+                wallet_objects[wallet_id],
+                product,
+                store,
+                discounts,
+                promocode,
+                created,
+                index,
+            )
+            for index, wallet_id in enumerate(wallets)
+            if wallet_id in wallet_objects
+        )
+    )
     await invoice.load_data()  # add payment methods with correct names and other related objects
     logger.info(f"Successfully added {len(invoice.payments)} payment methods to invoice {invoice.id}")
     await events.event_handler.publish("expired_task", {"id": invoice.id})
@@ -156,7 +184,7 @@ async def batch_invoice_action(query, settings: schemes.BatchSettings, user: sch
                 .where(models.PaymentMethod.invoice_id == models.Invoice.id)
                 .where(models.Invoice.id == invoice_id)
                 .where(models.Invoice.user_id == user.id)
-                .order_by(models.PaymentMethod.created)
+                .order_by(models.PaymentMethod.position, models.PaymentMethod.lightning, models.PaymentMethod.created)
                 .gino.load((models.Invoice, models.PaymentMethod))
                 .first()
             )
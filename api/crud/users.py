@@ -21,3 +21,20 @@ async def create_user(user: schemes.CreateUser, auth_user: schemes.User):
     d = user.dict()
     d["is_superuser"] = is_superuser
     return await utils.database.create_object(models.User, d)
+
+
+async def patch_user(item: models.User, model, user: schemes.User):
+    await utils.database.modify_object(item, model.dict(exclude_unset=True))
+    await utils.authorization.invalidate_user_tokens(item.id)
+
+
+async def delete_user(item: models.User, user: schemes.User):
+    await utils.authorization.invalidate_user_tokens(item.id)  # before tokens are detached from the user
+    await item.delete()
+
+
+async def batch_user_action(query, settings: schemes.BatchSettings, user: schemes.User):
+    for user_id in settings.ids:
+        await utils.authorization.invalidate_user_tokens(user_id)
+    await query.gino.status()
+    return True
@@ -55,6 +55,8 @@ async def process_message(message, custom_event_handler=None):
 
 async def send_message(message):
     await utils.redis.publish_message(constants.EVENTS_CHANNEL, message)
+    # pub/sub messages are lost if nobody listens, e.g. while the leader worker is being replaced
+    await utils.redis.queue_message(constants.EVENTS_QUEUE, message, constants.EVENTS_QUEUE_SIZE)
 
 
 async def listen(channel, custom_event_handler=None):  # pragma: no cover
@@ -67,6 +69,12 @@ async def start_listening(custom_event_handler=None):  # pragma: no cover
     await listen(channel, custom_event_handler)
 
 
+async def listen_queue(custom_event_handler=None):  # pragma: no cover
+    # each event is processed by one worker, events sent while there was no leader are processed after takeover
+    async for message in utils.redis.listen_queue(constants.EVENTS_QUEUE):
+        asyncio.ensure_future(process_message(message, custom_event_handler))
+
+
 event_handler = EventHandler(
     events={
         "expired_task": {
@@ -85,5 +93,9 @@ event_handler = EventHandler(
             "params": {"id", "status"},
             "handlers": [],
         },
+        "invalidate_auth": {
+            "params": {"tokens"},
+            "handlers": [],
+        },
     }
 )
@@ -8,3 +8,7 @@ class TemplateDoesNotExistError(BitcartError):
 
 class TemplateLoadError(BitcartError):
     """Failed to load template file from disk"""
+
+
+class PermanentDeliveryError(BitcartError):
+    """Email or notification delivery failed in a way retrying won't fix"""
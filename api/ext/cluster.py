@@ -0,0 +1,101 @@
+import asyncio
+import traceback
+
+from api import settings, utils
+from api.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+# Work which must run in exactly one worker process, i.e. singleton tasks or the daemon websocket of a currency
+# start and stop are called when this worker gains or loses the lease
+class Partition:
+    def __init__(self, name, start, stop):
+        self.name = name
+        self.start = start
+        self.stop = stop
+        self.lease = None
+        self.owned = False
+        self.starting = None
+
+
+# Leases are renewed in their own loop, while partitions are started and stopped in background tasks,
+# so that a slow start (i.e. network requests on startup) never delays renewal past the lease ttl
+class ClusterManager:
+    def __init__(self):
+        self.worker_id = utils.common.unique_id()
+        self.partitions = {}
+        self.task = None
+
+    @property
+    def owned_partitions(self):
+        return [name for name, partition in self.partitions.items() if partition.owned]
+
+    def add_partition(self, name, start, stop):
+        partition = Partition(name, start, stop)
+        partition.lease = utils.redis.Lease(f"worker:{name}", self.worker_id, settings.settings.worker_lease_ttl)
+        self.partitions[name] = partition
+
+    async def start(self):  # pragma: no cover
+        await self.check_partitions()
+        self.task = utils.tasks.create_task(self.run())
+
+    async def run(self):  # pragma: no cover
+        # renewing a few times per ttl, so that one missed renewal doesn't lose the lease
+        while True:
+            await asyncio.sleep(settings.settings.worker_lease_ttl / 3)
+            await self.check_partitions()
+
+    async def check_partitions(self):
+        await asyncio.gather(*(self.check_partition(partition) for partition in self.partitions.values()))
+
+    async def check_partition(self, partition):
+        try:
+            if partition.owned:
+                if not await partition.lease.renew():
+                    logger.warning(f"Worker {self.worker_id} lost partition {partition.name}")
+                    self.release_in_background(partition, release_lease=False)
+            elif await partition.lease.acquire():
+                logger.info(f"Worker {self.worker_id} acquired partition {partition.name}")
+                partition.owned = True
+                partition.starting = utils.tasks.create_task(self.start_partition(partition))
+        except Exception:
+            logger.error(f"Error checking partition {partition.name}:\n{traceback.format_exc()}")
+            if partition.owned:  # another worker will take over once the lease expires
+                self.release_in_background(partition)
+
+    async def start_partition(self, partition):
+        try:
+            await partition.start()
+        except Exception:
+            logger.error(f"Error starting partition {partition.name}:\n{traceback.format_exc()}")
+            partition.starting = None
+            await self.release(partition)
+
+    def release_in_background(self, partition, release_lease=True):
+        partition.owned = False
+        utils.tasks.create_task(self.release(partition, release_lease=release_lease))
+
+    async def release(self, partition, release_lease=True):
+        partition.owned = False
+        if partition.starting is not None:  # lost before startup finished
+            partition.starting.cancel()
+            partition.starting = None
+        try:
+            await partition.stop()
+        except Exception:
+            logger.error(f"Error stopping partition {partition.name}:\n{traceback.format_exc()}")
+        if release_lease:
+            try:
+                await partition.lease.release()
+            except Exception:
+                logger.error(f"Error releasing partition {partition.name}:\n{traceback.format_exc()}")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await asyncio.gather(*(self.release(partition) for partition in self.partitions.values() if partition.owned))
+
+
+manager = ClusterManager()
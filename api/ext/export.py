@@ -1,8 +1,18 @@
 import csv
 import io
+import json
+import pickle
+import tempfile
 
+import asyncpg
+from fastapi.encoders import jsonable_encoder
+
+from api import utils
 from api.schemes import DisplayInvoice
 
+EXPORT_BATCH_SIZE = 500
+CSV_SPOOL_SIZE = 1024 * 1024
+
 
 def merge_keys(k1, k2):
     return f"{k1}_{k2}" if k1 is not None and k2 is not None else k1 if k1 is not None else k2
@@ -47,3 +57,74 @@ def json_to_csv(json_data):
     csv_output.writeheader()
     csv_output.writerows(rows)
     return result
+
+
+async def iterate_batches(batches):
+    for batch in batches:
+        yield batch
+
+
+async def iterate_invoices(query, batch_size=EXPORT_BATCH_SIZE):
+    # server-side cursor, related objects are loaded per batch, so memory usage doesn't depend on the export size
+    try:
+        async with utils.database.iterate_helper():
+            batch = []
+            async for invoice in query.gino.iterate():
+                batch.append(invoice)
+                if len(batch) >= batch_size:
+                    yield await utils.database.postprocess_func(batch)
+                    batch = []
+            if batch:
+                yield await utils.database.postprocess_func(batch)
+    except (asyncpg.exceptions.UndefinedColumnError, asyncpg.exceptions.DataError):
+        return
+
+
+def dump_invoice(invoice):
+    return json.dumps(jsonable_encoder(invoice))
+
+
+async def stream_json(batches, add_payments=False):
+    separator = ""
+    yield "["
+    async for batch in batches:
+        for invoice in db_to_json(batch, add_payments):
+            yield separator + dump_invoice(invoice)
+            separator = ","
+    yield "]"
+
+
+async def stream_ndjson(batches, add_payments=False):
+    async for batch in batches:
+        yield "".join(f"{dump_invoice(invoice)}\n" for invoice in db_to_json(batch, add_payments))
+
+
+def iterate_spooled_rows(spool):
+    spool.seek(0)
+    while True:
+        try:
+            yield pickle.load(spool)
+        except EOFError:
+            return
+
+
+async def stream_csv(batches, add_payments=False):
+    # the header depends on all rows (products_0, payments_0_amount, ...), so rows are flattened in the first pass and
+    # spooled to a temporary file, which is moved to disk once it grows, then written out after the header
+    fieldnames = set()
+    with tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_SIZE) as spool:
+        async for batch in batches:
+            for invoice in db_to_json(batch, add_payments):
+                row = get_leaves(invoice)
+                fieldnames.update(row.keys())
+                pickle.dump(row, spool)
+        result = io.StringIO()
+        csv_output = csv.DictWriter(result, fieldnames=sorted(fieldnames))
+        csv_output.writeheader()
+        for row in iterate_spooled_rows(spool):
+            csv_output.writerow(row)
+            if result.tell() >= CSV_SPOOL_SIZE:
+                yield result.getvalue()
+                result.seek(0)
+                result.truncate()
+        yield result.getvalue()
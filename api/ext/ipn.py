@@ -0,0 +1,180 @@
+import asyncio
+import time
+import traceback
+from datetime import timedelta
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from api import models, settings, utils
+from api.logger import get_exception_message, get_logger
+
+logger = get_logger(__name__)
+
+QUEUE_KEY = "ipn:queue"  # delivery ids ready to be sent
+PROCESSING_KEY = "ipn:processing"  # delivery ids taken by workers, to recover them after a crash
+RETRY_KEY = "ipn:retry"  # delivery id -> timestamp of the next attempt
+WAITING_KEY = "ipn:waiting:{}"  # delivery ids waiting for earlier deliveries of the invoice to finish
+MAX_RETRY_DELAY = 60 * 60
+RETRY_POLL_INTERVAL = 1
+REQUEUE_GRACE_PERIOD = 60  # deliveries created just now may be not pushed to the queue yet
+
+
+class DeliveryStatus:
+    PENDING = "pending"
+    SUCCESS = "success"
+    FAILED = "failed"
+
+
+def get_retry_delay(attempts):
+    return min(MAX_RETRY_DELAY, settings.settings.ipn_retry_delay * 2 ** (attempts - 1))
+
+
+async def enqueue(obj, status):
+    data = {"id": obj.id, "status": status}
+    delivery = await models.IPNDelivery.create(
+        id=utils.common.unique_id(),
+        invoice_id=obj.id,
+        url=obj.notification_url,
+        data=data,
+        status=DeliveryStatus.PENDING,
+        attempts=0,
+        created=utils.time.now(),
+    )
+    async with utils.redis.wait_for_redis():
+        await settings.settings.redis_pool.lpush(QUEUE_KEY, delivery.id)
+    return delivery
+
+
+class IPNDeliveryManager:
+    def __init__(self):
+        self.session = None
+        self.tasks = []
+
+    async def start(self):  # pragma: no cover
+        self.session = ClientSession(
+            connector=TCPConnector(limit_per_host=settings.settings.ipn_connections_per_host),
+            timeout=ClientTimeout(total=settings.settings.ipn_timeout),
+        )
+        async with utils.redis.wait_for_redis():
+            # deliveries are processed only by the worker holding the leader lease, so anything left in processing
+            # was interrupted by a restart or by the previous leader losing its lease
+            while await settings.settings.redis_pool.rpoplpush(PROCESSING_KEY, QUEUE_KEY):
+                pass
+            async for key in settings.settings.redis_pool.scan_iter(match=WAITING_KEY.format("*")):
+                await self.release_waiting(key[len(WAITING_KEY.format("")) :])
+            await self.requeue_pending()
+        self.tasks = [utils.tasks.create_task(self.worker()) for _ in range(settings.settings.ipn_workers)]
+        self.tasks.append(utils.tasks.create_task(self.schedule_retries()))
+
+    async def stop(self):  # pragma: no cover
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def worker(self):  # pragma: no cover
+        redis = settings.settings.redis_pool
+        while True:
+            delivery_id = await redis.brpoplpush(QUEUE_KEY, PROCESSING_KEY, timeout=0)
+            try:
+                await self.process(delivery_id)
+            except Exception:
+                logger.error(f"Failed to process IPN delivery {delivery_id}:\n{traceback.format_exc()}")
+            # not in finally: on cancellation the delivery stays in processing and is queued again on the next start
+            await redis.lrem(PROCESSING_KEY, 1, delivery_id)
+
+    async def requeue_pending(self):
+        # pending deliveries are stored in the database, so they are recovered even if redis data was lost
+        redis = settings.settings.redis_pool
+        known = set(await redis.lrange(QUEUE_KEY, 0, -1)) | set(await redis.zrange(RETRY_KEY, 0, -1))
+        async for key in redis.scan_iter(match=WAITING_KEY.format("*")):
+            known.update(await redis.lrange(key, 0, -1))
+        deliveries = (
+            await models.IPNDelivery.select("id", "attempts", "updated")
+            .where(models.IPNDelivery.status == DeliveryStatus.PENDING)
+            .where(models.IPNDelivery.created <= utils.time.now() - timedelta(seconds=REQUEUE_GRACE_PERIOD))
+            .order_by(models.IPNDelivery.created)
+            .gino.all()
+        )
+        # new deliveries are due immediately, failed ones keep their retry delay
+        missing = {
+            delivery_id: updated.timestamp() + get_retry_delay(attempts) if attempts else 0
+            for delivery_id, attempts, updated in deliveries
+            if delivery_id not in known
+        }
+        if missing:
+            logger.info(f"Requeued {len(missing)} pending IPN deliveries")
+            await redis.zadd(RETRY_KEY, missing)
+        return list(missing)
+
+    async def schedule_retries(self):  # pragma: no cover
+        redis = settings.settings.redis_pool
+        while True:
+            due = await redis.zrangebyscore(RETRY_KEY, 0, time.time())
+            if due:
+                async with redis.pipeline(transaction=True) as pipe:
+                    await pipe.zrem(RETRY_KEY, *due).lpush(QUEUE_KEY, *due).execute()
+            await asyncio.sleep(RETRY_POLL_INTERVAL)
+
+    async def send(self, delivery):
+        try:
+            async with self.session.post(delivery.url, json=delivery.data) as response:
+                if response.ok:
+                    return response.status, None
+                return response.status, f"Unexpected response status {response.status}"
+        except Exception as e:
+            return None, get_exception_message(e) or e.__class__.__name__
+
+    async def has_earlier_pending(self, delivery):
+        return (
+            await models.IPNDelivery.select("id")
+            .where(models.IPNDelivery.invoice_id == delivery.invoice_id)
+            .where(models.IPNDelivery.status == DeliveryStatus.PENDING)
+            .where(models.IPNDelivery.created < delivery.created)
+            .limit(1)
+            .gino.scalar()
+        ) is not None
+
+    async def wait_for_earlier(self, delivery):
+        await settings.settings.redis_pool.lpush(WAITING_KEY.format(delivery.invoice_id), delivery.id)
+        if not await self.has_earlier_pending(delivery):  # finished while this one was being added
+            await self.release_waiting(delivery.invoice_id)
+
+    async def release_waiting(self, invoice_id):
+        # waiting deliveries are sent in their original order, later ones wait again if needed
+        while await settings.settings.redis_pool.rpoplpush(WAITING_KEY.format(invoice_id), QUEUE_KEY):
+            pass
+
+    async def process(self, delivery_id):
+        delivery = await models.IPNDelivery.get(delivery_id)
+        if not delivery or delivery.status != DeliveryStatus.PENDING:
+            return
+        # deliveries of one invoice are sent in order, so that merchants never get complete before paid
+        if await self.has_earlier_pending(delivery):
+            await self.wait_for_earlier(delivery)
+            return
+        attempts = delivery.attempts + 1
+        base_log_message = f"Sending IPN with data {delivery.data} to {delivery.url} (attempt {attempts})"
+        response_status, error = await self.send(delivery)
+        if error is None:
+            status = DeliveryStatus.SUCCESS
+            logger.info(f"{base_log_message}: success")
+        elif attempts >= settings.settings.ipn_max_attempts:
+            status = DeliveryStatus.FAILED
+            logger.info(f"{base_log_message}: error, giving up\n{error}")
+        else:
+            status = DeliveryStatus.PENDING
+            logger.info(f"{base_log_message}: error, retrying in {get_retry_delay(attempts)} seconds\n{error}")
+        await delivery.update(
+            status=status, attempts=attempts, response_status=response_status, error=error, updated=utils.time.now()
+        ).apply()
+        if status == DeliveryStatus.PENDING:
+            await settings.settings.redis_pool.zadd(RETRY_KEY, {delivery.id: time.time() + get_retry_delay(attempts)})
+        else:
+            await self.release_waiting(delivery.invoice_id)
+        return delivery
+
+
+manager = IPNDeliveryManager()
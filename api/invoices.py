@@ -1,10 +1,11 @@
 import asyncio
+from collections import defaultdict
 
-from sqlalchemy import or_, select
+from sqlalchemy import case, func, or_, select
 
 from api import constants, events, models, settings, utils
 from api.ext.moneyformat import currency_table
-from api.logger import get_logger
+from api.logger import get_exception_message, get_logger
 from api.utils.logging import log_errors
 
 logger = get_logger(__name__)
@@ -40,6 +41,21 @@ STATUS_MAPPING = {
     "Unconfirmed": InvoiceStatus.UNCONFIRMED,
 }
 
+# new status -> statuses it can be changed from
+STATUS_TRANSITIONS = {
+    InvoiceStatus.PAID: [InvoiceStatus.PENDING, InvoiceStatus.EXPIRED, InvoiceStatus.INVALID],
+    InvoiceStatus.CONFIRMED: [InvoiceStatus.PENDING, InvoiceStatus.PAID, InvoiceStatus.EXPIRED, InvoiceStatus.INVALID],
+    InvoiceStatus.COMPLETE: [
+        InvoiceStatus.PENDING,
+        InvoiceStatus.PAID,
+        InvoiceStatus.CONFIRMED,
+        InvoiceStatus.EXPIRED,
+        InvoiceStatus.INVALID,
+    ],
+    InvoiceStatus.EXPIRED: [InvoiceStatus.PENDING],
+    InvoiceStatus.INVALID: [InvoiceStatus.PENDING, InvoiceStatus.PAID, InvoiceStatus.CONFIRMED, InvoiceStatus.EXPIRED],
+}
+
 DEFAULT_PENDING_STATUSES = [InvoiceStatus.PENDING, InvoiceStatus.PAID]
 PAID_STATUSES = [InvoiceStatus.PAID, InvoiceStatus.CONFIRMED, InvoiceStatus.COMPLETE]
 FAILED_STATUSES = [InvoiceStatus.EXPIRED, InvoiceStatus.INVALID]
@@ -81,30 +97,96 @@ def get_pending_invoices_query(currency, statuses=None):
     )
 
 
-async def iterate_pending_invoices(currency, statuses=None):
+async def iterate_pending_invoices(currency, statuses=None, load_data=True):
     with log_errors():  # connection issues
         async with utils.database.iterate_helper():
             async for method, invoice, xpub in get_pending_invoices_query(currency, statuses=statuses).gino.load(
                 (models.PaymentMethod, models.Invoice, models.Wallet.xpub)
             ).iterate():
-                await invoice.load_data()
+                if load_data:
+                    await invoice.load_data()
                 yield method, invoice, xpub
 
 
-async def make_expired_task(invoice):
-    invoice.add_invoice_expiration()  # to ensure it is the most recent one
-    left = invoice.time_left + 1  # to ensure it's already expired at that moment
-    if left > 0:
-        await asyncio.sleep(left)
-    try:
-        invoice = await utils.database.get_object(models.Invoice, invoice.id)  # refresh data to get new status
-    except Exception:
-        return  # invoice deleted meantime
-    if invoice.status == InvoiceStatus.PENDING:  # to ensure there are no duplicate notifications
-        await update_status(invoice, InvoiceStatus.EXPIRED)
+async def expire_invoices():
+    # one statement per batch, rows locked by another worker are skipped and picked up on its side
+    expired = []
+    while True:
+        pending = (
+            select([models.Invoice.id])
+            .where(models.Invoice.status == InvoiceStatus.PENDING)
+            .where(models.Invoice.expires_at <= utils.time.now())
+            .limit(constants.EXPIRATION_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+        ids = [
+            invoice_id
+            for invoice_id, in await models.Invoice.update.values(status=InvoiceStatus.EXPIRED)
+            .where(models.Invoice.id.in_(pending))
+            .where(models.Invoice.status == InvoiceStatus.PENDING)
+            .returning(models.Invoice.id)
+            .gino.all()
+        ]
+        if ids:
+            logger.info(f"Expired {len(ids)} invoices")
+            invoices = await utils.database.get_objects(models.Invoice, ids)
+            results = await asyncio.gather(
+                *(status_changed(invoice, InvoiceStatus.EXPIRED) for invoice in invoices), return_exceptions=True
+            )
+            log_gather_errors(results)
+            expired.extend(invoices)
+        if len(ids) < constants.EXPIRATION_BATCH_SIZE:
+            return expired
+
+
+async def get_next_expiration():
+    return (
+        await select([func.min(models.Invoice.expires_at)]).where(models.Invoice.status == InvoiceStatus.PENDING).gino.scalar()
+    )
+
+
+class ExpirationScheduler:
+    # Sleeps until the nearest expiration instead of keeping one task per pending invoice
+    # New invoices wake it up to recalculate the nearest expiration
+    MAX_SLEEP = 60
+
+    def __init__(self):
+        self.event = None
+        self.task = None
+
+    def wakeup(self):
+        if self.event is not None:
+            self.event.set()
+
+    async def start(self):  # pragma: no cover
+        self.event = asyncio.Event()
+        self.task = utils.tasks.create_task(self.run())
+
+    async def stop(self):  # pragma: no cover
+        if self.task is not None:
+            self.task.cancel()
+        self.event = self.task = None
 
+    async def run(self):  # pragma: no cover
+        while True:
+            self.event.clear()
+            with log_errors():
+                await expire_invoices()
+            timeout = self.MAX_SLEEP
+            with log_errors():
+                next_expiration = await get_next_expiration()
+                if next_expiration is not None:
+                    timeout = min(self.MAX_SLEEP, max(0, (next_expiration - utils.time.now()).total_seconds()))
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-async def process_electrum_status(invoice, method, xpub, electrum_status):
+
+expiration_scheduler = ExpirationScheduler()
+
+
+async def process_electrum_status(invoice, method, xpub, electrum_status, confirmations=None):
     electrum_status = convert_status(electrum_status)
     if invoice.status not in DEFAULT_PENDING_STATUSES:  # double-check
         return
@@ -115,7 +197,9 @@ async def process_electrum_status(invoice, method, xpub, electrum_status):
         if method.lightning:
             await update_status(invoice, InvoiceStatus.COMPLETE, method)
         else:
-            await update_confirmations(invoice, method, await get_confirmations(method, xpub))
+            if confirmations is None:
+                confirmations = await get_confirmations(method, xpub)
+            await update_confirmations(invoice, method, min(constants.MAX_CONFIRMATION_WATCH, confirmations))
     return True
 
 
@@ -151,58 +235,91 @@ async def get_confirmations(method, xpub):
     )  # don't store arbitrary number of confirmations
 
 
-async def new_block_handler(instance, event, height):
+def log_gather_errors(results):
+    for result in results:
+        if isinstance(result, Exception):  # issues processing one wallet
+            logger.error(get_exception_message(result))
+
+
+def confirmations_from_height(height, tx_height):
+    if not tx_height:  # unconfirmed or not yet mined
+        return 0
+    # don't store arbitrary number of confirmations
+    return min(constants.MAX_CONFIRMATION_WATCH, max(0, height - tx_height + 1))
+
+
+async def refresh_confirmations(invoice, method, confirmations):
+    await invoice.load_data()
+    await update_confirmations(invoice, method, confirmations)
+
+
+async def process_wallet_confirmations(currency, xpub, contract, items, height):
+    coin = settings.settings.get_coin(currency, {"xpub": xpub, "contract": contract})
+    tx_heights = await coin.server.get_request_heights([method.lookup_field for method, _ in items])
     coros = []
-    async for method, invoice, xpub in iterate_pending_invoices(
-        instance.coin_name.lower(), statuses=[InvoiceStatus.CONFIRMED]
-    ):
-        with log_errors():  # issues processing one item
-            if invoice.status != InvoiceStatus.CONFIRMED or method.get_name() != invoice.paid_currency or method.lightning:
-                continue
-            await invoice.load_data()
-            confirmations = await get_confirmations(method, xpub)
-            if confirmations != method.confirmations:
-                coros.append(update_confirmations(invoice, method, confirmations))
+    for method, invoice in items:
+        if method.lookup_field not in tx_heights:  # request removed from the wallet
+            continue
+        confirmations = confirmations_from_height(height, tx_heights[method.lookup_field])
+        if confirmations != method.confirmations:
+            coros.append(refresh_confirmations(invoice, method, confirmations))
     # NOTE: if another operation in progress exception occurs, make it await one by one
     await asyncio.gather(*coros)
 
 
+async def new_block_handler(instance, event, height):
+    currency = instance.coin_name.lower()
+    wallets = defaultdict(list)
+    async for method, invoice, xpub in iterate_pending_invoices(currency, statuses=[InvoiceStatus.CONFIRMED], load_data=False):
+        if invoice.status != InvoiceStatus.CONFIRMED or method.get_name() != invoice.paid_currency or method.lightning:
+            continue
+        wallets[(xpub, method.contract)].append((method, invoice))
+    # one daemon call per wallet, confirmations are calculated from the new block height
+    results = await asyncio.gather(
+        *(
+            process_wallet_confirmations(currency, xpub, contract, items, height)
+            for (xpub, contract), items in wallets.items()
+        ),
+        return_exceptions=True,
+    )
+    log_gather_errors(results)
+
+
 async def invoice_notification(invoice: models.Invoice, status: str):
     await utils.notifications.send_ipn(invoice, status)
     if status == InvoiceStatus.COMPLETE:
         logger.info(f"Invoice {invoice.id} complete, sending notifications...")
         store = await utils.database.get_object(models.Store, invoice.store_id)
-        await utils.notifications.notify(store, await utils.templates.get_notify_template(store, invoice))
+        with log_errors():  # invalid notification settings must not prevent emails
+            await utils.notifications.notify(store, await utils.templates.get_notify_template(store, invoice))
+        # no ping before sending: the pooled connection is checked by sending itself
         if invoice.products:
-            if utils.email.check_ping(
-                store.email_host,
-                store.email_port,
-                store.email_user,
-                store.email_password,
-                store.email,
-                store.email_use_ssl,
-            ):
-                messages = []
+            if utils.email.is_configured(utils.email.get_store_email_config(store)):
                 products = await utils.database.get_objects(models.Product, invoice.products)
+                quantities = dict(
+                    await models.ProductxInvoice.select("product_id", "count")
+                    .where(models.ProductxInvoice.invoice_id == invoice.id)
+                    .gino.all()
+                )
                 for product in products:
                     product.price = currency_table.normalize(
                         invoice.currency, product.price
                     )  # to be formatted correctly in emails
-                    relation = (
-                        await models.ProductxInvoice.query.where(models.ProductxInvoice.invoice_id == invoice.id)
-                        .where(models.ProductxInvoice.product_id == product.id)
-                        .gino.first()
+                with utils.loaders.loaders_context():  # products sharing a template look it up once
+                    messages = await asyncio.gather(
+                        *(
+                            utils.templates.get_product_template(store, product, quantities.get(product.id))
+                            for product in products
+                        )
                     )
-                    quantity = relation.count
-                    product_template = await utils.templates.get_product_template(store, product, quantity)
-                    messages.append(product_template)
+                for product, product_template in zip(products, messages):
                     logger.debug(
                         f"Invoice {invoice.id} email notification: rendered product template for product {product.id}:\n"
                         f"{product_template}"
                     )
                 store_template = await utils.templates.get_store_template(store, messages)
                 logger.debug(f"Invoice {invoice.id} email notification: rendered final template:\n{store_template}")
-                utils.email.send_mail(
+                await utils.email.send_mail(
                     store,
                     invoice.buyer_email,
                     store_template,
@@ -210,39 +327,67 @@ async def invoice_notification(invoice: models.Invoice, status: str):
 
 
 async def update_status(invoice, status, method=None):
-    if invoice.status != status and status != InvoiceStatus.PENDING and invoice.status != InvoiceStatus.COMPLETE:
-        log_text = f"Updating status of invoice {invoice.id}"
-        if method:
-            full_method_name = method.get_name()
-            if not invoice.paid_currency and status in [InvoiceStatus.PAID, InvoiceStatus.CONFIRMED, InvoiceStatus.COMPLETE]:
-                await invoice.update(paid_currency=full_method_name, discount=method.discount).apply()
-            log_text += f" with payment method {full_method_name}"
-        logger.info(f"{log_text} to {status}")
-        await invoice.update(status=status).apply()
-        await events.event_handler.publish("invoice_status", {"id": invoice.id, "status": status})
-        await utils.redis.publish_message(f"invoice:{invoice.id}", {"status": status})
-        await invoice_notification(invoice, status)
-        return True
-
-
-async def create_expired_tasks():
-    with log_errors():
-        async with utils.database.iterate_helper():
-            async for invoice in models.Invoice.query.where(models.Invoice.status == InvoiceStatus.PENDING).gino.iterate():
-                with log_errors():
-                    asyncio.ensure_future(make_expired_task(invoice))
+    # the status is changed only if the current one in the database allows it, so concurrent handlers
+    # processing the same event change it once and only that one sends notifications
+    allowed_from = STATUS_TRANSITIONS.get(status)
+    if not allowed_from:
+        return
+    values = {"status": status}
+    log_text = f"Updating status of invoice {invoice.id}"
+    if method:
+        full_method_name = method.get_name()
+        if status in PAID_STATUSES:  # the first paid method is kept
+            first_payment = or_(models.Invoice.paid_currency.is_(None), models.Invoice.paid_currency == "")
+            values["paid_currency"] = case([(first_payment, full_method_name)], else_=models.Invoice.paid_currency)
+            values["discount"] = case([(first_payment, method.discount)], else_=models.Invoice.discount)
+        log_text += f" with payment method {full_method_name}"
+    result = (
+        await models.Invoice.update.values(**values)
+        .where(models.Invoice.id == invoice.id)
+        .where(models.Invoice.status.in_(allowed_from))
+        .returning(models.Invoice.paid_currency, models.Invoice.discount)
+        .gino.first()
+    )
+    if result is None:  # already changed by another handler or not allowed
+        return
+    invoice.status = status
+    invoice.paid_currency, invoice.discount = result
+    logger.info(f"{log_text} to {status}")
+    await status_changed(invoice, status)
+    return True
 
 
-async def check_pending(currency):
+async def status_changed(invoice, status):
+    await events.event_handler.publish("invoice_status", {"id": invoice.id, "status": status})
+    await utils.redis.publish_message(f"invoice:{invoice.id}", {"status": status})
+    await invoice_notification(invoice, status)
+
+
+async def process_wallet_pending(currency, xpub, contract, lightning, items):
+    coin = settings.settings.get_coin(currency, {"xpub": xpub, "contract": contract})
+    keys = [method.lookup_field for method, _ in items]
+    requests = await (coin.server.get_invoices(keys) if lightning else coin.server.get_requests(keys))
     coros = []
-    async for method, invoice, xpub in iterate_pending_invoices(currency):
-        with log_errors():  # issues processing one item
-            if invoice.status == InvoiceStatus.EXPIRED:
-                continue
-            coin = settings.settings.get_coin(method.currency, {"xpub": xpub, "contract": method.contract})
-            if method.lightning:
-                invoice_data = await coin.get_invoice(method.lookup_field)
-            else:
-                invoice_data = await coin.get_request(method.lookup_field)
-            coros.append(process_electrum_status(invoice, method, xpub, invoice_data["status"]))
+    for method, invoice in items:
+        if method.lookup_field not in requests:  # request removed from the wallet
+            continue
+        invoice_data = requests[method.lookup_field]
+        coros.append(process_electrum_status(invoice, method, xpub, invoice_data["status"], invoice_data.get("confirmations")))
     await asyncio.gather(*coros)
+
+
+async def check_pending(currency):
+    wallets = defaultdict(list)
+    async for method, invoice, xpub in iterate_pending_invoices(currency):
+        if invoice.status == InvoiceStatus.EXPIRED:
+            continue
+        wallets[(xpub, method.contract, method.lightning)].append((method, invoice))
+    # one daemon call per wallet instead of one per invoice
+    results = await asyncio.gather(
+        *(
+            process_wallet_pending(currency, xpub, contract, lightning, items)
+            for (xpub, contract, lightning), items in wallets.items()
+        ),
+        return_exceptions=True,
+    )
+    log_gather_errors(results)
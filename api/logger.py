@@ -9,7 +9,6 @@ import msgpack
 from pydantic import BaseModel
 
 from api import settings
-from api.constants import LOGSERVER_PORT
 
 
 def get_exception_message(exc: Exception):
@@ -50,7 +49,7 @@ class MsgpackHandler(logging.handlers.SocketHandler):
 
 
 def configure_logserver():
-    socket_handler = MsgpackHandler(settings.settings.logserver_host, LOGSERVER_PORT)
+    socket_handler = MsgpackHandler(settings.settings.logserver_host, settings.settings.logserver_port)
     socket_handler.setLevel(logging.DEBUG)
     logger_client.addHandler(socket_handler)
     bitcart_logger.addHandler(socket_handler)
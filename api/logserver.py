@@ -66,6 +66,14 @@ class LogRecordSocketReceiver(socketserver.ThreadingTCPServer):
             abort = self.abort
 
 
+def is_port_open(host="localhost", port=LOGSERVER_PORT):
+    try:
+        with socket.create_connection((host, port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
 def wait_for_port(host="localhost", port=LOGSERVER_PORT, timeout=5.0):
     start_time = time.perf_counter()
     while True:
@@ -85,7 +93,7 @@ def main():
     try:
         token = settings_module.settings_ctx.set(settings)
         configure_file_logging()
-        tcpserver = LogRecordSocketReceiver(host=settings.logserver_host)
+        tcpserver = LogRecordSocketReceiver(host=settings.logserver_host, port=settings.logserver_port)
         tcpserver.serve_until_stopped()
     finally:
         settings_module.settings_ctx.reset(token)
@@ -1,12 +1,15 @@
+import asyncio
 import inspect
 import secrets
 import sys
+from collections import defaultdict
 from datetime import timedelta
 
 from bitcart.errors import BaseError as BitcartBaseError
 from fastapi import HTTPException
 from fastapi.encoders import jsonable_encoder
 from gino.crud import UpdateRequest
+from sqlalchemy import literal_column, text
 from sqlalchemy.dialects.postgresql import ARRAY
 
 from api import schemes, settings
@@ -35,12 +38,27 @@ async def create_relations(model_id, related_ids, key_info):
     await key_info["table"].insert().gino.all(data)
 
 
+async def fetch_relations(model_ids, key_info):
+    table = key_info["table"]
+    result = (
+        await table.select(key_info["current_id"], key_info["related_id"])
+        .where(getattr(table, key_info["current_id"]).in_(model_ids))
+        .gino.all()
+    )
+    relations = defaultdict(list)
+    for model_id, obj_id in result:
+        if obj_id:
+            relations[model_id].append(obj_id)
+    return relations
+
+
 async def delete_relations(model_id, key_info):
     await key_info["table"].delete.where(getattr(key_info["table"], key_info["current_id"]) == model_id).gino.status()
 
 
 class BaseModel(db.Model):
     JSON_KEYS: dict = {}
+    SEARCH_COLUMNS: tuple = ()  # columns covered by the trigram search index, except timestamps and secrets
 
     @property
     def M2M_KEYS(self):
@@ -48,6 +66,13 @@ class BaseModel(db.Model):
         update_variant = getattr(self._update_request_cls, "KEYS", {})
         return model_variant or update_variant
 
+    @classmethod
+    def get_search_expression(cls):
+        # NOTE: must match the indexed expression in migrations, otherwise the search index won't be used
+        # columns are separated by newlines, so that newline-sensitive regex anchors match per column
+        columns = " || E'\\n' || ".join(f"coalesce({cls.__tablename__}.{column}::text, '')" for column in cls.SEARCH_COLUMNS)
+        return literal_column(f"({columns})")
+
     async def create_related(self):
         for key in self.M2M_KEYS:
             related_ids = getattr(self, key, [])
@@ -64,6 +89,14 @@ class BaseModel(db.Model):
             )
             setattr(self, key, [obj_id for obj_id, in result if obj_id])
 
+    @classmethod
+    async def add_related_batch(cls, items):
+        # same as add_related, but with one query per relation for the whole list
+        for key, key_info in items[0].M2M_KEYS.items():
+            relations = await fetch_relations([item.id for item in items], key_info)
+            for item in items:
+                setattr(item, key, relations[item.id])
+
     async def delete_related(self):
         for key_info in self.M2M_KEYS.values():
             await delete_relations(self.id, key_info)
@@ -76,6 +109,14 @@ class BaseModel(db.Model):
         await self.add_related()
         await self.add_fields()
 
+    @classmethod
+    async def load_data_batch(cls, items):
+        if not items:
+            return
+        await cls.add_related_batch(items)
+        # run concurrently so that data loaders can batch lookups of the whole list
+        await asyncio.gather(*(item.add_fields() for item in items))
+
     async def _delete(self, *args, **kwargs):
         await self.delete_related()
         return await super()._delete(*args, **kwargs)
@@ -171,6 +212,7 @@ class ManyToManyUpdateRequest(UpdateRequest):
 
 class User(BaseModel):
     __tablename__ = "users"
+    SEARCH_COLUMNS = ("id", "email", "is_superuser", "settings")
 
     JSON_KEYS = {"settings": schemes.UserPreferences}
 
@@ -195,6 +237,7 @@ class User(BaseModel):
 
 class Wallet(BaseModel):
     __tablename__ = "wallets"
+    SEARCH_COLUMNS = ("id", "name", "xpub", "currency", "user_id", "lightning_enabled", "label", "hint", "contract")
 
     id = Column(Text, primary_key=True, index=True)
     name = Column(Text, index=True)
@@ -211,7 +254,7 @@ class Wallet(BaseModel):
         await super().add_fields()
         from api import utils
 
-        success, self.divisibility, self.balance = await utils.wallets.get_confirmed_wallet_balance(self)
+        success, self.divisibility, self.balance = await utils.loaders.load_wallet_balance(self)
         self.error = not success
 
     @classmethod
@@ -220,6 +263,16 @@ class Wallet(BaseModel):
         kwargs.pop("divisibility", None)
         return kwargs
 
+    def prepare_edit(self, kwargs):
+        kwargs = super().prepare_edit(kwargs)
+        if kwargs.keys() & {"xpub", "contract", "currency"}:
+            settings.settings.evict_coin(self.currency, self.xpub, self.contract)
+        return kwargs
+
+    async def _delete(self, *args, **kwargs):
+        settings.settings.evict_coin(self.currency, self.xpub, self.contract)
+        return await super()._delete(*args, **kwargs)
+
     async def validate(self, kwargs):
         await super().validate(kwargs)
         if "xpub" in kwargs or "contract" in kwargs:
@@ -249,6 +302,7 @@ class Wallet(BaseModel):
 
 class Notification(BaseModel):
     __tablename__ = "notifications"
+    SEARCH_COLUMNS = ("id", "user_id", "name", "provider", "data")
 
     id = Column(Text, primary_key=True, index=True)
     user_id = Column(Text, ForeignKey(User.id, ondelete="SET NULL"))
@@ -265,20 +319,37 @@ class Notification(BaseModel):
 
 class Template(BaseModel):
     __tablename__ = "templates"
+    SEARCH_COLUMNS = ("id", "user_id", "name", "text")
 
     id = Column(Text, primary_key=True, index=True)
     user_id = Column(Text, ForeignKey(User.id, ondelete="SET NULL"))
     name = Column(Text, index=True)
     text = Column(Text())
     created = Column(DateTime(True), nullable=False)
+    updated = Column(DateTime(True))
     _unique_constaint = UniqueConstraint("user_id", "name")
 
+    def prepare_edit(self, kwargs):
+        from api import utils
+
+        kwargs = super().prepare_edit(kwargs)
+        kwargs["updated"] = utils.time.now()
+        utils.templates.drop_compiled_template(self.id)
+        return kwargs
+
+    async def _delete(self, *args, **kwargs):
+        from api import utils
+
+        utils.templates.drop_compiled_template(self.id)
+        return await super()._delete(*args, **kwargs)
+
 
 class WalletxStore(BaseModel):
     __tablename__ = "walletsxstores"
 
     wallet_id = Column(Text, ForeignKey("wallets.id", ondelete="SET NULL"))
     store_id = Column(Text, ForeignKey("stores.id", ondelete="SET NULL"))
+    _store_wallet_idx = db.Index("walletsxstores_store_id_wallet_id_idx", "store_id", "wallet_id")
 
 
 class NotificationxStore(BaseModel):
@@ -308,6 +379,21 @@ class StoreUpdateRequest(ManyToManyUpdateRequest):
 class Store(BaseModel):
     __tablename__ = "stores"
     _update_request_cls = StoreUpdateRequest
+    SEARCH_COLUMNS = (
+        "id",
+        "name",
+        "default_currency",
+        "email",
+        "email_host",
+        "email_port",
+        "email_use_ssl",
+        "email_user",
+        "checkout_settings",
+        "theme_settings",
+        "plugin_settings",
+        "templates",
+        "user_id",
+    )
 
     JSON_KEYS = {
         "checkout_settings": schemes.StoreCheckoutSettings,
@@ -344,6 +430,7 @@ class Store(BaseModel):
 
 class Discount(BaseModel):
     __tablename__ = "discounts"
+    SEARCH_COLUMNS = ("id", "user_id", "name", "percent", "description", "promocode", "currencies")
 
     id = Column(Text, primary_key=True, index=True)
     user_id = Column(Text, ForeignKey(User.id, ondelete="SET NULL"))
@@ -377,6 +464,20 @@ class ProductUpdateRequest(ManyToManyUpdateRequest):
 class Product(BaseModel):
     __tablename__ = "products"
     _update_request_cls = ProductUpdateRequest
+    SEARCH_COLUMNS = (
+        "id",
+        "name",
+        "price",
+        "quantity",
+        "download_url",
+        "category",
+        "description",
+        "image",
+        "store_id",
+        "status",
+        "templates",
+        "user_id",
+    )
 
     id = Column(Text, primary_key=True, index=True)
     name = Column(Text, index=True)
@@ -409,11 +510,8 @@ class Product(BaseModel):
         from api import utils
 
         # TODO: rework logic of deleting related objects, maybe we need cascade delete?
-        try:
-            store = await utils.database.get_object(Store, self.store_id)
-            self.currency = store.default_currency
-        except HTTPException:  # for products associated with deleted stores
-            self.currency = "USD"
+        store = await utils.loaders.load_store(self.store_id)
+        self.currency = store.default_currency if store else "USD"  # for products associated with deleted stores
 
 
 class ProductxInvoice(BaseModel):
@@ -447,13 +545,17 @@ class PaymentMethod(BaseModel):
     label = Column(Text)
     hint = Column(Text)
     created = Column(DateTime(True), nullable=False)
+    position = Column(Integer)  # index of the wallet in the store, lightning method shares it with on-chain one
+    _invoice_id_idx = db.Index("paymentmethods_invoice_id_idx", "invoice_id")
+    _lookup_field_idx = db.Index("paymentmethods_currency_lookup_field_idx", "currency", "lookup_field")
 
-    async def to_dict(self, index: int = None):
+    async def to_dict(self, index: int = None, invoice=None):
         from api import utils
 
         data = super().to_dict()
         invoice_id = data.pop("invoice_id")
-        invoice = await utils.database.get_object(Invoice, invoice_id, load_data=False)  # To avoid recursion
+        if invoice is None:
+            invoice = await utils.database.get_object(Invoice, invoice_id, load_data=False)  # To avoid recursion
         data["amount"] = currency_table.format_decimal(self.symbol, self.amount, divisibility=self.divisibility)
         data["rate"] = currency_table.format_decimal(invoice.currency, self.rate)
         data["rate_str"] = currency_table.format_currency(invoice.currency, self.rate)
@@ -486,6 +588,24 @@ class PaymentMethod(BaseModel):
 
 class Invoice(BaseModel):
     __tablename__ = "invoices"
+    SEARCH_COLUMNS = (
+        "id",
+        "price",
+        "currency",
+        "paid_currency",
+        "status",
+        "expiration",
+        "buyer_email",
+        "discount",
+        "promocode",
+        "shipping_address",
+        "notes",
+        "notification_url",
+        "redirect_url",
+        "store_id",
+        "order_id",
+        "user_id",
+    )
 
     KEYS = {
         "products": {
@@ -517,18 +637,40 @@ class Invoice(BaseModel):
     order_id = Column(Text)
     user_id = Column(Text, ForeignKey(User.id, ondelete="SET NULL"))
     created = Column(DateTime(True), nullable=False)
+    expires_at = Column(DateTime(True))
+    _expires_at_idx = db.Index("invoices_pending_expires_at_idx", "expires_at", postgresql_where=text("status = 'pending'"))
+    _pending_status_idx = db.Index(
+        "invoices_pending_status_idx", "status", postgresql_where=text("status IN ('pending', 'paid')")
+    )
 
-    async def add_related(self):
+    async def set_payments(self, payment_methods):
         from api import crud
 
         self.payments = []
-        payment_methods = (
-            await PaymentMethod.query.where(PaymentMethod.invoice_id == self.id).order_by(PaymentMethod.created).gino.all()
-        )
         for index, method in crud.invoices.get_methods_inds(payment_methods):
-            self.payments.append(await method.to_dict(index))
+            self.payments.append(await method.to_dict(index, invoice=self))
+
+    async def add_related(self):
+        await self.set_payments(
+            await PaymentMethod.query.where(PaymentMethod.invoice_id == self.id)
+            .order_by(PaymentMethod.position, PaymentMethod.lightning, PaymentMethod.created)
+            .gino.all()
+        )
         await super().add_related()
 
+    @classmethod
+    async def add_related_batch(cls, items):
+        payment_methods = defaultdict(list)
+        for method in (
+            await PaymentMethod.query.where(PaymentMethod.invoice_id.in_([item.id for item in items]))
+            .order_by(PaymentMethod.position, PaymentMethod.lightning, PaymentMethod.created)
+            .gino.all()
+        ):
+            payment_methods[method.invoice_id].append(method)
+        for item in items:
+            await item.set_payments(payment_methods[item.id])
+        await super().add_related_batch(items)
+
     async def create_related(self):
         # NOTE: we don't call super() here, as the ProductxInvoice creation is delegated to CRUD utils
         pass
@@ -545,8 +687,23 @@ class Invoice(BaseModel):
 
         kwargs = super().prepare_create(kwargs)
         kwargs["id"] = utils.common.unique_id(PUBLIC_ID_LENGTH)
+        kwargs["expires_at"] = cls.get_expires_at(kwargs.get("created"), kwargs.get("expiration"))
         return kwargs
 
+    def prepare_edit(self, kwargs):
+        kwargs = super().prepare_edit(kwargs)
+        if kwargs.keys() & {"created", "expiration"}:
+            kwargs["expires_at"] = self.get_expires_at(
+                kwargs.get("created", self.created), kwargs.get("expiration", self.expiration)
+            )
+        return kwargs
+
+    @staticmethod
+    def get_expires_at(created, expiration):
+        if created is None or expiration is None:
+            return None
+        return created + timedelta(minutes=expiration)
+
     def add_invoice_expiration(self):
         from api import utils
 
@@ -559,6 +716,21 @@ class Invoice(BaseModel):
         self.add_invoice_expiration()
 
 
+class IPNDelivery(BaseModel):
+    __tablename__ = "ipndeliveries"
+
+    id = Column(Text, primary_key=True, index=True)
+    invoice_id = Column(Text, ForeignKey("invoices.id", ondelete="SET NULL"), index=True)
+    url = Column(Text, nullable=False)
+    data = Column(JSON)
+    status = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    response_status = Column(Integer)
+    error = Column(Text)
+    created = Column(DateTime(True), nullable=False)
+    updated = Column(DateTime(True))
+
+
 class Setting(BaseModel):
     __tablename__ = "settings"
 
@@ -578,6 +750,7 @@ class Setting(BaseModel):
 
 class Token(BaseModel):
     __tablename__ = "tokens"
+    SEARCH_COLUMNS = ("id", "user_id", "app_id", "redirect_url")
 
     id = Column(Text, primary_key=True, index=True)
     user_id = Column(Text, ForeignKey(User.id, ondelete="SET NULL"), index=True)
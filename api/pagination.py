@@ -1,9 +1,11 @@
 import asyncio
+import base64
+import json
 from typing import Callable, Optional, Union
 
 import asyncpg
-from fastapi import Query
-from sqlalchemy import Text, and_, func, or_, text
+from fastapi import HTTPException, Query
+from sqlalchemy import Text, and_, cast, func, or_, text, tuple_
 from starlette.requests import Request
 
 from api import models, utils
@@ -25,6 +27,8 @@ class Pagination:
         multiple: bool = Query(default=False),
         sort: str = Query(default=""),
         desc: bool = Query(default=True),
+        cursor: Optional[str] = Query(default=None),
+        with_count: bool = Query(default=True),
     ):
         self.request = request
         self.offset = offset
@@ -34,11 +38,19 @@ class Pagination:
         if self.multiple:
             self.query.text = self.query.text.replace(",", "|")
         self.sort = sort
+        self.rank = not sort  # order search results by relevance, unless explicit sort was requested
         self.desc = desc
         self.desc_s = "desc" if desc else ""
+        # keyset pagination mode, enabled by passing cursor (empty for the first page)
+        self.cursor = cursor
+        self.with_count = with_count
+        self.next_cursor = None
+        self.previous_cursor = None
         self.model = None
 
     def get_previous_url(self) -> Union[None, str]:
+        if self.cursor is not None:
+            return self.get_cursor_url(self.previous_cursor)
         if self.offset <= 0:
             return None
         if self.offset - self.limit <= 0:
@@ -46,28 +58,101 @@ class Pagination:
         return str(self.request.url.include_query_params(limit=self.limit, offset=self.offset - self.limit))
 
     def get_next_url(self, count) -> Union[None, str]:
+        if self.cursor is not None:
+            return self.get_cursor_url(self.next_cursor)
         if self.offset + self.limit >= count or self.limit == -1:
             return None
         return str(self.request.url.include_query_params(limit=self.limit, offset=self.offset + self.limit))
 
+    def get_cursor_url(self, cursor) -> Union[None, str]:
+        if cursor is None:
+            return None
+        return str(self.request.url.remove_query_params(keys=["offset"]).include_query_params(cursor=cursor))
+
+    def get_link_header(self) -> str:
+        urls = {"next": self.get_next_url(None), "prev": self.get_previous_url()} if self.cursor is not None else {}
+        return ", ".join(f'<{url}>; rel="{rel}"' for rel, url in urls.items() if url)
+
+    def encode_cursor(self, item, backwards) -> str:
+        data = json.dumps([getattr(item, self.sort), item.id, backwards], default=str)
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self) -> tuple:
+        try:
+            value, item_id, backwards = json.loads(base64.urlsafe_b64decode(self.cursor.encode()))
+        except Exception:
+            raise HTTPException(422, "Invalid cursor")
+        return value, item_id, bool(backwards)
+
     async def get_count(self, query) -> int:
         try:
             return await utils.database.get_scalar(query, db.func.count, self.model.id)
         except asyncpg.exceptions.DataError:
             return 0
 
-    async def get_list(self, query) -> list:
+    def set_default_sort(self):
         if not self.sort:
             self.sort = "created"
             self.desc_s = "desc"
+
+    def get_ordered_query(self, query):
+        self.set_default_sort()
+        if self.rank and self.query.text and self.model.SEARCH_COLUMNS:
+            query = query.order_by(func.word_similarity(self.query.text, self.model.get_search_expression()).desc())
+        return query.order_by(text(f"{self.sort} {self.desc_s}"))
+
+    async def get_list(self, query) -> list:
+        self.set_default_sort()
+        if self.cursor is not None:
+            return await self.get_cursor_list(query)
         if self.limit != -1:
             query = query.limit(self.limit)
-        query = query.order_by(text(f"{self.sort} {self.desc_s}"))
+        query = self.get_ordered_query(query)
         try:
             return await query.offset(self.offset).gino.all()
         except (asyncpg.exceptions.UndefinedColumnError, asyncpg.exceptions.DataError):
             return []
 
+    def apply_cursor(self, query, column):
+        value, item_id, backwards = self.decode_cursor() if self.cursor else (None, None, False)
+        fetch_desc = (self.desc_s == "desc") != backwards
+        if self.cursor:
+            # (sort value, id) pairs are unique, so page boundaries are stable even with duplicate sort values
+            key, bound = tuple_(column, self.model.id), tuple_(cast(value, column.type), item_id)
+            query = query.where(key < bound if fetch_desc else key > bound)
+        if fetch_desc:
+            query = query.order_by(column.desc(), self.model.id.desc())
+        else:
+            query = query.order_by(column.asc(), self.model.id.asc())
+        return query, backwards
+
+    def set_cursors(self, items, has_more, backwards):
+        if not items:
+            return
+        if has_more or backwards:
+            self.next_cursor = self.encode_cursor(items[-1], False)
+        if (has_more and backwards) or (self.cursor and not backwards):
+            self.previous_cursor = self.encode_cursor(items[0], True)
+
+    async def get_cursor_list(self, query) -> list:
+        column = self.model.__table__.columns.get(self.sort)
+        if column is None:
+            return []
+        query, backwards = self.apply_cursor(query, column)
+        if self.limit != -1:
+            query = query.limit(self.limit + 1)  # one more to check if there is a next page
+        try:
+            items = await query.gino.all()
+        except (asyncpg.exceptions.UndefinedColumnError, asyncpg.exceptions.DataError):
+            return []
+        has_more = self.limit != -1 and len(items) > self.limit
+        if has_more:
+            items = items[: self.limit]
+        if backwards:
+            items.reverse()
+        self.set_cursors(items, has_more, backwards)
+        return items
+
     def search(self):
         if not self.query:
             return []
@@ -77,17 +162,16 @@ class Pagination:
             column = getattr(self.model, search_filter, None)
             if column is not None:
                 queries.append(column.in_(value))
-        queries.append(
-            or_(
-                *(
-                    getattr(self.model, m.key)
-                    .cast(Text)
-                    .op("~*")(f"{self.query.text}")  # NOTE: not cross-db, postgres case-insensitive regex
-                    for m in self.model.__table__.columns
-                )
-            )
-        )
-        return and_(*queries)
+        if self.query.text:
+            queries.append(self.get_text_filter())
+        return and_(*queries) if queries else []
+
+    def get_text_filter(self):
+        # NOTE: not cross-db, postgres case-insensitive regex
+        if self.model.SEARCH_COLUMNS:  # matched through pg_trgm index on the search expression
+            # newline-sensitive mode: ^ and $ match at column boundaries, and . doesn't match across columns
+            return self.model.get_search_expression().op("~*")(f"(?n){self.query.text}")
+        return or_(*(getattr(self.model, m.key).cast(Text).op("~*")(self.query.text) for m in self.model.__table__.columns))
 
     async def paginate(
         self,
@@ -109,7 +193,10 @@ class Pagination:
         )
         if count_only:
             return await self.get_count(query)
-        count, data = await asyncio.gather(self.get_count(query), self.get_list(query.group_by(model.id)))
+        if self.cursor is not None and not self.with_count:
+            count, data = None, await self.get_list(query.group_by(model.id))
+        else:
+            count, data = await asyncio.gather(self.get_count(query), self.get_list(query.group_by(model.id)))
         if postprocess:
             data = await postprocess(data)
         return {
@@ -6,11 +6,13 @@ import platform
 import re
 import sys
 import traceback
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 from contextvars import ContextVar
-from typing import Dict
+from typing import Any, Dict
 
 import aioredis
+from aiohttp import BasicAuth, ClientSession, TCPConnector
 from bitcart import COINS, APIManager
 from bitcart.coin import Coin
 from fastapi import HTTPException
@@ -20,7 +22,7 @@ from starlette.config import Config
 from starlette.datastructures import CommaSeparatedStrings
 
 from api import db
-from api.constants import GIT_REPO_URL, VERSION, WEBSITE
+from api.constants import GIT_REPO_URL, LOGSERVER_PORT, VERSION, WEBSITE
 from api.ext.notifiers import parse_notifier_schema
 from api.ext.ssh import load_ssh_settings
 from api.logger import configure_logserver, get_exception_message, get_logger
@@ -49,11 +51,43 @@ class Settings(BaseSettings):
     torrc_file: str = Field(None, env="TORRC_FILE")
     openapi_path: str = Field(None, env="OPENAPI_PATH")
     api_title: str = Field("BitcartCC", env="API_TITLE")
+    coin_pool_size: int = Field(1024, env="BITCART_COIN_POOL_SIZE")
+    templates_cache_size: int = Field(256, env="BITCART_TEMPLATES_CACHE_SIZE")
+    coin_connections_limit: int = Field(100, env="BITCART_COIN_CONNECTIONS_LIMIT")
+    payment_methods_concurrency: int = Field(8, env="BITCART_PAYMENT_METHODS_CONCURRENCY")
+    wallet_balances_concurrency: int = Field(8, env="BITCART_WALLET_BALANCES_CONCURRENCY")
+    auth_cache_ttl: int = Field(30, env="BITCART_AUTH_CACHE_TTL")
+    logserver_port: int = Field(LOGSERVER_PORT, env="BITCART_LOGSERVER_PORT")
+    rates_cache_ttl: int = Field(60, env="BITCART_RATES_CACHE_TTL")
+    rates_cache_max_age: int = Field(600, env="BITCART_RATES_CACHE_MAX_AGE")
+    ipn_workers: int = Field(10, env="BITCART_IPN_WORKERS")
+    ipn_connections_per_host: int = Field(4, env="BITCART_IPN_CONNECTIONS_PER_HOST")
+    ipn_timeout: int = Field(10, env="BITCART_IPN_TIMEOUT")
+    ipn_max_attempts: int = Field(10, env="BITCART_IPN_MAX_ATTEMPTS")
+    ipn_retry_delay: int = Field(5, env="BITCART_IPN_RETRY_DELAY")
+    delivery_workers: int = Field(4, env="BITCART_DELIVERY_WORKERS")
+    delivery_max_attempts: int = Field(3, env="BITCART_DELIVERY_MAX_ATTEMPTS")
+    delivery_retry_delay: int = Field(1, env="BITCART_DELIVERY_RETRY_DELAY")
+    worker_lease_ttl: int = Field(15, env="BITCART_WORKER_LEASE_TTL")
     cryptos: Dict[str, Coin] = None
     crypto_settings: dict = None
+    coin_clients: OrderedDict = None
+    coin_sessions: dict = None
+    coin_pool_hits: int = 0
+    coin_pool_misses: int = 0
+    rates_cache: dict = None
+    rates_refreshes: dict = None
+    token_metadata: dict = None
+    auth_cache: dict = None
+    auth_cache_generation: int = 0
+    templates_cache: OrderedDict = None
     manager: APIManager = None
     notifiers: dict = None
     redis_pool: aioredis.Redis = None
+    ws_multiplexer: Any = None
+    mailer: Any = None
+    delivery_executor: Any = None
+    delivery_stats: dict = None
     config: Config = None
     logger: logging.Logger = None
 
@@ -100,6 +134,12 @@ class Settings(BaseSettings):
             return "bitcart_test"
         return db
 
+    @validator("rates_cache_ttl", "auth_cache_ttl", pre=True, always=True)
+    def disable_caches_in_tests(cls, ttl, values):
+        if values["test"]:  # tests mock rates and modify users directly
+            return 0
+        return ttl
+
     @validator("datadir", pre=True, always=True)
     def set_datadir(cls, path):
         path = os.path.abspath(path)
@@ -128,6 +168,14 @@ class Settings(BaseSettings):
             self.ssh_settings = load_ssh_settings(self.config)
         self.load_cryptos()
         self.load_notification_providers()
+        self.coin_clients = OrderedDict()
+        self.coin_sessions = {}
+        self.rates_cache = {}
+        self.rates_refreshes = {}
+        self.token_metadata = {}
+        self.auth_cache = {}
+        self.templates_cache = OrderedDict()
+        self.delivery_stats = {}
 
     def load_cryptos(self):
         self.cryptos = {}
@@ -169,13 +217,47 @@ class Settings(BaseSettings):
                     required.remove("message")
             self.notifiers[notifier.name] = {"properties": properties, "required": required}
 
+    def get_coin_session(self, coin):
+        # one keep-alive connection pool per daemon, shared by all wallet clients
+        if coin not in self.coin_sessions or self.coin_sessions[coin].closed:
+            credentials = self.crypto_settings[coin]["credentials"]
+            self.coin_sessions[coin] = ClientSession(
+                connector=TCPConnector(limit_per_host=self.coin_connections_limit),
+                auth=BasicAuth(credentials["rpc_user"], credentials["rpc_pass"]),
+            )
+        return self.coin_sessions[coin]
+
     def get_coin(self, coin, xpub=None):
         coin = coin.lower()
         if coin not in self.cryptos:
             raise HTTPException(422, "Unsupported currency")
         if not xpub:
             return self.cryptos[coin]
-        return COINS[coin.upper()](xpub=xpub, **self.crypto_settings[coin]["credentials"])
+        key = get_coin_key(coin, xpub)
+        if key in self.coin_clients:
+            self.coin_pool_hits += 1
+            self.coin_clients.move_to_end(key)
+            return self.coin_clients[key]
+        self.coin_pool_misses += 1
+        credentials = self.crypto_settings[coin]["credentials"]
+        client = COINS[coin.upper()](xpub=xpub, session=self.get_coin_session(coin), **credentials)
+        self.coin_clients[key] = client
+        if len(self.coin_clients) > self.coin_pool_size:
+            self.coin_clients.popitem(last=False)
+        return client
+
+    def evict_coin(self, coin, xpub, contract=None):
+        self.coin_clients.pop(get_coin_key(coin.lower(), {"xpub": xpub, "contract": contract}), None)
+
+    @property
+    def coin_pool_stats(self):
+        return {"size": len(self.coin_clients), "hits": self.coin_pool_hits, "misses": self.coin_pool_misses}
+
+    async def close_coin_sessions(self):
+        self.coin_clients.clear()
+        for session in self.coin_sessions.values():
+            await session.close()
+        self.coin_sessions = {}
 
     async def create_db_engine(self):
         return await db.db.set_bind(self.connection_str, min_size=1, loop=asyncio.get_running_loop())
@@ -195,8 +277,15 @@ class Settings(BaseSettings):
         await self.create_db_engine()
 
     async def shutdown(self):
+        if self.ws_multiplexer:
+            await self.ws_multiplexer.close()
+        if self.mailer:
+            self.mailer.close()
+        if self.delivery_executor:
+            self.delivery_executor.shutdown(wait=False)
         if self.redis_pool:
             await self.redis_pool.close()
+        await self.close_coin_sessions()
         await self.shutdown_db_engine()
 
     def init_logging(self):
@@ -207,6 +296,12 @@ class Settings(BaseSettings):
         asyncio.get_running_loop().set_exception_handler(lambda *args, **kwargs: handle_exception(self, *args, **kwargs))
 
 
+def get_coin_key(coin, xpub):
+    if isinstance(xpub, dict):
+        return coin, xpub.get("xpub"), xpub.get("contract")
+    return coin, xpub, None
+
+
 def excepthook_handler(settings, excepthook):
     def internal_error_handler(type_, value, tb):
         if type_ != KeyboardInterrupt:
@@ -11,10 +11,7 @@ logger = get_logger(__name__)
 
 @event_handler.on("expired_task")
 async def create_expired_task(event, event_data):
-    invoice = await utils.database.get_object(models.Invoice, event_data["id"], raise_exception=False)
-    if not invoice:
-        return
-    await invoices.make_expired_task(invoice)
+    invoices.expiration_scheduler.wakeup()  # new invoice might expire before the currently scheduled one
 
 
 @event_handler.on("sync_wallet")
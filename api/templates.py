@@ -7,14 +7,18 @@ from api.exceptions import TemplateLoadError
 
 
 class Template:
-    def __init__(self, name, text=None, applicable_to=""):
+    def __init__(self, name, text=None, applicable_to="", compiled=None):
         self.name = name
         self.applicable_to = applicable_to
         if text:
             self.template_text = text
         else:
             self.load_from_file(name)
-        self.template = JinjaTemplate(self.template_text, trim_blocks=True)
+        self.template = compiled or self.compile(self.template_text)
+
+    @staticmethod
+    def compile(text):
+        return JinjaTemplate(text, trim_blocks=True)
 
     def load_from_file(self, name):
         try:
@@ -2,9 +2,11 @@ from api.utils import (
     authorization,
     common,
     database,
+    delivery,
     email,
     files,
     host,
+    loaders,
     logging,
     notifications,
     policies,
@@ -21,9 +23,11 @@ __all__ = [
     "authorization",
     "common",
     "database",
+    "delivery",
     "email",
     "files",
     "host",
+    "loaders",
     "logging",
     "notifications",
     "policies",
@@ -1,14 +1,22 @@
+import json
+import time
 from typing import Optional
 
+from dateutil.parser import isoparse
 from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordBearer, SecurityScopes
 from passlib.context import CryptContext
+from sqlalchemy import DateTime
 from starlette.requests import Request
 from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
 
-from api import models, utils
+from api import events, models, settings, utils
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+AUTH_CACHE_SIZE = 10000
+AUTH_GENERATION_EXPIRE_FACTOR = 10  # generation keys must outlive cache entries and requests started before invalidation
+USER_CACHE_FIELDS = ("id", "email", "is_superuser", "settings", "created")
 
 
 def verify_password(plain_password, hashed_password):
@@ -47,6 +55,114 @@ oauth2_scheme = OAuth2PasswordBearer(
 )
 
 
+def dump_model(model, fields=None):
+    data = jsonable_encoder(model.to_dict())
+    return {key: data[key] for key in fields} if fields else data
+
+
+def load_model(model, data):
+    data = data.copy()
+    for column in model.__table__.columns:
+        if isinstance(column.type, DateTime) and data.get(column.name):
+            data[column.name] = isoparse(data[column.name])
+    return model(**data)
+
+
+def get_auth_cache_key(token_id):
+    return f"auth:{token_id}"
+
+
+def get_auth_generation_key(token_id):
+    return f"auth:generation:{token_id}"
+
+
+def cache_principal(token_id, data, generation):
+    # skip entries read before an invalidation, they could be stale
+    if generation != settings.settings.auth_cache_generation:
+        return
+    cache = settings.settings.auth_cache
+    if len(cache) >= AUTH_CACHE_SIZE:
+        now = time.time()
+        for key in [key for key, (_, expires) in cache.items() if expires <= now] or [next(iter(cache))]:
+            cache.pop(key)
+    cache[token_id] = (data, time.time() + settings.settings.auth_cache_ttl)
+
+
+async def get_cached_principal(token_id, local_generation):
+    # returns cached data (or None) and the current generation of the token in redis
+    entry = settings.settings.auth_cache.get(token_id)
+    if entry and entry[1] > time.time():
+        return entry[0], None
+    async with utils.redis.wait_for_redis():
+        value, generation = await settings.settings.redis_pool.mget(
+            get_auth_cache_key(token_id), get_auth_generation_key(token_id)
+        )
+    data = json.loads(value) if value is not None else None
+    if data is None or data["generation"] != generation:  # written before the token was invalidated
+        return None, generation
+    cache_principal(token_id, data, local_generation)
+    return data, generation
+
+
+async def get_principal(token_id):
+    # user and token rows are cached, not model instances, so each request gets its own objects
+    ttl = settings.settings.auth_cache_ttl
+    if not ttl:
+        return await load_principal(token_id)
+    local_generation = settings.settings.auth_cache_generation
+    data, generation = await get_cached_principal(token_id, local_generation)
+    if data is None:
+        result = await load_principal(token_id)
+        if result is None:
+            return None
+        # password hash is never cached
+        data = {
+            "user": dump_model(result[0], USER_CACHE_FIELDS),
+            "token": dump_model(result[1]),
+            "generation": generation,
+        }
+        cache_principal(token_id, data, local_generation)
+        await utils.redis.set_json(get_auth_cache_key(token_id), data, expire=ttl)
+    return load_model(models.User, data["user"]), load_model(models.Token, data["token"])
+
+
+async def load_principal(token_id):
+    return (
+        await models.User.join(models.Token).select(models.Token.id == token_id).gino.load((models.User, models.Token)).first()
+    )
+
+
+def drop_cached_tokens(token_ids):
+    settings.settings.auth_cache_generation += 1
+    for token_id in token_ids:
+        settings.settings.auth_cache.pop(token_id, None)
+
+
+async def invalidate_tokens(token_ids):
+    if not token_ids or not settings.settings.auth_cache_ttl:
+        return
+    drop_cached_tokens(token_ids)
+    # bumping the generation makes entries written by requests that read the database before invalidation stale
+    expire = settings.settings.auth_cache_ttl * AUTH_GENERATION_EXPIRE_FACTOR
+    async with utils.redis.wait_for_redis():
+        async with settings.settings.redis_pool.pipeline(transaction=True) as pipe:
+            for token_id in token_ids:
+                pipe.incr(get_auth_generation_key(token_id)).expire(get_auth_generation_key(token_id), expire)
+            await pipe.delete(*map(get_auth_cache_key, token_ids)).execute()
+    await events.event_handler.publish("invalidate_auth", {"tokens": token_ids})  # for other workers
+
+
+async def invalidate_user_tokens(user_id):
+    if not settings.settings.auth_cache_ttl:
+        return
+    token_ids = await models.Token.select("id").where(models.Token.user_id == user_id).gino.all()
+    await invalidate_tokens([token_id for token_id, in token_ids])
+
+
+async def invalidate_auth_handler(event, event_data):
+    drop_cached_tokens(event_data["tokens"])
+
+
 def check_selective_scopes(request, scope, token):
     model_id = request.path_params.get("model_id", None)
     if model_id is None:
@@ -67,12 +183,7 @@ class AuthDependency:
         else:
             authenticate_value = "Bearer"
         token: str = await oauth2_scheme(request) if not self.token else self.token
-        data = (
-            await models.User.join(models.Token)
-            .select(models.Token.id == token)
-            .gino.load((models.User, models.Token))
-            .first()
-        )
+        data = await get_principal(token)
         if data is None:
             raise HTTPException(
                 status_code=HTTP_401_UNAUTHORIZED,
@@ -95,3 +206,6 @@ class AuthDependency:
         if return_token:
             return user, token
         return user
+
+
+events.event_handler.add_handler("invalidate_auth", invalidate_auth_handler)
@@ -4,7 +4,7 @@ import asyncpg
 from fastapi import HTTPException
 from sqlalchemy import distinct
 
-from api import db, models
+from api import db, models, utils
 from api.logger import get_exception_message, get_logger
 
 logger = get_logger(__name__)
@@ -80,8 +80,9 @@ async def get_scalar(query, func, column):
 
 
 async def postprocess_func(items):
-    for item in items:
-        await item.load_data()
+    if items:
+        with utils.loaders.loaders_context():
+            await type(items[0]).load_data_batch(items)
     return items
 
 
@@ -0,0 +1,56 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from api import settings
+from api.exceptions import PermanentDeliveryError
+from api.logger import get_exception_message, get_logger
+
+logger = get_logger(__name__)
+
+
+# blocking smtplib and notifiers calls run in a bounded thread pool, so that slow servers don't block the event loop
+def get_executor():
+    if settings.settings.delivery_executor is None:
+        settings.settings.delivery_executor = ThreadPoolExecutor(
+            max_workers=settings.settings.delivery_workers, thread_name_prefix="delivery"
+        )
+    return settings.settings.delivery_executor
+
+
+async def run_in_executor(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def get_stats(kind):
+    return settings.settings.delivery_stats.setdefault(kind, {"sent": 0, "failed": 0, "retries": 0, "time": 0.0})
+
+
+def get_retry_delay(attempt):
+    return settings.settings.delivery_retry_delay * 2 ** (attempt - 1)
+
+
+# retries func with exponential backoff, unless it fails with one of fatal_errors or PermanentDeliveryError
+async def deliver(kind, func, *args, fatal_errors=(), **kwargs):
+    stats = get_stats(kind)
+    max_attempts = settings.settings.delivery_max_attempts
+    for attempt in range(1, max_attempts + 1):
+        start = time.perf_counter()
+        try:
+            result = await run_in_executor(func, *args, **kwargs)
+        except Exception as e:
+            stats["time"] += time.perf_counter() - start
+            if isinstance(e, (PermanentDeliveryError, *fatal_errors)) or attempt >= max_attempts:
+                stats["failed"] += 1
+                raise
+            stats["retries"] += 1
+            delay = get_retry_delay(attempt)
+            logger.debug(
+                f"{kind} delivery failed (attempt {attempt}), retrying in {delay} seconds: {get_exception_message(e)}"
+            )
+            await asyncio.sleep(delay)
+        else:
+            stats["time"] += time.perf_counter() - start
+            stats["sent"] += 1
+            return result
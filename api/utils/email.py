@@ -1,48 +1,147 @@
+import asyncio
 import smtplib
+import time
 import traceback
+from collections import namedtuple
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-from api.logger import get_logger
+from api import settings
+from api.exceptions import PermanentDeliveryError
+from api.logger import get_exception_message, get_logger
+from api.utils import delivery
 
 logger = get_logger(__name__)
 
+SMTP_TIMEOUT = 2
+SMTP_IDLE_TIMEOUT = 60  # servers drop idle connections, so older ones are reopened instead of reused
+
+EmailConfig = namedtuple("EmailConfig", ["host", "port", "user", "password", "email", "ssl"])
+
 
 def get_email_dsn(host, port, user, password, email, ssl=True):
     return f"{user}:{password}@{host}:{port}?email={email}&ssl={ssl}"
 
 
-def check_ping(host, port, user, password, email, ssl=True):  # pragma: no cover
-    dsn = get_email_dsn(host, port, user, password, email, ssl)
-    if not (host and port and user and password and email):
+def get_store_email_config(store):
+    return EmailConfig(
+        store.email_host, store.email_port, store.email_user, store.email_password, store.email, store.email_use_ssl
+    )
+
+
+def is_configured(config):
+    return bool(config.host and config.port and config.user and config.password and config.email)
+
+
+def connect(config):  # pragma: no cover
+    server = smtplib.SMTP(host=config.host, port=config.port, timeout=SMTP_TIMEOUT)
+    if config.ssl:
+        server.starttls()
+    server.login(config.user, config.password)
+    return server
+
+
+def close_connection(server):  # pragma: no cover
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+
+def ping(config):  # pragma: no cover
+    server = connect(config)
+    server.verify(config.email)
+    close_connection(server)
+
+
+async def check_ping(host, port, user, password, email, ssl=True):  # pragma: no cover
+    config = EmailConfig(host, port, user, password, email, ssl)
+    dsn = get_email_dsn(*config)
+    if not is_configured(config):
         logger.debug("Checking ping failed: some parameters empty")
         return False
     try:
-        server = smtplib.SMTP(host=host, port=port, timeout=2)
-        if ssl:
-            server.starttls()
-        server.login(user, password)
-        server.verify(email)
-        server.quit()
+        await delivery.run_in_executor(ping, config)
         logger.debug(f"Checking ping successful for {dsn}")
         return True
-    except OSError:
+    except (OSError, smtplib.SMTPException):
         logger.debug(f"Checking ping error for {dsn}\n{traceback.format_exc()}")
         return False
 
 
-def send_mail(store, where, text, subject="Thank you for your purchase"):  # pragma: no cover
-    if not where:
-        return
+def build_message(sender, where, text, subject, html=False):
     message_obj = MIMEMultipart()
     message_obj["Subject"] = subject
-    message_obj["From"] = store.email
+    message_obj["From"] = sender
     message_obj["To"] = where
-    message_obj.attach(MIMEText(text, "html" if store.checkout_settings.use_html_templates else "plain"))
-    message = message_obj.as_string()
-    server = smtplib.SMTP(host=store.email_host, port=store.email_port, timeout=2)
-    if store.email_use_ssl:
-        server.starttls()
-    server.login(store.email_user, store.email_password)
-    server.sendmail(store.email, where, message)
-    server.quit()
+    message_obj.attach(MIMEText(text, "html" if html else "plain"))
+    return message_obj.as_string()
+
+
+# Keeps one SMTP connection per email config, reused for all messages of the store
+# Messages sent to the same config while a batch is in progress are sent together in the next batch
+class SMTPMailer:
+    def __init__(self):
+        self.connections = {}  # config -> (server, last used time)
+        self.pending = {}  # config -> list of messages waiting for the next batch
+        self.locks = {}
+
+    def get_connection(self, config):  # pragma: no cover
+        server, last_used = self.connections.pop(config, (None, 0))
+        if server is not None and time.monotonic() - last_used > SMTP_IDLE_TIMEOUT:
+            close_connection(server)
+            server = None
+        if server is not None:
+            return server
+        try:
+            return connect(config)
+        except smtplib.SMTPAuthenticationError as e:
+            raise PermanentDeliveryError(get_exception_message(e)) from e
+
+    def send_batch(self, config, batch):  # pragma: no cover
+        # runs in the delivery executor; sent messages are removed, so that retries only resend the rest
+        server = self.get_connection(config)
+        try:
+            while batch:
+                message = batch[0]
+                try:
+                    server.sendmail(config.email, message["where"], message["message"])
+                    message["sent"] = True
+                except smtplib.SMTPRecipientsRefused as e:
+                    logger.info(f"Email to {message['where']} refused: {get_exception_message(e)}")
+                batch.pop(0)
+        except Exception:
+            close_connection(server)
+            raise
+        self.connections[config] = (server, time.monotonic())
+
+    async def send(self, config, where, message):
+        entry = {"where": where, "message": message, "sent": False}
+        self.pending.setdefault(config, []).append(entry)
+        async with self.locks.setdefault(config, asyncio.Lock()):
+            if config in self.pending:  # otherwise already sent by the batch of another message
+                batch = self.pending.pop(config)
+                try:
+                    await delivery.deliver("email", self.send_batch, config, list(batch))
+                except Exception as e:
+                    logger.error(f"Failed to send {len(batch)} emails via {config.host}: {get_exception_message(e)}")
+        return entry["sent"]
+
+    def close(self):
+        for server, _ in self.connections.values():
+            close_connection(server)
+        self.connections.clear()
+
+
+def get_mailer():
+    if settings.settings.mailer is None:
+        settings.settings.mailer = SMTPMailer()
+    return settings.settings.mailer
+
+
+async def send_mail(store, where, text, subject="Thank you for your purchase"):  # pragma: no cover
+    config = get_store_email_config(store)
+    if not where or not is_configured(config):
+        return False
+    message = build_message(store.email, where, text, subject, store.checkout_settings.use_html_templates)
+    return await get_mailer().send(config, where, message)
@@ -0,0 +1,87 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from api import models, settings, utils
+from api.utils.tasks import create_task
+
+request_loaders: ContextVar[dict] = ContextVar("request_loaders", default=None)
+
+
+# Collects keys requested in the same event loop iteration and loads them with one batch_load call
+# batch_load receives a list of unique keys (or objects, if key function is passed) and returns results in the same order
+class DataLoader:
+    def __init__(self, batch_load, key=None):
+        self.batch_load = batch_load
+        self.key = key or (lambda obj: obj)
+        self.cache = {}
+        self.queue = []
+
+    def load(self, obj):
+        key = self.key(obj)
+        if key not in self.cache:
+            self.cache[key] = asyncio.get_running_loop().create_future()
+            self.queue.append(obj)
+            if len(self.queue) == 1:
+                create_task(self.dispatch())
+        return self.cache[key]
+
+    async def dispatch(self):
+        await asyncio.sleep(0)  # let other coroutines of the current batch enqueue their keys
+        objs, self.queue = self.queue, []
+        try:
+            results = await self.batch_load(objs)
+        except Exception as e:
+            for obj in objs:
+                self.cache.pop(self.key(obj)).set_exception(e)
+            return
+        for obj, result in zip(objs, results):
+            self.cache[self.key(obj)].set_result(result)
+
+
+@contextmanager
+def loaders_context():
+    token = request_loaders.set({})
+    try:
+        yield
+    finally:
+        request_loaders.reset(token)
+
+
+def get_loader(name, batch_load, key=None):
+    # outside of loaders context every call gets a new loader, so nothing is cached
+    loaders = request_loaders.get()
+    if loaders is None:
+        return DataLoader(batch_load, key=key)
+    if name not in loaders:
+        loaders[name] = DataLoader(batch_load, key=key)
+    return loaders[name]
+
+
+async def load_stores(store_ids):
+    stores = {store.id: store for store in await models.Store.query.where(models.Store.id.in_(store_ids)).gino.all()}
+    return [stores.get(store_id) for store_id in store_ids]
+
+
+async def load_wallet_balance_limited(semaphore, wallet):
+    async with semaphore:
+        return await utils.wallets.get_confirmed_wallet_balance(wallet)
+
+
+async def load_wallet_balances(wallets):
+    # limit concurrent daemon calls, a page of wallets shouldn't flood the daemons
+    semaphore = asyncio.Semaphore(settings.settings.wallet_balances_concurrency)
+    return await asyncio.gather(*(load_wallet_balance_limited(semaphore, wallet) for wallet in wallets))
+
+
+def get_wallet_key(wallet):
+    return (wallet.currency.lower(), wallet.xpub, wallet.contract)
+
+
+def load_store(store_id):
+    return get_loader("stores", load_stores).load(store_id)
+
+
+def load_wallet_balance(wallet):
+    # wallets with the same keys share one daemon call
+    return get_loader("wallet_balances", load_wallet_balances, key=get_wallet_key).load(wallet)
@@ -1,25 +1,20 @@
-import traceback
+import asyncio
 from decimal import Decimal
 
 import notifiers
-from aiohttp import ClientSession
+from notifiers.exceptions import BadArguments
 
 from api import models, utils
-from api.logger import get_logger
+from api.ext import ipn as ipn_ext
+from api.logger import get_exception_message, get_logger
 
 logger = get_logger(__name__)
 
 
-async def send_ipn(obj, status):  # pragma: no cover
+async def send_ipn(obj, status):
+    # delivered by the background worker with retries, so that slow merchant endpoints don't block status updates
     if obj.notification_url:
-        data = {"id": obj.id, "status": status}
-        base_log_message = f"Sending IPN with data {data} to {obj.notification_url}"
-        try:
-            async with ClientSession() as session:
-                await session.post(obj.notification_url, json=data)
-            logger.info(f"{base_log_message}: success")
-        except Exception:
-            logger.info(f"{base_log_message}: error\n{traceback.format_exc()}")
+        await ipn_ext.enqueue(obj, status)
 
 
 # Apply common type conversions which aren't user errors
@@ -40,9 +35,24 @@ def validate_data(provider, data):
     return data
 
 
+def send_notification(provider, text, data):  # pragma: no cover
+    response = provider.notify(message=text, **data)
+    if getattr(response, "errors", None):  # raised to be retried
+        response.raise_on_errors()
+
+
 async def notify(store, text):  # pragma: no cover
     notification_providers = await utils.database.get_objects(models.Notification, store.notifications)
+    coros = []
     for db_provider in notification_providers:
         provider = notifiers.get_notifier(db_provider.provider)
         data = validate_data(provider, db_provider.data)
-        provider.notify(message=text, **data)
+        coros.append(utils.delivery.deliver("notifier", send_notification, provider, text, data, fatal_errors=(BadArguments,)))
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    # delivery failures are only logged, so that one broken provider doesn't stop other notifications and emails
+    for db_provider, result in zip(notification_providers, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to send notification {db_provider.id} of store {store.id}: {get_exception_message(result)}")
+    for result in results:
+        if isinstance(result, BadArguments):  # invalid provider settings
+            raise result
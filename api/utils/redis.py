@@ -1,8 +1,13 @@
 import asyncio
 import json
+import traceback
 from contextlib import asynccontextmanager
 
 from api import settings
+from api.logger import get_exception_message, get_logger
+from api.utils.tasks import create_task
+
+logger = get_logger(__name__)
 
 
 @asynccontextmanager
@@ -24,6 +29,206 @@ async def publish_message(channel, message):
         return await settings.settings.redis_pool.publish(f"channel:{channel}", json.dumps(message))
 
 
+async def queue_message(key, message, max_size):
+    async with wait_for_redis():
+        async with settings.settings.redis_pool.pipeline(transaction=True) as pipe:
+            await pipe.lpush(key, json.dumps(message)).ltrim(key, 0, max_size - 1).execute()
+
+
+async def listen_queue(key):  # pragma: no cover
+    async with wait_for_redis():
+        redis = settings.settings.redis_pool
+    while True:
+        _, message = await redis.brpop(key, timeout=0)
+        yield json.loads(message)
+
+
 async def listen_channel(channel):
     async for message in channel.listen():
         yield json.loads(message["data"])
+
+
+async def get_json(key):
+    async with wait_for_redis():
+        value = await settings.settings.redis_pool.get(key)
+    return json.loads(value) if value is not None else None
+
+
+async def set_json(key, value, expire=None):
+    async with wait_for_redis():
+        return await settings.settings.redis_pool.set(key, json.dumps(value), ex=expire)
+
+
+class WebsocketClient:
+    def __init__(self, websocket, queue_size):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(queue_size)
+        self.channels = set()
+        self.sender = None
+
+
+# One pattern subscription per worker, shared by all websockets of that worker
+# channel name -> set of sockets, channel is kept while at least one socket listens to it
+# Each socket has its own bounded send queue, so that a slow client doesn't delay the others
+class ChannelMultiplexer:
+    PATTERNS = ("channel:invoice:*", "channel:wallet:*")
+    QUEUE_SIZE = 100
+    RECONNECT_DELAY = 1
+    MAX_RECONNECT_DELAY = 30
+
+    def __init__(self):
+        self.channels = {}
+        self.clients = {}
+        self.subscriber = None
+        self.listener = None
+        self.starting = None
+
+    @property
+    def stats(self):
+        return {"channels": len(self.channels), "sockets": sum(len(sockets) for sockets in self.channels.values())}
+
+    async def connect(self):
+        async with wait_for_redis():
+            self.subscriber = settings.settings.redis_pool.pubsub(ignore_subscribe_messages=True)
+            await self.subscriber.psubscribe(*self.PATTERNS)
+
+    async def disconnect(self):
+        subscriber, self.subscriber = self.subscriber, None
+        if subscriber:
+            try:
+                await subscriber.close()
+            except Exception as e:  # pragma: no cover
+                logger.debug(f"Error closing websocket subscription: {get_exception_message(e)}")
+
+    async def start(self):
+        await self.connect()
+        self.listener = create_task(self.listen())
+
+    async def ensure_started(self):
+        if self.starting is not None and self.starting.done() and (self.listener is None or self.listener.done()):
+            self.starting = None  # listener stopped unexpectedly, start again
+        if self.starting is None:  # concurrent first connections share one startup
+            self.starting = create_task(self.start())
+        try:
+            await self.starting
+        except Exception:
+            self.starting = None  # retry on next connection
+            raise
+
+    async def subscribe(self, channel, websocket):
+        await self.ensure_started()
+        client = self.clients.get(websocket)
+        if client is None:
+            client = self.clients[websocket] = WebsocketClient(websocket, self.QUEUE_SIZE)
+            client.sender = create_task(self.send_messages(client))
+        client.channels.add(f"channel:{channel}")
+        self.channels.setdefault(f"channel:{channel}", set()).add(websocket)
+
+    def discard_socket(self, channel, websocket):
+        sockets = self.channels.get(channel)
+        if sockets is None:
+            return
+        sockets.discard(websocket)
+        if not sockets:
+            del self.channels[channel]
+
+    def unsubscribe(self, channel, websocket):
+        channel = f"channel:{channel}"
+        self.discard_socket(channel, websocket)
+        client = self.clients.get(websocket)
+        if client is not None:
+            client.channels.discard(channel)
+            if not client.channels:
+                self.remove_client(client)
+
+    def remove_client(self, client):
+        if self.clients.pop(client.websocket, None) is None:
+            return
+        for channel in client.channels:
+            self.discard_socket(channel, client.websocket)
+        client.channels.clear()
+        if client.sender is not None and client.sender is not asyncio.current_task():
+            client.sender.cancel()
+
+    async def send_messages(self, client):
+        while True:
+            data = await client.queue.get()
+            try:
+                await client.websocket.send_text(data)
+            except Exception as e:  # pragma: no cover
+                logger.debug(f"Dropping websocket: {get_exception_message(e)}")
+                self.remove_client(client)
+                return
+
+    def dispatch(self, message):
+        sockets = self.channels.get(message["channel"])
+        if not sockets:
+            return
+        for websocket in list(sockets):
+            client = self.clients.get(websocket)
+            if client is None:  # pragma: no cover
+                continue
+            try:  # data is already json, so it is sent as is without decoding
+                client.queue.put_nowait(message["data"])
+            except asyncio.QueueFull:
+                # a stalled client is disconnected instead of buffering without limit, it reconnects and gets the status
+                logger.debug(f"Dropping websocket of {message['channel']}: send queue is full")
+                self.remove_client(client)
+                create_task(websocket.close())
+
+    async def listen(self):
+        delay = self.RECONNECT_DELAY
+        while True:
+            try:
+                if self.subscriber is None:
+                    await self.connect()
+                async for message in self.subscriber.listen():
+                    delay = self.RECONNECT_DELAY
+                    try:
+                        self.dispatch(message)
+                    except Exception:  # pragma: no cover
+                        logger.error(traceback.format_exc())
+                raise ConnectionError("Subscription closed")
+            except Exception as e:
+                logger.error(f"Websocket subscription lost, reconnecting in {delay} seconds: {get_exception_message(e)}")
+            await self.disconnect()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+
+    async def close(self):
+        if self.listener:
+            self.listener.cancel()
+        for client in list(self.clients.values()):
+            self.remove_client(client)
+        await self.disconnect()
+        self.channels.clear()
+        self.listener = self.starting = None
+
+
+def get_multiplexer():
+    if settings.settings.ws_multiplexer is None:
+        settings.settings.ws_multiplexer = ChannelMultiplexer()
+    return settings.settings.ws_multiplexer
+
+
+# Expiring lock owned by one process, it must be renewed before ttl passes to stay owned
+class Lease:
+    RENEW_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, name, owner, ttl):
+        self.key = f"lease:{name}"
+        self.owner = owner
+        self.ttl = int(ttl * 1000)
+
+    async def acquire(self):
+        async with wait_for_redis():
+            return bool(await settings.settings.redis_pool.set(self.key, self.owner, nx=True, px=self.ttl))
+
+    async def renew(self):
+        async with wait_for_redis():
+            return bool(await settings.settings.redis_pool.eval(self.RENEW_SCRIPT, 1, self.key, self.owner, self.ttl))
+
+    async def release(self):
+        async with wait_for_redis():
+            return bool(await settings.settings.redis_pool.eval(self.RELEASE_SCRIPT, 1, self.key, self.owner))
@@ -256,7 +256,7 @@ class ModelView:
 def get_pagination_model(display_model):
     return create_pydantic_model(
         f"PaginationResponse_{display_model.__name__}",
-        count=(int, ...),
+        count=(Optional[int], ...),
         next=(Optional[str], None),
         previous=(Optional[str], None),
         result=(List[display_model], ...),
@@ -1,4 +1,6 @@
-from api import exceptions, models, templates, utils
+from sqlalchemy import or_, tuple_
+
+from api import exceptions, models, settings, templates, utils
 from api.logger import get_logger
 from api.utils.common import get_object_name
 
@@ -13,17 +15,56 @@ def get_template_matching_str(name, obj):
     return template_str
 
 
+def get_compiled_template(custom_template):
+    # edits change the key, so stale entries are never returned and are evicted by LRU in other workers
+    key = (custom_template.id, custom_template.updated or custom_template.created)
+    cache = settings.settings.templates_cache
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    compiled = cache[key] = templates.Template.compile(custom_template.text)
+    if len(cache) > settings.settings.templates_cache_size:
+        cache.popitem(last=False)
+    return compiled
+
+
+def drop_compiled_template(template_id):
+    cache = settings.settings.templates_cache
+    for key in [key for key in cache if key[0] == template_id]:
+        del cache[key]
+
+
+async def load_custom_templates(keys):
+    # one query for all keys: templates by id, by name for the user, or by name only
+    template_ids = [template_id for _, _, template_id in keys if template_id]
+    user_names = [(name, user_id) for name, user_id, template_id in keys if not template_id and user_id]
+    names = [name for name, user_id, template_id in keys if not template_id and not user_id]
+    conditions = []
+    if template_ids:
+        conditions.append(models.Template.id.in_(template_ids))
+    if user_names:
+        conditions.append(tuple_(models.Template.name, models.Template.user_id).in_(user_names))
+    if names:
+        conditions.append(models.Template.name.in_(names))
+    custom_templates = await models.Template.query.where(or_(*conditions)).order_by(models.Template.created).gino.all()
+    await models.Template.load_data_batch(custom_templates)
+    return [match_custom_template(custom_templates, *key) for key in keys]
+
+
+def match_custom_template(custom_templates, name, user_id, template_id):
+    for custom_template in custom_templates:
+        matches = custom_template.id == template_id if template_id else custom_template.name == name
+        if matches and (not user_id or custom_template.user_id == user_id):
+            return custom_template
+
+
 async def get_template(name, user_id=None, obj=None):
-    if obj and obj.templates.get(name):
-        query = models.Template.query.where(models.Template.id == obj.templates[name])
-    else:
-        query = models.Template.query.where(models.Template.name == name)
-    if user_id:
-        query = query.where(models.Template.user_id == user_id)
-    custom_template = await utils.database.get_object(models.Template, custom_query=query, raise_exception=False)
+    template_id = obj.templates.get(name) if obj else None
+    # in loaders context objects using the same template share one query
+    custom_template = await utils.loaders.get_loader("templates", load_custom_templates).load((name, user_id, template_id))
     if custom_template:
         logger.info(f'{get_template_matching_str(name,obj)} selected custom template "{custom_template.name}"')
-        return templates.Template(name, custom_template.text)
+        return templates.Template(name, custom_template.text, compiled=get_compiled_template(custom_template))
     if name in templates.templates:
         logger.info(f"{get_template_matching_str(name,obj)} selected default template")
         return templates.templates[name]
@@ -1,4 +1,6 @@
+import asyncio
 import math
+import time
 from decimal import Decimal
 from typing import Union
 
@@ -13,17 +15,80 @@ from api.logger import get_exception_message, get_logger
 logger = get_logger(__name__)
 
 
+def get_rate_redis_key(cache_key):
+    coin, contract, fiat = cache_key
+    return f"rate:{coin}:{contract or ''}:{fiat}"
+
+
+async def fetch_rate(coin, cache_key):
+    rate = await coin.rate(cache_key[2])
+    fetched = time.time()
+    settings.settings.rates_cache[cache_key] = (rate, fetched)
+    await utils.redis.set_json(
+        get_rate_redis_key(cache_key), {"rate": str(rate), "time": fetched}, expire=settings.settings.rates_cache_max_age
+    )
+    return rate
+
+
+def refresh_rate(coin, cache_key):
+    # single-flight: concurrent cache misses share one daemon call
+    refreshes = settings.settings.rates_refreshes
+    if cache_key not in refreshes:
+        refreshes[cache_key] = utils.tasks.create_task(fetch_rate(coin, cache_key))
+        refreshes[cache_key].add_done_callback(lambda task: refreshes.pop(cache_key, None))
+    return refreshes[cache_key]
+
+
+async def load_shared_rate(cache_key):
+    data = await utils.redis.get_json(get_rate_redis_key(cache_key))
+    if data is None:
+        return None
+    entry = settings.settings.rates_cache[cache_key] = (Decimal(data["rate"]), data["time"])
+    return entry
+
+
+async def get_cached_rate(coin, wallet, currency):
+    ttl = settings.settings.rates_cache_ttl
+    if not ttl:
+        return await coin.rate(currency)
+    cache_key = (wallet.currency.lower(), wallet.contract, currency)
+    entry = settings.settings.rates_cache.get(cache_key)
+    if not entry or time.time() - entry[1] >= ttl:  # maybe other workers have already refreshed it
+        entry = await load_shared_rate(cache_key) or entry
+    if entry:
+        rate, fetched = entry
+        age = time.time() - fetched
+        if age < ttl:
+            return rate
+        if age < settings.settings.rates_cache_max_age:  # serve stale rate while refreshing in background
+            refresh_rate(coin, cache_key)
+            return rate
+    return await asyncio.shield(refresh_rate(coin, cache_key))
+
+
+async def get_token_metadata(coin, wallet, function):
+    # token symbol and decimals never change for a contract, so they are fetched once per worker
+    cache_key = (wallet.currency.lower(), wallet.contract, function)
+    if cache_key not in settings.settings.token_metadata:
+        settings.settings.token_metadata[cache_key] = await coin.server.readcontract(wallet.contract, function)
+    return settings.settings.token_metadata[cache_key]
+
+
+async def get_wallet_symbol(coin, wallet):
+    return await get_token_metadata(coin, wallet, "symbol") if wallet.contract else wallet.currency
+
+
 async def get_rate(wallet, currency, fallback_currency=None):
     try:
         coin = settings.settings.get_coin(wallet.currency, {"xpub": wallet.xpub, "contract": wallet.contract})
-        symbol = await coin.server.readcontract(wallet.contract, "symbol") if wallet.contract else wallet.currency
+        symbol = await get_wallet_symbol(coin, wallet)
         if symbol.lower() == currency.lower():
             return Decimal(1)
-        rate = await coin.rate(currency)
+        rate = await get_cached_rate(coin, wallet, currency)
         if math.isnan(rate) and fallback_currency:
-            rate = await coin.rate(fallback_currency)
+            rate = await get_cached_rate(coin, wallet, fallback_currency)
         if math.isnan(rate):
-            rate = await coin.rate("USD")
+            rate = await get_cached_rate(coin, wallet, "USD")
         if math.isnan(rate):
             rate = Decimal(1)  # no rate available, no conversion
     except (BitcartBaseError, HTTPException) as e:
@@ -45,7 +110,7 @@ async def get_wallet_history(model, response):
 async def get_wallet_balance(wallet) -> Union[bool, Decimal]:
     try:
         coin = settings.settings.get_coin(wallet.currency, {"xpub": wallet.xpub, "contract": wallet.contract})
-        divisibility = None if not wallet.contract else await coin.server.readcontract(wallet.contract, "decimals")
+        divisibility = None if not wallet.contract else await get_token_metadata(coin, wallet, "decimals")
         return True, divisibility, await coin.balance()
     except (BitcartBaseError, HTTPException) as e:
         logger.error(
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, Response, Security
+from fastapi import APIRouter, Depends, HTTPException, Security
 from fastapi.responses import StreamingResponse
 
 from api import crud, models, pagination, schemes, utils
@@ -23,7 +23,6 @@ async def get_invoice_by_order_id(order_id: str):
 
 @router.get("/export")
 async def export_invoices(
-    response: Response,
     pagination: pagination.Pagination = Depends(),
     export_format: str = "json",
     add_payments: bool = False,
@@ -32,27 +31,30 @@ async def export_invoices(
 ):
     if all_users and not user.is_superuser:
         raise HTTPException(403, "Not enough permissions")
-    # always full list for export
-    pagination.limit = -1
-    pagination.offset = 0
+    if pagination.cursor is None:  # always full list for export, unless it is paginated with cursors
+        pagination.limit = -1
+        pagination.offset = 0
     query = pagination.get_base_query(models.Invoice).where(models.Invoice.status == InvoiceStatus.COMPLETE)
     if not all_users:
         query = query.where(models.Invoice.user_id == user.id)
-    data = await pagination.get_list(query)
-    await utils.database.postprocess_func(data)
-    data = list(export_ext.db_to_json(data, add_payments))
+    if pagination.cursor is not None:
+        batches = export_ext.iterate_batches([await utils.database.postprocess_func(await pagination.get_list(query))])
+    else:
+        batches = export_ext.iterate_invoices(pagination.get_ordered_query(query))
     now = utils.time.now()
     filename = now.strftime(f"bitcartcc-export-%Y%m%d-%H%M%S.{export_format}")
     headers = {"Content-Disposition": f"attachment; filename={filename}"}
-    response.headers.update(headers)
+    link_header = pagination.get_link_header()
+    if link_header:
+        headers["Link"] = link_header
     if export_format == "json":
-        return data
-    else:
+        return StreamingResponse(export_ext.stream_json(batches, add_payments), media_type="application/json", headers=headers)
+    elif export_format == "ndjson":
         return StreamingResponse(
-            iter([export_ext.json_to_csv(data).getvalue()]),
-            media_type="application/csv",
-            headers=headers,
+            export_ext.stream_ndjson(batches, add_payments), media_type="application/x-ndjson", headers=headers
         )
+    else:
+        return StreamingResponse(export_ext.stream_csv(batches, add_payments), media_type="application/csv", headers=headers)
 
 
 @router.patch("/{model_id}/customer", response_model=schemes.DisplayInvoice)
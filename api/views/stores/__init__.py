@@ -12,7 +12,7 @@ async def ping_email(
     user: models.User = Security(utils.authorization.AuthDependency(), scopes=["store_management"]),
 ):
     model = await utils.database.get_object(models.Store, model_id, user)
-    return utils.email.check_ping(
+    return await utils.email.check_ping(
         model.email_host,
         model.email_port,
         model.email_user,
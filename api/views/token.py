@@ -53,6 +53,7 @@ async def patch_token(
         custom_query=models.Token.query.where(models.Token.user_id == user.id).where(models.Token.id == model_id),
     )
     await utils.database.modify_object(item, model.dict(exclude_unset=True))
+    await utils.authorization.invalidate_tokens([item.id])
     return item
 
 
@@ -67,6 +68,7 @@ async def delete_token(
         custom_query=models.Token.query.where(models.Token.user_id == user.id).where(models.Token.id == model_id),
     )
     await item.delete()
+    await utils.authorization.invalidate_tokens([item.id])  # logout
     return item
 
 
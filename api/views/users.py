@@ -35,6 +35,7 @@ async def set_settings(
     user: models.User = Security(utils.authorization.AuthDependency(), scopes=["full_control"]),
 ):
     await user.set_json_key("settings", settings)
+    await utils.authorization.invalidate_user_tokens(user.id)
     return user
 
 
@@ -45,7 +46,12 @@ utils.routing.ModelView.register(
     schemes.User,
     schemes.CreateUser,
     display_model=schemes.DisplayUser,
-    custom_methods={"post": crud.users.create_user},
+    custom_methods={
+        "post": crud.users.create_user,
+        "patch": crud.users.patch_user,
+        "delete": crud.users.delete_user,
+        "batch_action": crud.users.batch_user_action,
+    },
     post_auth=False,
     scopes={
         "get_all": ["server_management"],
@@ -14,7 +14,7 @@ class GenericWebsocketEndpoint(WebSocketEndpoint):
     MODEL: models.db.Model
     REQUIRE_AUTH: bool = True
 
-    subscriber = None
+    channel = None
 
     async def on_connect(self, websocket, **kwargs):
         await websocket.accept()
@@ -41,16 +41,13 @@ class GenericWebsocketEndpoint(WebSocketEndpoint):
             return
         if await self.maybe_exit_early(websocket):
             return
-        self.subscriber = await utils.redis.make_subscriber(f"{self.NAME}:{self.object_id}")
-        utils.tasks.create_task(self.poll_subs(websocket))
-
-    async def poll_subs(self, websocket):
-        async for message in utils.redis.listen_channel(self.subscriber):
-            await websocket.send_json(message)
+        # messages are delivered by the worker-wide subscription, no redis connection per websocket
+        self.channel = f"{self.NAME}:{self.object_id}"
+        await utils.redis.get_multiplexer().subscribe(self.channel, websocket)
 
     async def on_disconnect(self, websocket, close_code):
-        if self.subscriber:
-            await self.subscriber.unsubscribe(f"channel:{self.NAME}:{self.object_id}")
+        if self.channel:
+            utils.redis.get_multiplexer().unsubscribe(self.channel, websocket)
 
     async def maybe_exit_early(self, websocket):
         return False
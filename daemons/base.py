@@ -1,6 +1,7 @@
 import asyncio
 import json
 import os
+from collections import defaultdict
 
 from aiohttp import ClientSession, WSMsgType
 from aiohttp import __version__ as aiohttp_version
@@ -77,45 +78,86 @@ class BaseDaemon:
         if isinstance(xpub, dict):
             return xpub.get("xpub", None), xpub.get("contract", None)
 
-    async def get_handle_request_params(self, request):
-        data = await (request.json() if LEGACY_AIOHTTP else request.json(content_type=None))
+    async def get_request_data(self, request):
+        return await (request.json() if LEGACY_AIOHTTP else request.json(content_type=None))
+
+    def get_handle_request_params(self, data):
+        if not isinstance(data, dict):
+            return None, None, None, None, [], {}, JsonResponse(code=-32600, error="Invalid Request")
         method, id, params = data.get("method"), data.get("id", None), data.get("params", [])
         error = None if method else JsonResponse(code=-32601, error="Procedure not found", id=id)
         args, kwargs = parse_params(params)
         xpub, contract = self.parse_xpub(kwargs.pop("xpub", None))
         return id, method, xpub, contract, args, kwargs, error
 
-    @authenticate
-    async def handle_request(self, request):
-        id, req_method, xpub, contract, req_args, req_kwargs, error = await self.get_handle_request_params(request)
+    async def execute_call(self, params):
+        id, req_method, xpub, contract, req_args, req_kwargs, error = params
         if error:
-            return error.send()
+            return error
         return await self.execute_method(id, req_method, xpub, contract, req_args, req_kwargs)
 
+    async def execute_batch(self, batch):
+        """Execute JSON-RPC 2.0 batch request
+
+        Calls to the same wallet are executed one by one in the order they were sent,
+        to keep the same guarantees as sequential requests. Calls to different wallets,
+        and calls not requiring a wallet, are executed concurrently.
+
+        Args:
+            batch (list): list of parsed calls, as returned by get_handle_request_params
+
+        Returns:
+            list: list of response objects, in the same order as calls
+        """
+        results = [None] * len(batch)
+        queues = defaultdict(list)
+        for index, params in enumerate(batch):
+            xpub, contract = params[2], params[3]
+            queues[(xpub, contract) if xpub else index].append(index)
+
+        async def run_queue(indexes):
+            for index in indexes:
+                results[index] = (await self.execute_call(batch[index])).to_dict()
+
+        await asyncio.gather(*(run_queue(indexes) for indexes in queues.values()))
+        return results
+
+    @authenticate
+    async def handle_request(self, request):
+        data = await self.get_request_data(request)
+        if isinstance(data, list):
+            if not data:
+                return JsonResponse(code=-32600, error="Invalid Request").send()
+            return web.json_response(await self.execute_batch([self.get_handle_request_params(item) for item in data]))
+        return (await self.execute_call(self.get_handle_request_params(data))).send()
+
     @authenticate
     async def handle_websocket(self, request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)
         ws.config = {"xpub": None}
-        request.app["websockets"].add(ws)
+        ws.queue = asyncio.Queue(self.WEBSOCKET_QUEUE_SIZE)
+        sender = asyncio.ensure_future(self.send_websocket_messages(ws))
+        self.subscribe_websocket(ws, None)
         try:
             async for msg in ws:
                 if msg.type == WSMsgType.TEXT:
                     try:
                         data = msg.json()
                         if data.get("xpub"):
-                            ws.config["xpub"] = data["xpub"]
+                            self.subscribe_websocket(ws, data["xpub"])
                     except json.JSONDecodeError:
                         pass
         finally:
-            request.app["websockets"].remove(ws)
+            self.unsubscribe_websocket(ws)
+            sender.cancel()
 
     @authenticate
     async def handle_spec(self, request):
         return web.json_response(self.spec)
 
     def configure_app(self):
-        self.app["websockets"] = set()
+        self.app["websockets"] = defaultdict(set)  # xpub -> websockets, None for websockets listening on all wallets
         self.app.router.add_post("/", self.handle_request)
         self.app.router.add_get("/ws", self.handle_websocket)
         self.app.router.add_get("/spec", self.handle_spec)
@@ -130,13 +172,51 @@ class BaseDaemon:
     def build_notification(self, data, xpub):
         return {"updates": [data], "wallet": xpub, "currency": self.name}
 
+    def subscribe_websocket(self, ws, xpub):
+        self.unsubscribe_websocket(ws)
+        ws.config["xpub"] = xpub
+        self.app["websockets"][xpub].add(ws)
+
+    def unsubscribe_websocket(self, ws):
+        websockets = self.app["websockets"].get(ws.config["xpub"])
+        if websockets is not None:
+            websockets.discard(ws)
+            if not websockets:
+                del self.app["websockets"][ws.config["xpub"]]
+
+    def get_websockets(self, xpub):
+        websockets = set(self.app["websockets"].get(None, ()))
+        if xpub:
+            websockets.update(self.app["websockets"].get(xpub, ()))
+        return websockets
+
+    def queue_notification(self, websockets, data, xpub):
+        if not websockets:
+            return
+        payload = json.dumps(self.build_notification(data, xpub))  # serialized once for all websockets
+        for ws in list(websockets):  # stalled websockets are unsubscribed while iterating
+            if ws.closed:
+                continue
+            try:
+                ws.queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                # a stalled client is disconnected instead of buffering without limit, it resyncs on reconnect
+                if self.VERBOSE:
+                    print(f"Closing websocket with {ws.queue.qsize()} pending messages")
+                self.unsubscribe_websocket(ws)
+                asyncio.ensure_future(ws.close())
+
+    async def send_websocket_messages(self, ws):
+        # each websocket has its own sender, so that a slow client doesn't delay the others
+        while not ws.closed:
+            payload = await ws.queue.get()
+            try:
+                await ws.send_str(payload)
+            except Exception:
+                break
+
     async def notify_websockets(self, data, xpub):
-        coros = [
-            ws.send_json(self.build_notification(data, xpub))
-            for ws in self.app["websockets"]
-            if not ws.closed and not ws.config["xpub"] or ws.config["xpub"] == xpub
-        ]
-        coros and await asyncio.gather(*coros)
+        self.queue_notification(self.get_websockets(xpub), data, xpub)
         return True
 
     ### Overridable methods for completely custom coins ###
@@ -154,6 +234,7 @@ class BaseDaemon:
         self.VERBOSE = self.env("DEBUG", cast=bool, default=False)
         self.NET = self.env("NETWORK", default="mainnet")
         self.DEFAULT_CURRENCY = self.env("FIAT_CURRENCY", default="USD")
+        self.WEBSOCKET_QUEUE_SIZE = self.env("WEBSOCKET_QUEUE_SIZE", cast=int, default=1000)
 
     async def on_startup(self, app):
         """Create essential objects for daemon operation here
@@ -174,7 +255,7 @@ class BaseDaemon:
     async def execute_method(self, id, req_method, xpub, contract, req_args, req_kwargs):
         """Main entrypoint for executing methods your daemon provides
 
-        Return JsonResponse(...).send() there to avoid building message manually
+        Return JsonResponse(...) there to avoid building message manually
 
         Args:
             id (int): jsonrpc id, return as is
@@ -185,5 +266,5 @@ class BaseDaemon:
             req_kwargs (dict): list of named arguments to pass
 
         Returns:
-            web.Response: response containing details about method execution
+            JsonResponse: response containing details about method execution
         """
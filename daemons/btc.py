@@ -11,11 +11,14 @@ from urllib.parse import urlparse
 from base import BaseDaemon
 from utils import JsonResponse, async_partial, cached, format_satoshis, get_exception_message, hide_logging_errors, rpc
 
+REQUEST_STATUS_FIELDS = ("status", "status_str", "confirmations")  # returned by bulk request lookups
+
 
 class BTCDaemon(BaseDaemon):
     name = "BTC"
     BASE_SPEC_FILE = "daemons/spec/btc.json"
     DEFAULT_PORT = 5000
+    ALIASES = {"get_invoices": "get_requests"}
 
     # specify the module in subclass to use features from
     electrum: ModuleType
@@ -278,22 +281,22 @@ class BTCDaemon(BaseDaemon):
     async def execute_method(self, id, req_method, xpub, contract, req_args, req_kwargs):
         wallet, cmd, error = await self._get_wallet(id, req_method, xpub)
         if error:
-            return error.send()
+            return error
         exec_method, custom, error = await self.get_exec_method(cmd, id, req_method)
         if error:
-            return error.send()
+            return error
         if self.get_method_data(req_method, custom).requires_wallet and not xpub:
-            return JsonResponse(code=-32000, error="Wallet not loaded", id=id).send()
+            return JsonResponse(code=-32000, error="Wallet not loaded", id=id)
         try:
             result = await self.get_exec_result(
                 xpub, req_method, req_args, req_kwargs, exec_method, custom, wallet=wallet, config=self.electrum_config
             )
-            return JsonResponse(result=result, id=id).send()
+            return JsonResponse(result=result, id=id)
         except BaseException as e:
             if self.VERBOSE:
                 print(traceback.format_exc())
             error_message = self.get_exception_message(e)
-            return JsonResponse(code=self.get_error_code(error_message), error=error_message, id=id).send()
+            return JsonResponse(code=self.get_error_code(error_message), error=error_message, id=id)
 
     async def _process_events(self, event, *args):
         mapped_event = self.EVENT_MAPPING.get(event)
@@ -463,6 +466,29 @@ class BTCDaemon(BaseDaemon):
             raise Exception("Invoice not found")
         return value
 
+    @rpc(requires_wallet=True)
+    def get_requests(self, keys, wallet):
+        wallet_obj = self.wallets[wallet]["wallet"]
+        requests = {}
+        for key in keys:
+            request = wallet_obj.get_formatted_request(key)
+            if request:
+                requests[key] = {field: request[field] for field in REQUEST_STATUS_FIELDS if field in request}
+        return requests
+
+    @rpc(requires_wallet=True)
+    def get_request_heights(self, keys, wallet):
+        wallet_obj = self.wallets[wallet]["wallet"]
+        local_height = self.network.get_local_height()
+        heights = {}
+        for key in keys:
+            request = wallet_obj.get_formatted_request(key)
+            if not request:
+                continue
+            confirmations = request.get("confirmations", 0)
+            heights[key] = local_height - confirmations + 1 if confirmations > 0 else None
+        return heights
+
     def get_address_balance(self, address, wallet):
         return self.wallets[wallet]["wallet"].get_addr_balance(address)
 
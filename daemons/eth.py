@@ -26,6 +26,7 @@ from storage import decimal_to_string
 from utils import (
     CastingDataclass,
     JsonResponse,
+    UpdatesBuffer,
     exception_retry_middleware,
     get_exception_message,
     hide_logging_errors,
@@ -45,6 +46,7 @@ from web3.providers.rpc import get_default_http_endpoint
 
 Account.enable_unaudited_hdwallet_features()
 
+TOKEN_METADATA_FUNCTIONS = ("name", "symbol", "decimals")  # immutable for a contract, cached in config
 NO_HISTORY_MESSAGE = "We don't access transaction history to remain lightweight"
 WRITE_DOWN_SEED_MESSAGE = "Please keep your seed in a safe place; if you lose it, you will not be able to restore your wallet."
 ONE_ADDRESS_MESSAGE = "We only support one address per wallet as it is common in ethereum ecosystem"
@@ -54,7 +56,8 @@ NO_MASTER_KEYS_MESSAGE = "As we use only one address per wallet, address keys ar
 EIP1559_PARAMS = ("maxFeePerGas", "maxPriorityFeePerGas")
 FEE_PARAMS = EIP1559_PARAMS + ("gasPrice", "gas")
 
-CHUNK_SIZE = 30
+DEFAULT_CHUNK_SIZE = 30  # blocks fetched in one JSON-RPC batch request
+PREFETCH_CHUNKS = 4  # chunks fetched ahead while the previous ones are processed
 AMOUNTGEN_LIMIT = 10**9
 
 TX_DEFAULT_GAS = 21000
@@ -81,6 +84,11 @@ STR_TO_BOOL_MAPPING = {
     "0": False,
 }  # common str -> bool conversions
 
+
+class InvalidBatchResponse(Exception):
+    pass
+
+
 # storage
 
 with open("daemons/abi/erc20.json") as f:
@@ -137,10 +145,6 @@ def to_dict(obj):
     return json.loads(json.dumps(obj, cls=JSONEncoder))
 
 
-def get_exception_traceback(exc):
-    return "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
-
-
 def get_wallet_key(xpub, contract=None):
     key = xpub
     if contract:
@@ -169,6 +173,7 @@ class Transaction:
     hash: str
     to: str
     value: int
+    height: int = None
 
 
 @dataclass
@@ -250,6 +255,7 @@ class Invoice(CastingDataclass, StoredObject):
     status: int = 0
     tx_hash: str = None
     contract: str = None
+    tx_height: int = None
 
     @property
     def status_str(self):
@@ -307,9 +313,8 @@ class Wallet:
 
         self.running = True
         # process onchain transactions
-        for block in blocks:
-            for tx in block:
-                await process_transaction(tx)
+        for block_number, transactions in blocks:
+            await daemon.process_transactions(block_number, transactions, {self.address.lower()})
         current_height = await self.web3.eth.block_number
         if self.contract:
             # process token transactions
@@ -418,16 +423,20 @@ class Wallet:
         if req.tx_hash:
             d["tx_hash"] = req.tx_hash
             d["contract"] = req.contract
-            d["confirmations"] = (
-                await self.web3.eth.block_number
-                - (await self.web3.eth.get_transaction_receipt(req.tx_hash))["blockNumber"]
-                + 1
-            )
+            d["confirmations"] = await self.web3.eth.block_number - await self.get_request_height(req) + 1
         d["amount_wei"] = to_wei(req.amount, self.divisibility)
         d["address"] = req.address
         d["URI"] = await self.get_request_url(req)
         return d
 
+    async def get_request_height(self, req):
+        if not req.tx_hash:
+            return None
+        if req.tx_height is None:  # requests paid before tx heights were stored
+            req.tx_height = (await self.web3.eth.get_transaction_receipt(req.tx_hash))["blockNumber"]
+            self.save_db()
+        return req.tx_height
+
     def get_request(self, key):
         try:
             amount = Decimal(key)
@@ -474,9 +483,9 @@ class Wallet:
             return
         self.set_request_status(req.id, PR_EXPIRED)
 
-    async def process_payment(self, wallet, amount, tx_hash, contract=None):
+    async def process_payment(self, wallet, amount, tx_hash, contract=None, tx_height=None):
         try:
-            req = self.set_request_status(amount, PR_PAID, tx_hash=tx_hash, contract=contract)
+            req = self.set_request_status(amount, PR_PAID, tx_hash=tx_hash, contract=contract, tx_height=tx_height)
             await daemon.trigger_event(
                 {
                     "event": "new_payment",
@@ -495,23 +504,28 @@ class Wallet:
 
 async def process_transaction(tx, contract=None, divisibility=18):
     to = tx.to
-    amount = from_wei(tx.value, divisibility)
     if to not in daemon.addresses:
         return
+    amount = from_wei(tx.value, divisibility)
     for wallet in daemon.addresses[to]:
         wallet_contract = daemon.wallets[wallet].contract.address if daemon.wallets[wallet].contract else None
         if contract != wallet_contract:
             continue
         await daemon.trigger_event({"event": "new_transaction", "tx": tx.hash}, wallet)
         if amount in daemon.wallets[wallet].used_amounts:
-            daemon.loop.create_task(daemon.wallets[wallet].process_payment(wallet, amount, tx.hash, contract))
+            daemon.loop.create_task(daemon.wallets[wallet].process_payment(wallet, amount, tx.hash, contract, tx.height))
 
 
 async def check_contract_logs(contract, divisibility, from_block=None, to_block=None):
     try:
         for tx_data in await contract.events.Transfer.getLogs(fromBlock=from_block, toBlock=to_block):
             try:
-                tx = Transaction(str(tx_data["transactionHash"].hex()), tx_data["args"]["to"], tx_data["args"]["value"])
+                tx = Transaction(
+                    str(tx_data["transactionHash"].hex()),
+                    tx_data["args"]["to"],
+                    tx_data["args"]["value"],
+                    tx_data["blockNumber"],
+                )
                 await process_transaction(tx, contract.address, divisibility)
             except Exception:
                 if daemon.VERBOSE:
@@ -532,6 +546,7 @@ class ETHDaemon(BaseDaemon):
         "clear_invoices": "clear_requests",
         "commands": "help",
         "get_invoice": "getrequest",
+        "get_invoices": "get_requests",
         "get_transaction": "gettransaction",
         "getaddressbalance_wallet": "getaddressbalance",
         "getunusedaddress": "getaddress",
@@ -564,6 +579,7 @@ class ETHDaemon(BaseDaemon):
         self.config_path = os.path.join(self.get_datadir(), "config")
         self.config = ConfigDB(self.config_path)
         self.contract_heights = self.config.get_dict("contract_heights")
+        self.token_metadata = self.config.get_dict("token_metadata")
         self.web3 = Web3(
             Web3.AsyncHTTPProvider(self.SERVER, request_kwargs={"timeout": 5 * 60}),
             modules={
@@ -574,10 +590,14 @@ class ETHDaemon(BaseDaemon):
         )
         self.web3.middleware_onion.inject(async_geth_poa_middleware, layer=0)
         self.web3.middleware_onion.inject(async_http_retry_request_middleware, layer=0)
-        self.get_block_safe = exception_retry_middleware(self.web3.eth.get_block, (BlockNotFound,), self.VERBOSE)
+        self.batch_size = self.CHUNK_SIZE  # lowered if the node rejects batch requests of this size
+        self.get_blocks_safe = exception_retry_middleware(
+            self.get_blocks, (BlockNotFound, AsyncClientError, asyncio.TimeoutError), self.VERBOSE
+        )
         # initialize wallet storages
         self.wallets = {}
         self.addresses = defaultdict(set)
+        self.watched_addresses = set()  # lowercase, as in raw JSON-RPC responses
         self.wallets_updates = {}
         # initialize not yet created network
         self.running = True
@@ -589,6 +609,8 @@ class ETHDaemon(BaseDaemon):
         self.SERVER = self.env("SERVER", default=get_default_http_endpoint())
         max_sync_hours = self.env("MAX_SYNC_HOURS", cast=int, default=1)
         self.MAX_SYNC_BLOCKS = max_sync_hours * self.DEFAULT_MAX_SYNC_BLOCKS
+        self.UPDATES_BUFFER_SIZE = self.env("UPDATES_BUFFER_SIZE", cast=int, default=1000)
+        self.CHUNK_SIZE = max(1, self.env("CHUNK_SIZE", cast=int, default=DEFAULT_CHUNK_SIZE))
 
     async def on_startup(self, app):
         await super().on_startup(app)
@@ -621,42 +643,113 @@ class ETHDaemon(BaseDaemon):
                     print(traceback.format_exc())
             await asyncio.sleep(self.FX_FETCH_TIME)
 
-    async def process_block(self, start_height, end_height):
-        for block_number in range(start_height, end_height + 1):
+    def get_block_request(self, block_number):
+        return {"jsonrpc": "2.0", "id": block_number, "method": "eth_getBlockByNumber", "params": [hex(block_number), True]}
+
+    async def send_rpc_request(self, payload):
+        async with self.client_session.post(self.SERVER, json=payload) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def get_block(self, block_number):
+        result = await self.send_rpc_request(self.get_block_request(block_number))
+        return {block_number: result.get("result") if isinstance(result, dict) else None}
+
+    async def get_blocks_batch(self, block_numbers):
+        # one JSON-RPC batch request instead of a request per block
+        results = await self.send_rpc_request([self.get_block_request(block_number) for block_number in block_numbers])
+        # nodes without batch support, or with a lower batch limit, return an error object or errors for each request
+        if not isinstance(results, list) or len(results) < len(block_numbers) or any("error" in result for result in results):
+            raise InvalidBatchResponse(f"Invalid batch response: {results}")
+        return {result["id"]: result.get("result") for result in results}
+
+    async def fetch_blocks(self, block_numbers):
+        if len(block_numbers) == 1:
+            return await self.get_block(block_numbers[0])
+        try:
+            return await self.get_blocks_batch(block_numbers)
+        except InvalidBatchResponse:
+            self.batch_size = min(self.batch_size, len(block_numbers) // 2)  # smaller batches are used from now on
+            if self.VERBOSE:
+                print(f"Batch request of {len(block_numbers)} blocks failed, using batches of {self.batch_size} blocks")
+        return await self.fetch_blocks_batches(block_numbers)
+
+    async def fetch_blocks_batches(self, block_numbers):
+        blocks = {}
+        for batch in await asyncio.gather(
+            *(
+                self.fetch_blocks(block_numbers[index : index + self.batch_size])
+                for index in range(0, len(block_numbers), self.batch_size)
+            )
+        ):
+            blocks.update(batch)
+        return blocks
+
+    async def get_blocks(self, block_numbers):
+        blocks = await self.fetch_blocks_batches(block_numbers)
+        for block_number in block_numbers:
+            if not blocks.get(block_number):  # not yet available on the node, or an error
+                raise BlockNotFound(f"Block {block_number} not found")
+        return [blocks[block_number] for block_number in block_numbers]
+
+    async def process_transactions(self, block_number, transactions, addresses):
+        for to, tx_hash, value in transactions:
+            if to not in addresses:  # most transactions are not ours, so they are skipped before any conversions
+                continue
             try:
-                await self.trigger_event({"event": "new_block", "height": block_number}, None)
-                block = (await self.get_block_safe(block_number, full_transactions=True))["transactions"]
-                transactions = []
-                for tx_data in block:
-                    try:
-                        tx = Transaction(str(tx_data["hash"].hex()), tx_data["to"], tx_data["value"])
-                        transactions.append(tx)
-                        await process_transaction(tx)
-                    except Exception:
-                        if self.VERBOSE:
-                            print(f"Error processing transaction {tx_data['hash'].hex()}:")
-                            print(traceback.format_exc())
-                self.latest_blocks.append(transactions)
+                await process_transaction(Transaction(tx_hash, Web3.toChecksumAddress(to), int(value, 16), block_number))
             except Exception:
                 if self.VERBOSE:
-                    print(f"Error processing block {block_number}:")
+                    print(f"Error processing transaction {tx_hash}:")
                     print(traceback.format_exc())
 
+    async def process_block(self, block_number, block):
+        # (to, hash, value) of all transfers are kept, so that wallets loaded later can check the latest blocks
+        transactions = [
+            (tx_data["to"], tx_data["hash"], tx_data["value"]) for tx_data in block["transactions"] if tx_data["to"]
+        ]
+        self.latest_blocks.append((block_number, transactions))
+        await self.process_transactions(block_number, transactions, self.watched_addresses)
+
+    async def process_blocks(self, start_height, end_height):
+        # chunks are fetched concurrently, up to PREFETCH_CHUNKS ahead, but processed in order,
+        # and latest_height is saved after each chunk, so that after a crash syncing continues from the right block
+        chunks = iter(
+            range(block_number, min(block_number + self.CHUNK_SIZE - 1, end_height) + 1)
+            for block_number in range(start_height, end_height + 1, self.CHUNK_SIZE)
+        )
+        fetching = deque()
+
+        def prefetch():
+            for chunk in chunks:
+                fetching.append((chunk, asyncio.ensure_future(self.get_blocks_safe(chunk))))
+                if len(fetching) >= PREFETCH_CHUNKS:
+                    break
+
+        prefetch()
+        try:
+            while fetching:
+                chunk, task = fetching.popleft()
+                blocks = await task
+                prefetch()
+                for block_number, block in zip(chunk, blocks):
+                    await self.process_block(block_number, block)
+                self.latest_height = chunk[-1]
+        finally:
+            for _, task in fetching:
+                task.cancel()
+
     async def process_pending(self):
         while self.running:
             try:
                 current_height = await self.web3.eth.block_number
-                tasks = []
-                # process at max 300 blocks since last processed block, fetched by chunks
-                for block_number in range(
-                    self.latest_height + 1, min(self.latest_height + self.MAX_SYNC_BLOCKS, current_height) + 1, CHUNK_SIZE
-                ):
-                    tasks.append(self.process_block(block_number, min(block_number + CHUNK_SIZE - 1, current_height)))
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-                if self.VERBOSE:
-                    for task in results:
-                        if isinstance(task, Exception):
-                            print(get_exception_traceback(task))
+                if current_height > self.latest_height:
+                    # process at max 300 blocks since last processed block, older ones are skipped
+                    await self.process_blocks(
+                        self.latest_height + 1, min(self.latest_height + self.MAX_SYNC_BLOCKS, current_height)
+                    )
+                    # one event for all blocks processed in this cycle
+                    await self.trigger_event({"event": "new_block", "height": current_height}, None)
                 self.latest_height = current_height
                 self.synchronized = True  # set it once, as we just need to ensure initial sync was done
             except Exception:
@@ -710,10 +803,20 @@ class ETHDaemon(BaseDaemon):
             await asyncio.sleep(self.BLOCK_TIME)
 
     async def trigger_event(self, data, wallet):
-        for key in self.wallets:
-            if not wallet or wallet == key:
-                await self.notify_websockets(data, key)
-                self.wallets_updates[key].append(data)
+        if not wallet:
+            return await self.broadcast_event(data)
+        if wallet in self.wallets:
+            await self.notify_websockets(data, wallet)
+            self.wallets_updates[wallet].append(data)
+
+    async def broadcast_event(self, data):
+        # events of all wallets are serialized once and sent once to the websockets listening on all wallets,
+        # instead of once per loaded wallet; websockets of a single wallet still get it with their wallet set
+        for updates in self.wallets_updates.values():
+            updates.append(data)
+        self.queue_notification(self.get_websockets(None), data, None)
+        for xpub in [xpub for xpub in self.app["websockets"] if xpub in self.wallets]:
+            self.queue_notification(set(self.app["websockets"].get(xpub, ())), data, xpub)
 
     async def on_shutdown(self, app):
         self.running = False
@@ -764,8 +867,9 @@ class ETHDaemon(BaseDaemon):
         db = WalletDB(storage.read())
         wallet = Wallet(self.web3, db, storage)
         self.wallets[wallet_key] = wallet
-        self.wallets_updates[wallet_key] = []
+        self.wallets_updates[wallet_key] = UpdatesBuffer(self.UPDATES_BUFFER_SIZE)
         self.addresses[wallet.address].add(wallet_key)
+        self.watched_addresses.add(wallet.address.lower())
         await self.add_contract(contract, wallet_key)
         await wallet.start(self.latest_blocks.copy())
         return wallet
@@ -814,20 +918,20 @@ class ETHDaemon(BaseDaemon):
     async def execute_method(self, id, req_method, xpub, contract, req_args, req_kwargs):
         wallet, error = await self._get_wallet(id, req_method, xpub, contract)
         if error:
-            return error.send()
+            return error
         exec_method, error = await self.get_exec_method(id, req_method)
         if error:
-            return error.send()
+            return error
         if self.get_method_data(req_method).requires_wallet and not xpub:
-            return JsonResponse(code=-32000, error="Wallet not loaded", id=id).send()
+            return JsonResponse(code=-32000, error="Wallet not loaded", id=id)
         try:
             result = await self.get_exec_result(get_wallet_key(xpub, contract), req_args, req_kwargs, exec_method)
-            return JsonResponse(result=result, id=id).send()
+            return JsonResponse(result=result, id=id)
         except BaseException as e:
             if self.VERBOSE:
                 print(traceback.format_exc())
             error_message = self.get_exception_message(e)
-            return JsonResponse(code=self.get_error_code(error_message), error=error_message, id=id).send()
+            return JsonResponse(code=self.get_error_code(error_message), error=error_message, id=id)
 
     ### Methods ###
 
@@ -860,6 +964,7 @@ class ETHDaemon(BaseDaemon):
         self.wallets[wallet].stop(block_number)
         del self.wallets_updates[wallet]
         del self.addresses[self.wallets[wallet].address]
+        self.watched_addresses.discard(self.wallets[wallet].address.lower())
         del self.wallets[wallet]
         return True
 
@@ -919,6 +1024,28 @@ class ETHDaemon(BaseDaemon):
             fee = from_wei(tx_dict["gasPrice"]) * tx_dict["gas"]
         return to_dict(fee)
 
+    @rpc(requires_wallet=True, requires_network=True)
+    async def get_requests(self, keys, wallet):
+        current_height = await self.web3.eth.block_number
+        requests = {}
+        for key in keys:
+            req = self.wallets[wallet].get_request(key)
+            if not req:
+                continue
+            requests[key] = {"status": req.status, "status_str": req.status_str}
+            if req.tx_hash:
+                requests[key]["confirmations"] = current_height - await self.wallets[wallet].get_request_height(req) + 1
+        return requests
+
+    @rpc(requires_wallet=True, requires_network=True)
+    async def get_request_heights(self, keys, wallet):
+        heights = {}
+        for key in keys:
+            req = self.wallets[wallet].get_request(key)
+            if req:
+                heights[key] = await self.wallets[wallet].get_request_height(req)
+        return heights
+
     @rpc
     def get_tokens(self, wallet=None):
         return self.TOKENS
@@ -940,8 +1067,11 @@ class ETHDaemon(BaseDaemon):
     @rpc(requires_wallet=True, requires_network=True)
     def get_updates(self, wallet):
         updates = self.wallets_updates[wallet]
-        self.wallets_updates[wallet] = []
-        return updates
+        if updates.dropped:
+            if self.VERBOSE:
+                print(f"Dropped {updates.dropped} updates of wallet {wallet}, as they were not fetched in time")
+            updates.dropped = 0
+        return updates.pop_all()
 
     @rpc
     def getabi(self, wallet=None):
@@ -1178,7 +1308,15 @@ class ETHDaemon(BaseDaemon):
     @rpc(requires_network=True)
     async def readcontract(self, address, function, *args, **kwargs):
         exec_function = self.load_contract_exec_function(address, function, *args, **kwargs)
-        return await exec_function.call()
+        if function not in TOKEN_METADATA_FUNCTIONS or args:
+            return await exec_function.call()
+        if exec_function.address not in self.token_metadata:
+            self.token_metadata[exec_function.address] = {}
+        metadata = self.token_metadata[exec_function.address]
+        if function not in metadata:
+            metadata[function] = await exec_function.call()
+            self.config.write(self.config.storage)
+        return metadata[function]
 
     @rpc
     async def recommended_fee(self, target=None, wallet=None):  # disable fee estimation as it's unclear what to show
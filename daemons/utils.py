@@ -6,6 +6,7 @@ import sys
 import time
 import traceback
 from base64 import b64decode
+from collections import deque
 from contextlib import contextmanager
 from dataclasses import dataclass
 from decimal import Decimal
@@ -118,19 +119,44 @@ class JsonResponse:
     error: Optional[str] = None
     result: Optional[Any] = None
 
-    def send(self):
+    def to_dict(self):
         if self.result is not None and self.error is not None:
             raise ValueError(f"result={self.result} and error={self.error} cannot be both set")
         if self.error is not None:
-            return self.send_error_response()
+            return {"jsonrpc": "2.0", "error": {"code": self.code, "message": self.error}, "id": self.id}
         else:
-            return self.send_ok_response()
+            return {"jsonrpc": "2.0", "result": self.result, "id": self.id}
+
+    def send(self):
+        return web.json_response(self.to_dict())
+
+
+class UpdatesBuffer:
+    """Ring buffer of wallet events not yet fetched via get_updates
+
+    When nobody polls the updates, the oldest events are dropped and counted instead of growing without limit.
+    Consecutive new_block events are coalesced, as only the latest height is useful.
+    """
+
+    def __init__(self, maxlen):
+        self.events = deque(maxlen=maxlen)
+        self.dropped = 0
+
+    def append(self, data):
+        if data.get("event") == "new_block" and self.events and self.events[-1].get("event") == "new_block":
+            self.events[-1] = data
+            return
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(data)
 
-    def send_error_response(self):
-        return web.json_response({"jsonrpc": "2.0", "error": {"code": self.code, "message": self.error}, "id": self.id})
+    def pop_all(self):
+        events = list(self.events)
+        self.events.clear()
+        return events
 
-    def send_ok_response(self):
-        return web.json_response({"jsonrpc": "2.0", "result": self.result, "id": self.id})
+    def __len__(self):
+        return len(self.events)
 
 
 async def periodic_task(self, process_func, interval):
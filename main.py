@@ -7,6 +7,7 @@ from starlette.middleware.cors import CORSMiddleware
 from starlette.responses import PlainTextResponse
 from starlette.staticfiles import StaticFiles
 
+from api import events
 from api import settings as settings_module
 from api import utils
 from api.constants import VERSION
@@ -64,9 +65,11 @@ def get_app():
     async def startup():
         app.ctx_token = settings_module.settings_ctx.set(app.settings)  # for events context
         await settings_module.init()
+        app.events_listener = utils.tasks.create_task(events.start_listening())  # i.e. cache invalidations
 
     @app.on_event("shutdown")
     async def shutdown():
+        app.events_listener.cancel()
         await app.settings.shutdown()
         settings_module.settings_ctx.reset(app.ctx_token)
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Measures JSON-RPC throughput of the base daemon for single and batch requests against a stub daemon
+# Run from the repository root: python3 scripts/benchmark-batch-rpc.py [total_calls]
+import asyncio
+import os
+import sys
+import time
+
+from aiohttp import BasicAuth, ClientSession, web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "daemons"))
+
+from base import BaseDaemon  # noqa: E402
+from utils import JsonResponse, rpc  # noqa: E402
+
+BATCH_SIZES = [1, 10, 100]
+DEFAULT_TOTAL_CALLS = 10000
+
+
+class StubDaemon(BaseDaemon):
+    name = "STUB"
+    BASE_SPEC_FILE = "daemons/spec/btc.json"
+    DEFAULT_PORT = 5099
+
+    @rpc
+    async def echo(self, value, wallet=None):
+        return value
+
+    async def execute_method(self, id, req_method, xpub, contract, req_args, req_kwargs):
+        if req_method not in self.supported_methods:
+            return JsonResponse(code=-32601, error="Procedure not found", id=id)
+        result = await self.supported_methods[req_method](*req_args, wallet=xpub, **req_kwargs)
+        return JsonResponse(result=result, id=id)
+
+
+def make_call(call_id):
+    return {"jsonrpc": "2.0", "id": call_id, "method": "echo", "params": [call_id]}
+
+
+async def run_benchmark(session, url, payload, calls_per_request, total_calls):
+    requests_count = max(1, total_calls // calls_per_request)
+    start = time.perf_counter()
+    for _ in range(requests_count):
+        async with session.post(url, json=payload) as response:
+            await response.json()
+    elapsed = time.perf_counter() - start
+    return requests_count / elapsed, requests_count * calls_per_request / elapsed
+
+
+async def main():
+    total_calls = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_TOTAL_CALLS
+    daemon = StubDaemon()
+    runner = web.AppRunner(daemon.app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", daemon.PORT)
+    await site.start()
+    url = f"http://127.0.0.1:{daemon.PORT}"
+    try:
+        async with ClientSession(auth=BasicAuth(daemon.LOGIN, daemon.PASSWORD)) as session:
+            print(f"{'mode':<12}{'requests/s':>14}{'calls/s':>14}")
+            rps, cps = await run_benchmark(session, url, make_call(0), 1, total_calls)
+            print(f"{'single':<12}{rps:>14.1f}{cps:>14.1f}")
+            for batch_size in BATCH_SIZES:
+                payload = [make_call(i) for i in range(batch_size)]
+                rps, cps = await run_benchmark(session, url, payload, batch_size, total_calls)
+                print(f"{f'batch {batch_size}':<12}{rps:>14.1f}{cps:>14.1f}")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Measures blocks/s of ETH daemon block processing, compared to converting every transaction before the address check
+# Uses blocks recorded with eth_getBlockByNumber(number, true) if a JSON file with a list of them is passed,
+# otherwise generates mainnet-sized blocks. Run from the repository root:
+# python3 scripts/benchmark-eth-blocks.py [wallets=1000] [blocks=300] [txs_per_block=200] [blocks_file]
+import asyncio
+import json
+import os
+import secrets
+import sys
+import time
+from collections import defaultdict, deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "daemons"))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import eth  # noqa: E402
+from web3 import Web3  # noqa: E402
+
+ROUNDS = 5
+
+
+def random_address():
+    return f"0x{secrets.token_hex(20)}"
+
+
+def generate_blocks(blocks, txs_per_block):
+    return [
+        {
+            "number": hex(number),
+            "transactions": [
+                {
+                    "hash": f"0x{secrets.token_hex(32)}",
+                    "to": random_address() if i % 50 else None,  # some contract creations
+                    "value": hex(secrets.randbelow(10**20)),
+                    "input": f"0x{secrets.token_hex(68)}",
+                }
+                for i in range(txs_per_block)
+            ],
+        }
+        for number in range(blocks)
+    ]
+
+
+def create_daemon(blocks, wallets):
+    daemon = eth.ETHDaemon.__new__(eth.ETHDaemon)
+    daemon.VERBOSE = False
+    daemon.wallets = {}
+    daemon.addresses = defaultdict(set)
+    daemon.watched_addresses = set()
+    for _ in range(wallets):
+        address = Web3.toChecksumAddress(random_address())
+        daemon.addresses[address]  # loaded wallets without matching transactions
+        daemon.watched_addresses.add(address.lower())
+    daemon.latest_blocks = deque(maxlen=len(blocks))
+    eth.daemon = daemon
+    return daemon
+
+
+async def process_block_legacy(daemon, block_number, block):
+    # every transaction converted before checking the address
+    transactions = []
+    for tx_data in block["transactions"]:
+        to = Web3.toChecksumAddress(tx_data["to"]) if tx_data["to"] else None
+        tx = eth.Transaction(tx_data["hash"], to, int(tx_data["value"], 16), block_number)
+        transactions.append(tx)
+        eth.from_wei(tx.value)
+        daemon.addresses.get(tx.to)
+    daemon.latest_blocks.append(transactions)
+
+
+async def run_benchmark(name, process_block, daemon, blocks):
+    best = 0
+    for _ in range(ROUNDS):
+        daemon.latest_blocks.clear()
+        start = time.perf_counter()
+        for block in blocks:
+            await process_block(int(block["number"], 16), block)
+        best = max(best, len(blocks) / (time.perf_counter() - start))
+    txs = sum(len(block["transactions"]) for block in blocks)
+    print(f"{name:>8}: {best:10.1f} blocks/s, {best * txs / len(blocks):12.1f} txs/s")
+
+
+async def main(blocks, wallets):
+    daemon = create_daemon(blocks, wallets)
+    print(f"{len(blocks)} blocks, {sum(len(block['transactions']) for block in blocks)} transactions, {wallets} wallets")
+    await run_benchmark("legacy", lambda number, block: process_block_legacy(daemon, number, block), daemon, blocks)
+    await run_benchmark("current", daemon.process_block, daemon, blocks)
+
+
+if __name__ == "__main__":
+    wallets = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    if len(sys.argv) > 4:
+        with open(sys.argv[4]) as f:
+            blocks = json.load(f)
+    else:
+        blocks_count = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+        blocks = generate_blocks(blocks_count, int(sys.argv[3]) if len(sys.argv) > 3 else 200)
+    asyncio.run(main(blocks, wallets))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Measures POST /invoices latency for a store with N wallets, served by a stub BTC daemon with artificial latency
+# Start the API with BTC_PORT pointing to the stub port first, then run from the repository root:
+# python3 scripts/benchmark-invoice-creation.py API_URL TOKEN [wallets=6] [invoices=20] [latency_ms=100]
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+
+from aiohttp import ClientSession, web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "daemons"))
+
+from base import BaseDaemon  # noqa: E402
+from utils import JsonResponse  # noqa: E402
+
+STUB_PORT = int(os.environ.get("BTC_PORT", 5000))
+
+
+def make_request(amount=1, memo="", expiration=900, **kwargs):
+    request_id = uuid.uuid4().hex
+    address = f"bc1q{request_id[:38]}"
+    return {
+        "id": request_id,
+        "address": address,
+        "URI": f"bitcoin:{address}?amount={amount}",
+        "amount_BTC": str(amount),
+        "message": memo,
+        "expiration": expiration,
+        "status": 0,
+        "status_str": "Unpaid",
+    }
+
+
+class StubDaemon(BaseDaemon):
+    name = "STUB"
+    BASE_SPEC_FILE = "daemons/spec/btc.json"
+    DEFAULT_PORT = STUB_PORT
+    LATENCY = 0.1
+
+    RESPONSES = {
+        "exchange_rate": lambda *args, **kwargs: "50000",
+        "recommended_fee": lambda *args, **kwargs: 1024,
+        "validatekey": lambda *args, **kwargs: True,
+        "getbalance": lambda *args, **kwargs: {"confirmed": "0", "unconfirmed": "0", "unmatured": "0", "lightning": "0"},
+        "add_request": make_request,
+        "get_request": lambda key, **kwargs: make_request(),
+    }
+
+    async def execute_method(self, id, req_method, xpub, contract, req_args, req_kwargs):
+        await asyncio.sleep(self.LATENCY)
+        handler = self.RESPONSES.get(req_method)
+        return JsonResponse(result=handler(*req_args, **req_kwargs) if handler else None, id=id)
+
+
+async def api_call(session, method, url, **kwargs):
+    async with session.request(method, url, **kwargs) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+async def main():
+    if len(sys.argv) < 3:
+        sys.exit(f"Usage: {sys.argv[0]} API_URL TOKEN [wallets] [invoices] [latency_ms]")
+    api_url, token = sys.argv[1].rstrip("/"), sys.argv[2]
+    wallets_count = int(sys.argv[3]) if len(sys.argv) > 3 else 6
+    invoices_count = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+    StubDaemon.LATENCY = (int(sys.argv[5]) if len(sys.argv) > 5 else 100) / 1000
+    daemon = StubDaemon()
+    runner = web.AppRunner(daemon.app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", daemon.PORT)
+    await site.start()
+    wallet_ids = []
+    try:
+        async with ClientSession(headers={"Authorization": f"Bearer {token}"}) as session:
+            for i in range(wallets_count):
+                data = {"name": f"bench_{i}", "xpub": f"xpub_bench_{uuid.uuid4().hex}"}
+                wallet = await api_call(session, "POST", f"{api_url}/wallets", json=data)
+                wallet_ids.append(wallet["id"])
+            store = await api_call(session, "POST", f"{api_url}/stores", json={"name": "bench", "wallets": wallet_ids})
+            timings = []
+            for _ in range(invoices_count):
+                start = time.perf_counter()
+                await api_call(session, "POST", f"{api_url}/invoices", json={"price": 1, "store_id": store["id"]})
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            print(f"wallets: {wallets_count}, daemon latency: {StubDaemon.LATENCY * 1000:.0f}ms, invoices: {invoices_count}")
+            print(f"mean: {statistics.mean(timings):.1f}ms")
+            print(f"p50: {timings[len(timings) // 2]:.1f}ms")
+            print(f"p95: {timings[min(len(timings) - 1, int(len(timings) * 0.95))]:.1f}ms")
+            await api_call(session, "DELETE", f"{api_url}/stores/{store['id']}")
+            for wallet_id in wallet_ids:
+                await api_call(session, "DELETE", f"{api_url}/wallets/{wallet_id}")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Opens many websockets for a pending invoice against a running API, measures redis connections and delivery latency
+# Raise the open files limit first (ulimit -n 65535), then run from the repository root:
+# python3 scripts/load-test-websockets.py API_URL INVOICE_ID [sockets=10000] [messages=20] [redis_url=redis://localhost]
+import asyncio
+import json
+import statistics
+import sys
+import time
+
+import aioredis
+from aiohttp import ClientSession, TCPConnector, WSMsgType
+
+CONNECT_CONCURRENCY = 200
+
+
+async def get_redis_stats(redis):
+    clients = await redis.info("clients")
+    return {"connected_clients": clients["connected_clients"], "patterns": await redis.pubsub_numpat()}
+
+
+async def open_socket(session, url, semaphore):
+    async with semaphore:
+        return await session.ws_connect(url, heartbeat=None, autoping=True)
+
+
+async def receive(websocket, messages, latencies):
+    for _ in range(messages):
+        msg = await websocket.receive()
+        if msg.type != WSMsgType.TEXT:
+            return
+        latencies.append((time.time() - json.loads(msg.data)["sent"]) * 1000)
+
+
+async def main():
+    if len(sys.argv) < 3:
+        sys.exit(f"Usage: {sys.argv[0]} API_URL INVOICE_ID [sockets] [messages] [redis_url]")
+    api_url, invoice_id = sys.argv[1].rstrip("/"), sys.argv[2]
+    sockets_count = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    messages = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+    redis = aioredis.from_url(sys.argv[5] if len(sys.argv) > 5 else "redis://localhost", decode_responses=True)
+    ws_url = api_url.replace("http", "ws", 1) + f"/ws/invoices/{invoice_id}"
+    before = await get_redis_stats(redis)
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    async with ClientSession(connector=TCPConnector(limit=0)) as session:
+        start = time.perf_counter()
+        websockets = await asyncio.gather(*(open_socket(session, ws_url, semaphore) for _ in range(sockets_count)))
+        print(f"opened {sockets_count} websockets in {time.perf_counter() - start:.1f}s")
+        await asyncio.sleep(1)
+        after = await get_redis_stats(redis)
+        print(f"redis clients: {before['connected_clients']} -> {after['connected_clients']}")
+        print(f"pattern subscriptions: {before['patterns']} -> {after['patterns']}")
+        latencies = []
+        receivers = [asyncio.create_task(receive(websocket, messages, latencies)) for websocket in websockets]
+        for _ in range(messages):
+            await redis.publish(f"channel:invoice:{invoice_id}", json.dumps({"status": "pending", "sent": time.time()}))
+            await asyncio.sleep(0.1)
+        await asyncio.wait(receivers, timeout=30)
+        latencies.sort()
+        print(f"delivered: {len(latencies)}/{sockets_count * messages}")
+        if latencies:
+            print(f"mean: {statistics.mean(latencies):.1f}ms")
+            print(f"p50: {latencies[len(latencies) // 2]:.1f}ms")
+            print(f"p99: {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]:.1f}ms")
+        await asyncio.gather(*(websocket.close() for websocket in websockets))
+    await redis.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
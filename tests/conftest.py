@@ -39,6 +39,7 @@ async def setup_template_database():
         await db.status(f"CREATE DATABASE {template_db_name}")
     settings.db_name = template_db_name
     async with settings.with_db():
+        await db.status("CREATE EXTENSION IF NOT EXISTS pg_trgm")  # created by migrations in production
         await db.gino.create_all()
 
 
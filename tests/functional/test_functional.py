@@ -135,10 +135,13 @@ async def ipn_server(queue, client):
     await runner.cleanup()
 
 
-def check_status(queue, data):
+def check_status(queue, data, allow_next=False):
     queue_data = queue.get()
     assert queue_data[0] == data
-    assert queue_data[0]["status"] == queue_data[1]
+    if allow_next:  # IPNs are sent in the background, so the next status can be set already (zeroconf)
+        assert queue_data[1] in (data["status"], "complete")
+    else:
+        assert queue_data[0]["status"] == queue_data[1]
 
 
 @pytest.fixture
@@ -175,7 +178,7 @@ async def test_onchain_pay_flow(client, ws_client, regtest_api_store, token, wor
         utils.run_shell(["newblocks", str(speed)])
         await check_invoice_status(ws_client, invoice_id, "complete")
     assert queue.qsize() == 2
-    check_status(queue, {"id": invoice["id"], "status": "paid"})
+    check_status(queue, {"id": invoice["id"], "status": "paid"}, allow_next=zeroconf)
     check_status(queue, {"id": invoice["id"], "status": "complete"})
 
 
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "daemons"))
+
+from base import BaseDaemon  # noqa: E402
+
+
+class StubDaemon(BaseDaemon):
+    name = "STUB"
+    BASE_SPEC_FILE = "daemons/spec/btc.json"
+    DEFAULT_PORT = 5099
+
+
+class DummyWebsocket:
+    def __init__(self, queue_size):
+        self.config = {"xpub": None}
+        self.queue = asyncio.Queue(queue_size)
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.anyio
+async def test_websocket_notifications_stalled_client():
+    daemon = StubDaemon()
+    websockets = [DummyWebsocket(2) for _ in range(4)]
+    for ws in websockets:
+        daemon.subscribe_websocket(ws, None)
+    wallet_ws = DummyWebsocket(2)
+    daemon.subscribe_websocket(wallet_ws, "xpub")
+    stalled = websockets[1]
+    stalled.queue.put_nowait("old")
+    stalled.queue.put_nowait("old")
+    data = {"event": "new_block", "height": 1}
+    daemon.queue_notification(daemon.app["websockets"][None], data, None)  # live set, modified while sending
+    await asyncio.sleep(0)
+    assert stalled.closed
+    assert daemon.get_websockets(None) == set(websockets) - {stalled}
+    for ws in websockets:
+        if ws is not stalled:
+            assert json.loads(ws.queue.get_nowait()) == daemon.build_notification(data, None)
+    assert wallet_ws.queue.empty()
+    await daemon.notify_websockets(data, "xpub")
+    assert json.loads(wallet_ws.queue.get_nowait()) == daemon.build_notification(data, "xpub")
+    assert daemon.get_websockets("xpub") == set(websockets) - {stalled} | {wallet_ws}
+
+
+class CappedNode:
+    # answers batch requests of up to batch_limit blocks, like public nodes with batch size limits
+    def __init__(self, batch_limit):
+        self.batch_limit = batch_limit
+        self.requests = []
+
+    async def send_rpc_request(self, payload):
+        self.requests.append(payload)
+        if isinstance(payload, dict):
+            return {"jsonrpc": "2.0", "id": payload["id"], "result": {"number": payload["params"][0]}}
+        if len(payload) > self.batch_limit:
+            return {"jsonrpc": "2.0", "id": None, "error": {"code": -32600, "message": "batch too large"}}
+        return [{"jsonrpc": "2.0", "id": item["id"], "result": {"number": item["params"][0]}} for item in payload]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("batch_limit", [0, 7, 30])
+async def test_eth_get_blocks_fallback(batch_limit):
+    pytest.importorskip("web3")
+    import eth
+
+    daemon = eth.ETHDaemon.__new__(eth.ETHDaemon)
+    daemon.VERBOSE = False
+    daemon.batch_size = 30
+    node = CappedNode(batch_limit)
+    daemon.send_rpc_request = node.send_rpc_request
+    blocks = await daemon.get_blocks(range(100, 130))
+    assert [block["number"] for block in blocks] == [hex(number) for number in range(100, 130)]
+    assert daemon.batch_size <= max(batch_limit, 1)
+    requests_count = len(node.requests)
+    await daemon.get_blocks(range(130, 160))  # smaller batches are remembered
+    assert len(node.requests) - requests_count == -(-30 // daemon.batch_size)
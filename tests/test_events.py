@@ -1,8 +1,9 @@
+import json
 from queue import Queue
 
 import pytest
 
-from api import events
+from api import constants, events, settings, utils
 
 
 @pytest.fixture
@@ -54,3 +55,13 @@ async def test_process_message(event_handler):
     await events.process_message({"event": "test_event", "data": sample_data}, event_handler)
     assert queue.qsize() == 1
     assert queue.get() == sample_data
+
+
+@pytest.mark.anyio
+async def test_events_queue(mocker):
+    mocker.patch.object(constants, "EVENTS_QUEUE", f"events:queue:{utils.common.unique_id()}")
+    mocker.patch.object(constants, "EVENTS_QUEUE_SIZE", 2)
+    for index in range(3):
+        await events.event_handler.publish("expired_task", {"id": str(index)})
+    queued = await settings.settings.redis_pool.lrange(constants.EVENTS_QUEUE, 0, -1)
+    assert [json.loads(message)["data"]["id"] for message in queued] == ["2", "1"]  # oldest event dropped
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from api import utils
+from api.ext.cluster import ClusterManager
+
+
+class Counter:
+    def __init__(self):
+        self.started = 0
+        self.stopped = 0
+
+    async def start(self):
+        self.started += 1
+
+    async def stop(self):
+        self.stopped += 1
+
+
+@pytest.mark.anyio
+async def test_partition_failover():
+    name = f"test:{utils.common.unique_id()}"
+    workers = [ClusterManager(), ClusterManager()]
+    counters = [Counter(), Counter()]
+    for worker, counter in zip(workers, counters):
+        worker.add_partition(name, counter.start, counter.stop)
+    for worker in workers:
+        await worker.check_partitions()
+    await asyncio.sleep(0)  # partitions are started in background
+    assert workers[0].owned_partitions == [name]
+    assert workers[1].owned_partitions == []
+    await workers[0].check_partitions()  # renewal doesn't restart
+    await asyncio.sleep(0)
+    assert counters[0].started == 1
+    await workers[0].stop()
+    assert counters[0].stopped == 1
+    await workers[1].check_partitions()
+    await asyncio.sleep(0)
+    assert workers[1].owned_partitions == [name]
+    assert counters[1].started == 1
+    await workers[1].partitions[name].lease.release()  # i.e. lease expired and was taken by another worker
+    await workers[1].check_partitions()
+    await asyncio.sleep(0)
+    assert workers[1].owned_partitions == []
+    assert counters[1].stopped == 1
+
+
+@pytest.mark.anyio
+async def test_slow_partition_start():
+    name = f"test:{utils.common.unique_id()}"
+    started = asyncio.Event()
+    stopped = []
+
+    async def start():
+        started.set()
+        await asyncio.Event().wait()  # i.e. slow network requests on startup
+
+    async def stop():
+        stopped.append(True)
+
+    worker = ClusterManager()
+    worker.add_partition(name, start, stop)
+    await asyncio.wait_for(worker.check_partitions(), timeout=5)
+    await asyncio.wait_for(started.wait(), timeout=5)
+    assert await asyncio.wait_for(worker.partitions[name].lease.renew(), timeout=5)
+    await asyncio.wait_for(worker.check_partitions(), timeout=5)  # renewal is not blocked by the start
+    assert worker.owned_partitions == [name]
+    starting = worker.partitions[name].starting
+    await worker.stop()
+    await asyncio.sleep(0)
+    assert starting.cancelled()
+    assert stopped == [True]
@@ -1,9 +1,10 @@
 import io
+import json
 
 import pytest
 
 from api import models, utils
-from api.ext.export import db_to_json, json_to_csv, merge_keys
+from api.ext.export import db_to_json, iterate_batches, json_to_csv, merge_keys, stream_csv, stream_json, stream_ndjson
 
 
 def test_merge_keys():
@@ -26,3 +27,21 @@ def test_json_to_csv():
     assert isinstance(converted, io.StringIO)
     value = converted.getvalue()
     assert value.strip() == 'list,obj_obj2_field,test\r\n"[1,2,3]",4,1'
+
+
+@pytest.mark.anyio
+async def test_stream_export(invoice):
+    items = await models.Invoice.query.gino.all()
+    await utils.database.postprocess_func(items)
+    csv_data = "".join([chunk async for chunk in stream_csv(iterate_batches([items, items]), add_payments=True)])
+    # same flattened layout as the non-streaming export
+    assert csv_data == json_to_csv(list(db_to_json(items + items, add_payments=True))).getvalue()
+    header = csv_data.split("\r\n")[0].split(",")
+    assert "payments_0_amount" in header
+    assert len(csv_data.strip().split("\r\n")) == 3
+    csv_data = "".join([chunk async for chunk in stream_csv(iterate_batches([items]))])
+    assert not any(name.startswith("payments") for name in csv_data.split("\r\n")[0].split(","))
+    ndjson_data = "".join([chunk async for chunk in stream_ndjson(iterate_batches([items]))])
+    assert [json.loads(line)["id"] for line in ndjson_data.splitlines()] == [items[0].id]
+    json_data = json.loads("".join([chunk async for chunk in stream_json(iterate_batches([items, items]))]))
+    assert len(json_data) == 2
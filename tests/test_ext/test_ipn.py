@@ -0,0 +1,87 @@
+import time
+
+import pytest
+from aiohttp import ClientSession
+
+from api import models, settings, utils
+from api.ext import ipn as ipn_ext
+from tests.helper import create_invoice
+
+
+@pytest.fixture
+def ipn_keys(mocker):
+    # tests can run in parallel, so each one uses its own queues
+    prefix = f"ipn:{utils.common.unique_id()}"
+    mocker.patch.object(ipn_ext, "QUEUE_KEY", f"{prefix}:queue")
+    mocker.patch.object(ipn_ext, "PROCESSING_KEY", f"{prefix}:processing")
+    mocker.patch.object(ipn_ext, "RETRY_KEY", f"{prefix}:retry")
+    mocker.patch.object(ipn_ext, "WAITING_KEY", f"{prefix}:waiting:{{}}")
+
+
+def test_retry_delay(mocker):
+    mocker.patch.object(settings.settings, "ipn_retry_delay", 5)
+    assert [ipn_ext.get_retry_delay(attempts) for attempts in range(1, 5)] == [5, 10, 20, 40]
+    assert ipn_ext.get_retry_delay(100) == ipn_ext.MAX_RETRY_DELAY
+
+
+@pytest.mark.anyio
+async def test_ipn_delivery(client, token, user, mocker, ipn_keys):
+    mocker.patch.object(settings.settings, "ipn_max_attempts", 2)
+    redis = settings.settings.redis_pool
+    invoice = await create_invoice(client, user["id"], token, notification_url="http://127.0.0.1:1")
+    invoice_obj = await utils.database.get_object(models.Invoice, invoice["id"])
+    await utils.notifications.send_ipn(invoice_obj, "paid")
+    delivery_id = await redis.rpop(ipn_ext.QUEUE_KEY)
+    manager = ipn_ext.IPNDeliveryManager()
+    manager.session = ClientSession()
+    try:
+        delivery = await manager.process(delivery_id)
+        assert delivery.invoice_id == invoice["id"]
+        assert delivery.data == {"id": invoice["id"], "status": "paid"}
+        assert delivery.status == ipn_ext.DeliveryStatus.PENDING
+        assert delivery.attempts == 1
+        assert delivery.error
+        assert await redis.zscore(ipn_ext.RETRY_KEY, delivery_id) > time.time()
+        delivery = await manager.process(delivery_id)
+        assert delivery.status == ipn_ext.DeliveryStatus.FAILED
+        assert delivery.attempts == 2
+        assert await manager.process(delivery_id) is None  # already finished
+    finally:
+        await manager.session.close()
+
+
+@pytest.mark.anyio
+async def test_ipn_delivery_order(client, token, user, mocker, ipn_keys):
+    mocker.patch.object(settings.settings, "ipn_max_attempts", 1)
+    redis = settings.settings.redis_pool
+    invoice = await create_invoice(client, user["id"], token, notification_url="http://127.0.0.1:1")
+    invoice_obj = await utils.database.get_object(models.Invoice, invoice["id"])
+    paid = await ipn_ext.enqueue(invoice_obj, "paid")
+    complete = await ipn_ext.enqueue(invoice_obj, "complete")
+    await redis.delete(ipn_ext.QUEUE_KEY)
+    manager = ipn_ext.IPNDeliveryManager()
+    manager.session = ClientSession()
+    try:
+        assert await manager.process(complete.id) is None  # waits until paid is delivered
+        assert await redis.lrange(ipn_ext.WAITING_KEY.format(invoice["id"]), 0, -1) == [complete.id]
+        assert (await manager.process(paid.id)).status == ipn_ext.DeliveryStatus.FAILED
+        assert await redis.rpop(ipn_ext.QUEUE_KEY) == complete.id
+        assert (await manager.process(complete.id)).attempts == 1
+    finally:
+        await manager.session.close()
+
+
+@pytest.mark.anyio
+async def test_requeue_pending(client, token, user, mocker, ipn_keys):
+    mocker.patch.object(ipn_ext, "REQUEUE_GRACE_PERIOD", 0)
+    redis = settings.settings.redis_pool
+    invoice = await create_invoice(client, user["id"], token, notification_url="http://127.0.0.1:1")
+    invoice_obj = await utils.database.get_object(models.Invoice, invoice["id"])
+    queued = await ipn_ext.enqueue(invoice_obj, "paid")
+    lost = await ipn_ext.enqueue(invoice_obj, "complete")
+    await redis.lrem(ipn_ext.QUEUE_KEY, 1, lost.id)  # redis data lost
+    manager = ipn_ext.IPNDeliveryManager()
+    assert await manager.requeue_pending() == [lost.id]
+    assert await redis.zscore(ipn_ext.RETRY_KEY, lost.id) == 0
+    assert await redis.lrange(ipn_ext.QUEUE_KEY, 0, -1) == [queued.id]
+    assert await manager.requeue_pending() == []
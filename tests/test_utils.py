@@ -1,4 +1,5 @@
 import asyncio
+import json
 import os
 import shlex
 import subprocess
@@ -11,9 +12,11 @@ import pytest
 from aioredis.client import PubSub
 from bitcart.errors import BaseError as BitcartBaseError
 from notifiers.exceptions import BadArguments
+from sqlalchemy.dialects import postgresql
 
-from api import exceptions, models, schemes, settings, utils
-from tests.helper import create_notification, create_store
+from api import exceptions, invoices, models, schemes, settings, templates, utils
+from api.db import db
+from tests.helper import create_invoice, create_notification, create_store
 
 
 def test_verify_password():
@@ -43,6 +46,66 @@ async def test_make_subscriber():
     assert await utils.redis.publish_message("test", {"hello": "world"}) == 1
 
 
+class DummyWebsocket:
+    def __init__(self):
+        self.messages = asyncio.Queue()
+        self.closed = False
+
+    async def send_text(self, data):
+        await self.messages.put(data)
+
+    async def close(self):
+        self.closed = True
+
+
+class StalledWebsocket(DummyWebsocket):
+    async def send_text(self, data):
+        await asyncio.Event().wait()
+
+
+@pytest.mark.anyio
+async def test_channel_multiplexer():
+    multiplexer = utils.redis.get_multiplexer()
+    assert utils.redis.get_multiplexer() is multiplexer
+    ws1, ws2, ws3 = DummyWebsocket(), DummyWebsocket(), DummyWebsocket()
+    await multiplexer.subscribe("invoice:muxtest", ws1)
+    await multiplexer.subscribe("invoice:muxtest", ws2)
+    await multiplexer.subscribe("wallet:muxtest", ws3)
+    assert multiplexer.stats == {"channels": 2, "sockets": 3}
+    await utils.redis.publish_message("invoice:muxtest", {"status": "paid"})
+    for ws in (ws1, ws2):
+        assert json.loads(await asyncio.wait_for(ws.messages.get(), timeout=5)) == {"status": "paid"}
+    assert ws3.messages.empty()
+    multiplexer.unsubscribe("invoice:muxtest", ws1)
+    multiplexer.unsubscribe("invoice:muxtest", ws2)
+    multiplexer.unsubscribe("invoice:muxtest", ws2)  # no-op
+    assert multiplexer.stats == {"channels": 1, "sockets": 1}
+    await multiplexer.close()
+    assert multiplexer.stats == {"channels": 0, "sockets": 0}
+
+
+@pytest.mark.anyio
+async def test_channel_multiplexer_slow_client(mocker):
+    mocker.patch.object(utils.redis.ChannelMultiplexer, "QUEUE_SIZE", 2)
+    multiplexer = utils.redis.ChannelMultiplexer()
+    stalled, ws = StalledWebsocket(), DummyWebsocket()
+    await multiplexer.subscribe("invoice:slowtest", stalled)
+    await multiplexer.subscribe("invoice:slowtest", ws)
+    for i in range(4):
+        multiplexer.dispatch({"channel": "channel:invoice:slowtest", "data": json.dumps({"i": i})})
+        await asyncio.sleep(0.01)  # let senders take the message
+    for i in range(4):  # not delayed by the stalled client
+        assert json.loads(await asyncio.wait_for(ws.messages.get(), timeout=5)) == {"i": i}
+    await asyncio.sleep(0)
+    assert stalled.closed
+    assert multiplexer.stats == {"channels": 1, "sockets": 1}
+    multiplexer.listener.cancel()  # listener stopped, it is started again on the next subscription
+    await asyncio.sleep(0)
+    await multiplexer.subscribe("invoice:slowtest", DummyWebsocket())
+    assert not multiplexer.listener.done()
+    await multiplexer.close()
+
+
 @dataclass
 class MockTemplateObj:
     template_name: str
@@ -94,6 +157,55 @@ async def test_get_template(notification_template, client, token, user):
     assert template3.template_text == template2.template_text
 
 
+@pytest.mark.anyio
+async def test_load_custom_templates(client, token, user):
+    template_ids = []
+    for name in ("first", "second"):
+        resp = await client.post("/templates", json={"name": name, "text": name}, headers={"Authorization": f"Bearer {token}"})
+        template_ids.append(resp.json()["id"])
+    keys = [
+        ("first", user["id"], None),
+        ("product", user["id"], template_ids[1]),
+        ("second", "other_user", None),
+        ("second", None, None),
+        ("first", "other_user", template_ids[0]),
+        ("missing", user["id"], None),
+    ]
+    result = await utils.templates.load_custom_templates(keys)
+    assert [template.id if template else None for template in result] == [
+        template_ids[0],
+        template_ids[1],
+        None,
+        template_ids[1],
+        None,
+        None,
+    ]
+
+
+@pytest.mark.anyio
+async def test_compiled_templates_cache(client, token, user, mocker):
+    compile_mock = mocker.patch("api.templates.Template.compile", wraps=templates.Template.compile)
+    resp = await client.post(
+        "/templates",
+        json={"name": "cached", "text": "Hello {{var1}}!"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    template_id = resp.json()["id"]
+    for _ in range(3):
+        template = await utils.templates.get_template("cached", user_id=user["id"])
+        assert template.render(var1="world") == "Hello world!"
+    assert compile_mock.call_count == 1
+    assert (
+        await client.patch(
+            f"/templates/{template_id}", json={"text": "Bye {{var1}}!"}, headers={"Authorization": f"Bearer {token}"}
+        )
+    ).status_code == 200
+    assert not any(key[0] == template_id for key in settings.settings.templates_cache)
+    template = await utils.templates.get_template("cached", user_id=user["id"])
+    assert template.render(var1="world") == "Bye world!"
+    assert compile_mock.call_count == 2
+
+
 @pytest.mark.anyio
 async def test_product_template(client, token, user):
     qty = 10
@@ -336,3 +448,181 @@ async def test_send_notification(client, token, user, mocker):
     )
     await check_modify_notify(client, store, notification_id, token, base_data, "max_price", "5.5", int, expect_raises=False)
     await check_modify_notify(client, store, notification_id, token, base_data, "max_price", "test", int, expect_raises=True)
+
+
+@pytest.mark.anyio
+async def test_coin_pool():
+    wallet_key = {"xpub": "xpub_pool_test", "contract": None}
+    stats = settings.settings.coin_pool_stats
+    coin = settings.settings.get_coin("btc", wallet_key)
+    assert settings.settings.get_coin("BTC", wallet_key) is coin
+    assert settings.settings.get_coin("btc", "xpub_pool_test") is coin
+    new_stats = settings.settings.coin_pool_stats
+    assert new_stats["hits"] == stats["hits"] + 2
+    assert new_stats["misses"] == stats["misses"] + 1
+    settings.settings.evict_coin("btc", "xpub_pool_test")
+    assert settings.settings.get_coin("btc", wallet_key) is not coin
+    assert settings.settings.get_coin("btc") is settings.settings.cryptos["btc"]
+
+
+@pytest.mark.anyio
+async def test_rates_cache(mocker, wallet):
+    mocker.patch.object(settings.settings, "rates_cache_ttl", 60)
+    rate_mock = mocker.patch("bitcart.BTC.rate", return_value=Decimal(10))
+    await settings.settings.redis_pool.delete("rate:btc::RATESTEST")  # left over from previous runs
+    wallet_obj = schemes.Wallet(**wallet)
+    rates = await asyncio.gather(*(utils.wallets.get_rate(wallet_obj, "RATESTEST") for _ in range(5)))
+    assert rates == [Decimal(10)] * 5
+    assert await utils.wallets.get_rate(wallet_obj, "RATESTEST") == Decimal(10)
+    rate_mock.assert_called_once_with("RATESTEST")
+
+
+@pytest.mark.anyio
+async def test_token_metadata_cache(mocker):
+    coin = mocker.Mock()
+    coin.server.readcontract = mocker.AsyncMock(return_value=18)
+    wallet_obj = schemes.CreateWallet(name="token", xpub="xpub_token_test", currency="eth", contract="0xtoken")
+    for _ in range(3):
+        assert await utils.wallets.get_token_metadata(coin, wallet_obj, "decimals") == 18
+    coin.server.readcontract.assert_called_once_with("0xtoken", "decimals")
+    assert await utils.wallets.get_wallet_symbol(coin, schemes.CreateWallet(name="btc", xpub="xpub")) == "btc"
+
+
+@pytest.mark.anyio
+async def test_load_data_batch(client, token, user):
+    invoice_ids = [(await create_invoice(client, user["id"], token))["id"] for _ in range(2)]
+    items = await models.Invoice.query.where(models.Invoice.id.in_(invoice_ids)).gino.all()
+    await models.Invoice.load_data_batch(items)
+    for invoice in items:
+        expected = await utils.database.get_object(models.Invoice, invoice.id)
+        assert invoice.payments == expected.payments
+        assert invoice.products == expected.products
+
+
+@pytest.mark.anyio
+async def test_data_loader():
+    calls = []
+
+    async def batch_load(keys):
+        calls.append(keys)
+        return [key * 2 for key in keys]
+
+    with utils.loaders.loaders_context():
+        loader = utils.loaders.get_loader("test", batch_load)
+        assert utils.loaders.get_loader("test", batch_load) is loader
+        assert await asyncio.gather(*(loader.load(key) for key in [1, 2, 1, 3])) == [2, 4, 2, 6]
+        assert await loader.load(2) == 4
+    assert calls == [[1, 2, 3]]
+    assert utils.loaders.get_loader("test", batch_load) is not loader
+
+
+@pytest.mark.anyio
+async def test_load_wallet_balances_concurrency(mocker):
+    mocker.patch.object(settings.settings, "wallet_balances_concurrency", 2)
+    running = 0
+    max_running = 0
+
+    async def get_balance(wallet):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return wallet
+
+    mocker.patch("api.utils.wallets.get_confirmed_wallet_balance", side_effect=get_balance)
+    assert await utils.loaders.load_wallet_balances(list(range(5))) == list(range(5))
+    assert max_running == 2
+
+
+@pytest.mark.anyio
+async def test_delivery_retries(mocker):
+    mocker.patch.object(settings.settings, "delivery_retry_delay", 0)
+    mocker.patch.object(settings.settings, "delivery_max_attempts", 3)
+    calls = []
+
+    def flaky(value):
+        calls.append(value)
+        if len(calls) < 3:
+            raise OSError("Connection refused")
+        return value
+
+    assert await utils.delivery.deliver("test", flaky, 5) == 5
+    assert calls == [5, 5, 5]
+    failing = mocker.Mock(side_effect=OSError("Connection refused"))
+    with pytest.raises(OSError):
+        await utils.delivery.deliver("test", failing)
+    assert failing.call_count == 3
+    with pytest.raises(exceptions.PermanentDeliveryError):
+        await utils.delivery.deliver("test", mocker.Mock(side_effect=exceptions.PermanentDeliveryError("Auth failed")))
+    with pytest.raises(ValueError):
+        await utils.delivery.deliver("test", mocker.Mock(side_effect=ValueError), fatal_errors=(ValueError,))
+    stats = settings.settings.delivery_stats["test"]
+    assert (stats["sent"], stats["failed"], stats["retries"]) == (1, 3, 4)
+
+
+@pytest.mark.anyio
+async def test_expire_invoices(client, token, user):
+    now = utils.time.now()
+    expired = await create_invoice(client, user["id"], token, created=(now - timedelta(hours=1)).isoformat())
+    pending = await create_invoice(client, user["id"], token)
+    assert await invoices.get_next_expiration() < now
+    assert [invoice.id for invoice in await invoices.expire_invoices()] == [expired["id"]]
+    assert (await utils.database.get_object(models.Invoice, expired["id"])).status == invoices.InvoiceStatus.EXPIRED
+    assert (await utils.database.get_object(models.Invoice, pending["id"])).status == invoices.InvoiceStatus.PENDING
+    assert await invoices.expire_invoices() == []
+    assert await invoices.get_next_expiration() > now
+
+
+@pytest.mark.anyio
+async def test_update_status_atomic(client, token, user, mocker):
+    invoice = await create_invoice(client, user["id"], token)
+    copies = [await utils.database.get_object(models.Invoice, invoice["id"]) for _ in range(3)]
+    methods = [mocker.Mock(get_name=mocker.Mock(return_value=name), discount=None) for name in ("BTC", "LTC", "BCH")]
+    results = await asyncio.gather(
+        *(invoices.update_status(copy, invoices.InvoiceStatus.PAID, method) for copy, method in zip(copies, methods))
+    )
+    assert results.count(True) == 1
+    paid_currency = copies[results.index(True)].paid_currency
+    invoice_obj = await utils.database.get_object(models.Invoice, invoice["id"])
+    assert invoice_obj.status == invoices.InvoiceStatus.PAID
+    assert invoice_obj.paid_currency == paid_currency
+    # stale copies and repeated events don't change anything
+    assert not await invoices.update_status(copies[0], invoices.InvoiceStatus.PAID, methods[0])
+    assert await invoices.update_status(copies[1], invoices.InvoiceStatus.COMPLETE, methods[1])
+    assert copies[1].paid_currency == paid_currency  # the first paid method is kept
+    assert not await invoices.update_status(copies[2], invoices.InvoiceStatus.EXPIRED)
+    assert not await invoices.update_status(copies[2], invoices.InvoiceStatus.PENDING)
+    invoice_obj = await utils.database.get_object(models.Invoice, invoice["id"])
+    assert invoice_obj.status == invoices.InvoiceStatus.COMPLETE
+
+
+async def explain(query):
+    sql = query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    return "\n".join(row[0] for row in await db.all(f"EXPLAIN {sql}"))
+
+
+@pytest.mark.anyio
+async def test_payment_lookup_indexes(client, token, user):
+    invoice = await create_invoice(client, user["id"], token)
+    # a large history of finished invoices, like on a long-running instance
+    await db.status(
+        "INSERT INTO invoices (id, price, status, created) "
+        "SELECT 'seed' || i, 1, 'complete', now() FROM generate_series(1, 20000) i"
+    )
+    await db.status(
+        "INSERT INTO paymentmethods (id, invoice_id, amount, confirmations, recommended_fee, currency, "
+        "payment_address, payment_url, lookup_field, created) "
+        "SELECT 'seed' || i, 'seed' || i, 1, 0, 0, 'btc', 'address' || i, 'bitcoin:address' || i, 'address' || i, now() "
+        "FROM generate_series(1, 20000) i"
+    )
+    await db.status("INSERT INTO walletsxstores (wallet_id, store_id) SELECT NULL, NULL FROM generate_series(1, 20000)")
+    await db.status("ANALYZE")
+    currency, address = invoice["payments"][0]["currency"], invoice["payments"][0]["lookup_field"]
+    plan = await explain(invoices.get_pending_invoices_query(currency).where(models.PaymentMethod.lookup_field == address))
+    for table in ("paymentmethods", "invoices", "walletsxstores"):
+        assert f"Seq Scan on {table}" not in plan
+    assert "paymentmethods_currency_lookup_field_idx" in plan
+    plan = await explain(invoices.get_pending_invoices_query(currency))
+    assert "Seq Scan on invoices" not in plan
+    assert "Seq Scan on paymentmethods" not in plan
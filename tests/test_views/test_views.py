@@ -12,7 +12,7 @@ from bitcart import BTC, LTC
 from bitcart.errors import BaseError as BitcartBaseError
 from parametrization import Parametrization
 
-from api import invoices, models, schemes, settings, templates, utils
+from api import crud, invoices, models, schemes, settings, templates, utils
 from api.constants import BACKUP_FREQUENCIES, BACKUP_PROVIDERS, DOCKER_REPO_URL, SUPPORTED_CRYPTOS
 from api.ext import tor as tor_ext
 from api.invoices import InvoiceStatus
@@ -573,6 +573,11 @@ async def test_export_invoices(client: TestClient, token: str, limited_user):
     json_resp = await client.get("/invoices/export?all_users=true", headers={"Authorization": f"Bearer {token}"})
     data = json_resp.json()
     assert len(data) == 1
+    ndjson_resp = await client.get(
+        "/invoices/export?all_users=true&export_format=ndjson", headers={"Authorization": f"Bearer {token}"}
+    )
+    assert ndjson_resp.headers["content-type"] == "application/x-ndjson"
+    assert [json_module.loads(line) for line in ndjson_resp.text.splitlines()] == data
     assert data[0]["id"] == invoice["id"]
     assert "payments" not in data[0]
     assert (
@@ -1006,6 +1011,25 @@ async def test_multiple_wallets_same_currency(client, token: str, user):
     assert resp["payments"][1]["name"] == "BTC (2)"
 
 
+async def test_payment_methods_order(client, token: str, user, mocker):
+    wallets = [(await create_wallet(client, user["id"], token, label=f"Wallet {i}"))["id"] for i in range(4)]
+    create_payment_method = crud.invoices._create_payment_method
+
+    async def slow_create_payment_method(*args, **kwargs):
+        position = args[7]
+        await asyncio.sleep(0.05 * (len(wallets) - position))  # later wallets finish first
+        return await create_payment_method(*args, **kwargs)
+
+    mocker.patch("api.crud.invoices._create_payment_method", side_effect=slow_create_payment_method)
+    resp = await client.post(
+        "/stores", json={"name": "Ordered", "wallets": wallets}, headers={"Authorization": f"Bearer {token}"}
+    )
+    assert resp.status_code == 200
+    resp = await client.post("/invoices", json={"price": 5, "store_id": resp.json()["id"]})
+    assert resp.status_code == 200
+    assert [method["name"] for method in resp.json()["payments"]] == [f"Wallet {i}" for i in range(4)]
+
+
 async def test_change_store_checkout_settings(client: TestClient, token: str, store):
     store_id = store["id"]
     assert (await client.patch(f"/stores/{store_id}/checkout_settings")).status_code == 401
@@ -1346,3 +1370,36 @@ async def test_syncinfo(client: TestClient, token, mocker):
     data = (await client.get("/manage/syncinfo", headers={"Authorization": f"Bearer {token}"})).json()
     item = find_element(data, "BTC")
     assert item["running"] is False
+
+
+async def test_auth_cache(client: TestClient, user, token: str, mocker):
+    mocker.patch.object(settings.settings, "auth_cache_ttl", 30)
+    headers = {"Authorization": f"Bearer {token}"}
+    assert (await client.get("/users/me", headers=headers)).status_code == 200
+    assert token in settings.settings.auth_cache
+    miss_spy = mocker.spy(utils.authorization, "dump_model")
+    assert (await client.get("/users/me", headers=headers)).json()["id"] == user["id"]
+    miss_spy.assert_not_called()
+    await client.patch("/users/me/settings", json={"balance_currency": "EUR"}, headers=headers)
+    assert token not in settings.settings.auth_cache
+    assert (await client.get("/users/me", headers=headers)).json()["settings"]["balance_currency"] == "EUR"
+    assert (await client.delete(f"/token/{token}", headers=headers)).status_code == 200
+    assert (await client.get("/users/me", headers=headers)).status_code == 401
+
+
+async def test_auth_cache_invalidation_during_read(client: TestClient, user, token: str, mocker):
+    mocker.patch.object(settings.settings, "auth_cache_ttl", 30)
+    load_principal = utils.authorization.load_principal
+
+    async def invalidated_load_principal(token_id):
+        result = await load_principal(token_id)
+        await utils.authorization.invalidate_tokens([token_id])  # concurrent settings change
+        return result
+
+    mocker.patch("api.utils.authorization.load_principal", side_effect=invalidated_load_principal)
+    assert (await client.get("/users/me", headers={"Authorization": f"Bearer {token}"})).status_code == 200
+    assert token not in settings.settings.auth_cache
+    data = await utils.redis.get_json(utils.authorization.get_auth_cache_key(token))
+    assert "hashed_password" not in data["user"]
+    assert data["user"]["id"] == user["id"]
+    assert await utils.authorization.get_cached_principal(token, settings.settings.auth_cache_generation) == (None, "1")
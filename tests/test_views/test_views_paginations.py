@@ -113,3 +113,52 @@ async def test_date_pagination(client: TestClient, user, token):
     await check_start_date_query(client, token, "-1w", 1, invoice3["id"], start=False)
     await check_start_date_query(client, token, "-1d", 2, invoice2["id"], start=False)
     await check_start_date_query(client, token, "-1h", 3, invoice1["id"], start=False)
+
+
+async def test_cursor_pagination(client: TestClient, token: str):
+    users = [(await create_user(client))["id"] for _ in range(3)]
+    resp = await client.get("/users?limit=2&cursor=", headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == 200
+    data = resp.json()
+    assert data["count"] >= 3
+    assert data["previous"] is None
+    assert [item["id"] for item in data["result"]] == users[::-1][:2]
+    assert "offset" not in data["next"]
+    resp = await client.get(data["next"], headers={"Authorization": f"Bearer {token}"})
+    next_data = resp.json()
+    assert next_data["result"][0]["id"] == users[0]
+    resp = await client.get(next_data["previous"], headers={"Authorization": f"Bearer {token}"})
+    assert [item["id"] for item in resp.json()["result"]] == users[::-1][:2]
+    resp = await client.get("/users?limit=2&cursor=&with_count=false", headers={"Authorization": f"Bearer {token}"})
+    assert resp.json()["count"] is None
+    resp = await client.get("/users?cursor=invalid", headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == 422
+
+
+async def test_search_ranking(client: TestClient, user, token):
+    exact = await create_invoice(client, user["id"], token, order_id="ranktest")
+    await create_invoice(client, user["id"], token, order_id="ranktestextra")
+    resp = await client.get("/invoices?query=ranktest", headers={"Authorization": f"Bearer {token}"})
+    assert resp.json()["count"] == 2
+    assert resp.json()["result"][0]["id"] == exact["id"]
+    resp = await client.get("/invoices?query=ranktest&sort=created", headers={"Authorization": f"Bearer {token}"})
+    assert resp.json()["result"][0]["id"] != exact["id"]
+    resp = await client.get("/invoices?query=ranktest status:pending", headers={"Authorization": f"Bearer {token}"})
+    assert resp.json()["count"] == 2
+
+
+async def test_search_anchors(client: TestClient, user, token):
+    exact = await create_invoice(client, user["id"], token, order_id="anchortest")
+    await create_invoice(client, user["id"], token, order_id="anchortest2", notification_url="https://anchortest.com")
+    await create_invoice(client, user["id"], token, order_id="2anchortest")
+    resp = await client.get(f"/invoices?query={quote('^anchortest$')}", headers={"Authorization": f"Bearer {token}"})
+    assert resp.json()["count"] == 1
+    assert resp.json()["result"][0]["id"] == exact["id"]
+    resp = await client.get(f"/invoices?query={quote('^anchortest')}", headers={"Authorization": f"Bearer {token}"})
+    assert resp.json()["count"] == 2
+    # anchors match per column, notification_url is searched too (quoted, as it contains a colon)
+    query = quote('"^https://anchortest"')
+    resp = await client.get(f"/invoices?query={query}", headers={"Authorization": f"Bearer {token}"})
+    assert resp.json()["count"] == 1
+    resp = await client.get(f"/invoices?query={quote('anchortest2.*https')}", headers={"Authorization": f"Bearer {token}"})
+    assert resp.json()["count"] == 0
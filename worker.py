@@ -5,6 +5,7 @@ import time
 from multiprocessing import Process
 
 import sqlalchemy
+from bitcart import APIManager
 
 from alembic import config, script
 from alembic.runtime import migration
@@ -12,13 +13,17 @@ from api import events, invoices
 from api import settings as settings_module
 from api import tasks
 from api.ext import backups as backup_ext
+from api.ext import cluster as cluster_ext
 from api.ext import configurator as configurator_ext
+from api.ext import ipn as ipn_ext
 from api.ext import tor as tor_ext
 from api.ext import update as update_ext
+from api.logserver import is_port_open
 from api.logserver import main as start_logserver
 from api.logserver import wait_for_port
 from api.settings import Settings
 from api.utils.common import run_repeated
+from api.utils.tasks import create_task
 
 
 def check_db():
@@ -38,26 +43,73 @@ def check_db():
         return False
 
 
-async def main():
-    settings = settings_module.settings_ctx.get()
-    await settings_module.init()
-    settings_module.log_startup_info()
+leader_tasks = []
+
+
+async def start_leader():
+    # tasks which must run in one worker only
     await tor_ext.refresh(log=False)  # to pre-load data for initial requests
     await update_ext.refresh()
     await configurator_ext.refresh_pending_deployments()
     await backup_ext.manager.start()
-    asyncio.ensure_future(run_repeated(tor_ext.refresh, 60 * 10, 10))
-    asyncio.ensure_future(run_repeated(update_ext.refresh, 60 * 60 * 24))
-    settings.manager.add_event_handler("new_payment", invoices.new_payment_handler)
-    settings.manager.add_event_handler("new_block", invoices.new_block_handler)
-    await invoices.create_expired_tasks()  # to ensure invoices get expired actually
-    coro = events.start_listening(tasks.event_handler)  # to avoid deleted task errors
-    asyncio.ensure_future(coro)
-    await settings.manager.start_websocket(reconnect_callback=invoices.check_pending, force_connect=True)
+    await ipn_ext.manager.start()
+    await invoices.expiration_scheduler.start()  # also expires invoices which expired while no worker was running
+    leader_tasks.extend(
+        [
+            create_task(run_repeated(tor_ext.refresh, 60 * 10, 10)),
+            create_task(run_repeated(update_ext.refresh, 60 * 60 * 24)),
+            create_task(events.listen_queue(tasks.event_handler)),  # so that events are processed once
+        ]
+    )
+
+
+async def stop_leader():
+    for task in leader_tasks:
+        task.cancel()
+    leader_tasks.clear()
+    await backup_ext.manager.reset_task()
+    await ipn_ext.manager.stop()
+    await invoices.expiration_scheduler.stop()
+
+
+class CurrencyListener:
+    # daemon websocket of one currency, owned by one worker so that payments are processed once
+    def __init__(self, currency):
+        self.currency = currency
+        self.task = None
+
+    async def start(self):
+        settings = settings_module.settings_ctx.get()
+        manager = APIManager({self.currency.upper(): []})
+        manager.wallets[self.currency.upper()][""] = settings.cryptos[self.currency]
+        manager.add_event_handler("new_payment", invoices.new_payment_handler)
+        manager.add_event_handler("new_block", invoices.new_block_handler)
+        self.task = create_task(manager.start_websocket(reconnect_callback=invoices.check_pending, force_connect=True))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+async def main():
+    settings = settings_module.settings_ctx.get()
+    await settings_module.init()
+    settings_module.log_startup_info()
+    cluster_ext.manager.add_partition("leader", start_leader, stop_leader)
+    for currency in settings.enabled_cryptos:
+        listener = CurrencyListener(currency)
+        cluster_ext.manager.add_partition(f"currency:{currency}", listener.start, listener.stop)
+    try:
+        await cluster_ext.manager.start()
+        await cluster_ext.manager.task
+    finally:  # let other workers take over without waiting for leases to expire
+        await cluster_ext.manager.stop()
 
 
 def handler(signum, frame):
-    process.terminate()
+    if process is not None:
+        process.terminate()
     sys.exit()
 
 
@@ -65,9 +117,12 @@ if __name__ == "__main__":
     settings = Settings()
     try:
         token = settings_module.settings_ctx.set(settings)
-        process = Process(target=start_logserver)
-        process.start()
-        wait_for_port()
+        process = None
+        # one logserver per host, other workers send logs to the running one
+        if not is_port_open(port=settings.logserver_port):
+            process = Process(target=start_logserver)
+            process.start()
+        wait_for_port(port=settings.logserver_port)
         signal.signal(signal.SIGINT, handler)
         # wait for db
         while True: